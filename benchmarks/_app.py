@@ -0,0 +1,48 @@
+"""Wspólne narzędzia benchmarków - import aplikacji bez prawdziwych sekretów"""
+import json
+import os
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLACEHOLDER_SECRETS = {
+    "EMAIL_USERNAME": "benchmark@localhost",
+    "EMAIL_PASSWORD": "benchmark",
+    "IMAP_SERVER": "127.0.0.1",
+    "IMAP_PORT": "143",
+}
+
+def import_app(**secrets):
+    """Importuje streamlit_app.
+
+    Streamlit szuka sekretów w .streamlit/secrets.toml bieżącego katalogu.
+    Jeśli ich tam nie ma (albo podano własne ustawienia), przechodzimy do
+    katalogu tymczasowego z fikcyjnymi danymi - benchmarki nie łączą się
+    z prawdziwym serwerem. Gdy aplikacja jest już zaimportowana (kilka
+    testów w jednym procesie), podane ustawienia zastępują atrybuty modułu
+    odczytane z sekretów przy pierwszym imporcie, a pula IMAP i indeks
+    nagłówków są tworzone od nowa.
+    """
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    if "streamlit_app" in sys.modules:
+        app = sys.modules["streamlit_app"]
+        for key, value in secrets.items():
+            if hasattr(app, key):
+                setattr(app, key, value)
+        if secrets:
+            # Pula IMAP i indeks nagłówków powstały z poprzednimi ustawieniami
+            app.close_imap_pool()
+            app.get_header_index.clear()
+        return app
+    if secrets or not os.path.exists(os.path.join(".streamlit", "secrets.toml")):
+        workdir = tempfile.mkdtemp(prefix="mail-opener-bench-")
+        os.makedirs(os.path.join(workdir, ".streamlit"))
+        with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w") as f:
+            for key, value in dict(PLACEHOLDER_SECRETS, **secrets).items():
+                # Napisy, liczby i wartości logiczne w JSON są też poprawnym TOML
+                f.write(f"{key} = {json.dumps(value)}\n")
+        os.chdir(workdir)
+    import streamlit_app
+    return streamlit_app
@@ -0,0 +1,115 @@
+"""Generator syntetycznych skrzynek o kształtach spotykanych w prawdziwych newsletterach.
+
+Kształty:
+    alternative - multipart/alternative: tekst + HTML z obrazkami i linkami śledzącymi
+    cid         - multipart/related: HTML z wieloma obrazkami osadzonymi (cid:)
+    charsets    - części w iso-8859-2 / windows-1250 / utf-8 (base64 i quoted-printable)
+    attachment  - multipart/mixed: newsletter + duży załącznik PDF
+"""
+import random
+from email.charset import Charset, BASE64, QP
+from email.header import Header
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from _servers import make_png
+
+DEFAULT_MIX = {"alternative": 40, "cid": 25, "charsets": 25, "attachment": 10}
+
+SUBJECT_PREFIX = "Benchmark"
+
+POLISH_TEXT = "Zażółć gęślą jaźń - wyjątkowa oferta dla Ciebie! Sprawdź nowości w naszym sklepie. "
+
+def _html(rng, base_url, message_id, images=12, links=15, cid_images=()):
+    """Treść HTML newslettera; linki prowadzą przez przekierowania serwera zastępczego"""
+    blocks = ['<!DOCTYPE html><html><head><meta charset="utf-8"><style>td{font-family:Arial}</style></head>'
+              '<body style="margin:0"><table width="100%" cellpadding="0" cellspacing="0">']
+    blocks.append(f'<tr><td><img src="{base_url}/img/logo.png" width="200" height="60" alt="Logo"></td></tr>')
+    for i in range(max(images, links, len(cid_images))):
+        cells = [f'<p style="line-height:1.5">{POLISH_TEXT * rng.randint(1, 4)}</p>']
+        if i < len(cid_images):
+            cells.append(f'<img src="cid:{cid_images[i]}" width="560" height="200" alt="Baner {i}">')
+        if i < images:
+            cells.append(f'<img src="{base_url}/img/{message_id}-{i}.png" width="120" height="60">')
+        if i < links:
+            # "leadingmail.pl" w adresie - aplikacja wybiera części HTML z linkami śledzącymi
+            cells.append(f'<a href="{base_url}/r/{message_id}-{i}?via=leadingmail.pl&amp;u={rng.getrandbits(32):x}">Zobacz ofertę {i}</a>')
+        blocks.append('<tr><td style="padding:10px 20px">' + ''.join(cells) + '</td></tr>')
+    blocks.append(f'<img src="{base_url}/o/{message_id}.gif" width="1" height="1"></table></body></html>')
+    return ''.join(blocks)
+
+def _text(rng):
+    return (POLISH_TEXT * rng.randint(5, 20)).strip()
+
+def _headers(message, shape, number):
+    message['Subject'] = Header(f"{SUBJECT_PREFIX} {shape} #{number} - zniżki", 'utf-8')
+    message['From'] = f"newsletter-{shape}@example.com"
+    message['List-Id'] = f"<{shape}.newsletter.example.com>"
+    message['Date'] = "Mon, 06 Oct 2025 10:00:00 +0200"
+    return message
+
+def _alternative(rng, base_url, message_id, **options):
+    message = MIMEMultipart('alternative')
+    message.attach(MIMEText(_text(rng), 'plain', 'utf-8'))
+    message.attach(MIMEText(_html(rng, base_url, message_id), 'html', 'utf-8'))
+    return message
+
+def _cid(rng, base_url, message_id, cid_images=10, **options):
+    message = MIMEMultipart('related')
+    content_ids = [f"image{i}.{message_id}@campaign" for i in range(cid_images)]
+    message.attach(MIMEText(_html(rng, base_url, message_id, images=2, cid_images=content_ids), 'html', 'utf-8'))
+    for content_id in content_ids:
+        image = MIMEImage(make_png(content_id, rng.randint(4, 40) * 1024), 'png')
+        image['Content-ID'] = f"<{content_id}>"
+        image.add_header('Content-Disposition', 'inline', filename=content_id.split('@')[0] + '.png')
+        message.attach(image)
+    return message
+
+def _charsets(rng, base_url, message_id, **options):
+    charset_name = rng.choice(['iso-8859-2', 'windows-1250', 'utf-8'])
+    charset = Charset(charset_name)
+    charset.body_encoding = rng.choice([BASE64, QP])
+    message = MIMEMultipart('alternative')
+    for subtype, content in (('plain', _text(rng)), ('html', _html(rng, base_url, message_id, images=6, links=8))):
+        if charset_name != 'utf-8':
+            content = content.replace('charset="utf-8"', f'charset="{charset_name}"')
+        part = MIMEText('', subtype)
+        part.set_payload(content, charset)
+        message.attach(part)
+    return message
+
+def _attachment(rng, base_url, message_id, attachment_size=1024 * 1024, **options):
+    message = MIMEMultipart('mixed')
+    message.attach(_alternative(rng, base_url, message_id))
+    attachment = MIMEApplication(b'%PDF-1.4\n' + rng.randbytes(attachment_size), 'pdf')
+    attachment.add_header('Content-Disposition', 'attachment', filename=f"katalog-{message_id}.pdf")
+    message.attach(attachment)
+    return message
+
+SHAPES = {
+    "alternative": _alternative,
+    "cid": _cid,
+    "charsets": _charsets,
+    "attachment": _attachment,
+}
+
+def generate_message(shape, rng, base_url, message_id, number=0, **options):
+    """Jeden mail o danym kształcie jako bajty RFC 822"""
+    message = SHAPES[shape](rng, base_url, message_id, **options)
+    return _headers(message, shape, number).as_bytes()
+
+def generate_mailbox(count, base_url, seed=1, mix=None, prefix="m", **options):
+    """Lista (kształt, bajty) dla count maili; proporcje kształtów według mix.
+
+    prefix odróżnia adresy obrazków między skrzynkami, żeby kolejne pomiary
+    nie korzystały z pamięci obrazów wypełnionej przez poprzednie.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    shapes = rng.choices(list(mix), weights=list(mix.values()), k=count)
+    return [
+        (shape, generate_message(shape, rng, base_url, f"{prefix}{number}", number, **options))
+        for number, shape in enumerate(shapes, 1)
+    ]
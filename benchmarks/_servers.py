@@ -0,0 +1,497 @@
+"""Lokalne serwery zastępcze dla benchmarków - IMAP i HTTP bez dostępu do sieci.
+
+Serwer IMAP obsługuje podzbiór IMAP4rev1 potrzebny aplikacji: LOGIN, SELECT,
+STATUS, SEARCH (ALL, SUBJECT, RETURN (COUNT), CHARSET z literałem), FETCH
+(RFC822, RFC822.SIZE, BODYSTRUCTURE, BODY[sekcja]<zakres>, HEADER.FIELDS),
+STORE i EXPUNGE, także w wariantach UID, oraz IDLE i NOOP z powiadomieniami
+EXISTS/EXPUNGE o zmianach z innych połączeń. Z compress=True ogłasza
+COMPRESS=DEFLATE (RFC 4978). Serwer HTTP zwraca obrazki, strony
+docelowe przekierowań i piksele śledzące. Oba mogą sztucznie opóźniać
+odpowiedzi, żeby odtworzyć opóźnienia prawdziwej sieci.
+"""
+import email
+import hashlib
+import re
+import select
+import socketserver
+import struct
+import threading
+import time
+import zlib
+from email import policy
+from email.header import decode_header, make_header
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CAPABILITIES = "IMAP4rev1 UIDPLUS ESEARCH CONDSTORE IDLE"
+
+def _quote(value):
+    if value is None:
+        return "NIL"
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def _split_part(part):
+    """(nagłówki, treść) części w postaci, w jakiej serwer zwraca sekcje"""
+    raw = part.as_bytes(policy=policy.compat32)
+    header, _, body = raw.partition(b"\n\n")
+    return header + b"\n\n", body
+
+def _param_list(pairs):
+    if not pairs:
+        return "NIL"
+    return "(" + " ".join(f"{_quote(key.upper())} {_quote(value)}" for key, value in pairs) + ")"
+
+def bodystructure(part):
+    """BODYSTRUCTURE części w formacie RFC 3501 (z MD5 i disposition)"""
+    if part.is_multipart():
+        children = "".join(bodystructure(child) for child in part.get_payload())
+        return f"({children} {_quote(part.get_content_subtype().upper())})"
+    params = (part.get_params() or [])[1:]
+    body = _split_part(part)[1]
+    encoding = (part.get("Content-Transfer-Encoding") or "7BIT").upper()
+    fields = [
+        _quote(part.get_content_maintype().upper()),
+        _quote(part.get_content_subtype().upper()),
+        _param_list(params),
+        _quote(part.get("Content-ID")),
+        "NIL",
+        _quote(encoding),
+        str(len(body)),
+    ]
+    if part.get_content_maintype() == "text":
+        fields.append(str(body.count(b"\n")))
+    fields.append("NIL")  # MD5
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_param("filename", header="Content-Disposition")
+        disposition_params = _param_list([("filename", filename)] if filename else [])
+        fields.append(f"({_quote(disposition.upper())} {disposition_params})")
+    else:
+        fields.append("NIL")
+    return "(" + " ".join(fields) + ")"
+
+def fetch_section(message, raw, section):
+    """Zawartość BODY[section] - cały mail, nagłówki, wybrane pola albo część"""
+    if section == "":
+        return raw
+    if section == "HEADER":
+        return _split_part(message)[0]
+    if section.startswith("HEADER.FIELDS"):
+        names = section[section.index("(") + 1:section.rindex(")")].lower().split()
+        lines = [f"{name}: {value}\r\n" for name, value in message.items() if name.lower() in names]
+        return "".join(lines).encode("utf-8", errors="replace") + b"\r\n"
+    mime = section.endswith(".MIME")
+    if mime:
+        section = section[:-len(".MIME")]
+    part = message
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    header, body = _split_part(part)
+    return header if mime else body
+
+class StoredMessage:
+    def __init__(self, uid, raw):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set()
+        self._message = None
+
+    @property
+    def message(self):
+        if self._message is None:
+            self._message = email.message_from_bytes(self.raw)
+        return self._message
+
+    def subject(self):
+        value = self.message.get("Subject") or ""
+        return str(make_header(decode_header(value)))
+
+class Mailbox:
+    """Jedna skrzynka (INBOX) współdzielona przez wszystkie połączenia"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.messages = []
+        self.uidvalidity = 1
+        self.next_uid = 1
+        self.modseq = 1
+        self.commands = 0
+
+    def load(self, raw_messages):
+        """Zastępuje zawartość skrzynki nowym zestawem maili"""
+        with self.lock:
+            self.messages = []
+            self.uidvalidity += 1
+            self.next_uid = 1
+            for raw in raw_messages:
+                self.append(raw)
+
+    def append(self, raw):
+        with self.lock:
+            self.messages.append(StoredMessage(self.next_uid, raw))
+            self.next_uid += 1
+            self.modseq += 1
+            self.changed.notify_all()
+
+class _DeflateReader:
+    """Odczyt strumienia COMPRESS=DEFLATE - readline()/read() jak plik gniazda"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def _fill(self):
+        data = self.raw.read1(65536)
+        if not data:
+            return False
+        self.buffer += self.decompressor.decompress(data)
+        return True
+
+    def _take(self, size):
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self):
+        while b"\n" not in self.buffer and self._fill():
+            pass
+        return self._take(self.buffer.find(b"\n") + 1 or len(self.buffer))
+
+    def read(self, size):
+        while len(self.buffer) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def close(self):
+        self.raw.close()
+
+class _DeflateWriter:
+    """Zapis strumienia COMPRESS=DEFLATE; flush() wysyła dane z Z_SYNC_FLUSH"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.pending = False
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+    def write(self, data):
+        self.raw.write(self.compressor.compress(data))
+        self.pending = True
+
+    def flush(self):
+        # Puste flush() (np. w pętli IDLE) nie wysyła pustych bloków
+        if self.pending:
+            self.raw.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.pending = False
+        self.raw.flush()
+
+    def close(self):
+        self.raw.close()
+
+def _parse_sequence_set(sequence_set, highest):
+    numbers = set()
+    for item in sequence_set.split(","):
+        first, _, last = item.partition(":")
+        first = highest if first == "*" else int(first)
+        last = first if not last else (highest if last == "*" else int(last))
+        numbers.update(range(min(first, last), max(first, last) + 1))
+    return numbers
+
+_SECTION_PATTERN = re.compile(r"BODY(?:\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?", re.IGNORECASE)
+_LITERAL_PATTERN = re.compile(rb"\{(\d+)\}\r?\n$")
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode("utf-8"))
+
+    def read_command(self):
+        """Linia komendy razem z doklejonymi literałami {n}"""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        while True:
+            match = _LITERAL_PATTERN.search(line)
+            if not match:
+                break
+            self.send("+ Ready for literal data\r\n")
+            self.wfile.flush()
+            literal = self.rfile.read(int(match.group(1)))
+            line = line[:match.start()] + b'"' + literal + b'"' + self.rfile.readline()
+        return line.decode("utf-8", errors="replace").rstrip("\r\n")
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.known = []  # UID maili w kolejności numerów, tak jak widzi je ten klient
+        self.compressed = False
+        self.send("* OK IMAP stand-in ready\r\n")
+        self.wfile.flush()
+        while True:
+            line = self.read_command()
+            if line is None:
+                return
+            tag, _, rest = line.partition(" ")
+            command, _, arguments = rest.partition(" ")
+            command = command.upper()
+            use_uid = command == "UID"
+            if use_uid:
+                command, _, arguments = arguments.partition(" ")
+                command = command.upper()
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            with mailbox.lock:
+                mailbox.commands += 1
+                if command == "LOGOUT":
+                    self.send(f"* BYE\r\n{tag} OK LOGOUT completed\r\n")
+                    self.wfile.flush()
+                    return
+                handler = getattr(self, "cmd_" + command.lower(), None)
+                if handler is None:
+                    self.send(f"{tag} BAD unknown command {command}\r\n")
+                elif not handler(mailbox, tag, arguments, use_uid):
+                    # Handler zwraca True, jeśli sam wysłał odpowiedź z tagiem
+                    self.send(f"{tag} OK {command} completed\r\n")
+            self.wfile.flush()
+
+    def cmd_capability(self, mailbox, tag, arguments, use_uid):
+        extra = " COMPRESS=DEFLATE" if self.server.compress and not self.compressed else ""
+        self.send(f"* CAPABILITY {CAPABILITIES}{extra}\r\n")
+
+    def cmd_compress(self, mailbox, tag, arguments, use_uid):
+        if not self.server.compress or self.compressed or arguments.upper() != "DEFLATE":
+            self.send(f"{tag} NO compression not available\r\n")
+            return True
+        # Odpowiedź jeszcze bez kompresji, wszystko po niej - skompresowane
+        self.send(f"{tag} OK DEFLATE active\r\n")
+        self.wfile.flush()
+        self.rfile = _DeflateReader(self.rfile)
+        self.wfile = _DeflateWriter(self.wfile)
+        self.compressed = True
+        return True
+
+    def cmd_login(self, mailbox, tag, arguments, use_uid):
+        pass
+
+    def cmd_noop(self, mailbox, tag, arguments, use_uid):
+        self._report_changes(mailbox)
+
+    def cmd_idle(self, mailbox, tag, arguments, use_uid):
+        self.send("+ idling\r\n")
+        while True:
+            self._report_changes(mailbox)
+            self.wfile.flush()
+            mailbox.changed.wait(0.05)
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                # DONE (albo zamknięte połączenie) kończy IDLE
+                self.rfile.readline()
+                return
+
+    def _report_changes(self, mailbox):
+        """EXPUNGE i EXISTS dla zmian wprowadzonych przez inne połączenia"""
+        live = {message.uid for message in mailbox.messages}
+        for number in range(len(self.known), 0, -1):
+            if self.known[number - 1] not in live:
+                self.send(f"* {number} EXPUNGE\r\n")
+                del self.known[number - 1]
+        if len(self.known) != len(mailbox.messages):
+            self.known = [message.uid for message in mailbox.messages]
+            self.send(f"* {len(self.known)} EXISTS\r\n")
+
+    def cmd_select(self, mailbox, tag, arguments, use_uid):
+        self.known = [message.uid for message in mailbox.messages]
+        self.send(
+            f"* {len(mailbox.messages)} EXISTS\r\n"
+            f"* OK [UIDVALIDITY {mailbox.uidvalidity}]\r\n"
+            f"* OK [UIDNEXT {mailbox.next_uid}]\r\n"
+        )
+
+    cmd_examine = cmd_select
+
+    def cmd_status(self, mailbox, tag, arguments, use_uid):
+        items = f"MESSAGES {len(mailbox.messages)} UIDNEXT {mailbox.next_uid} UIDVALIDITY {mailbox.uidvalidity}"
+        if "HIGHESTMODSEQ" in arguments.upper():
+            items += f" HIGHESTMODSEQ {mailbox.modseq}"
+        name = arguments.split(" ")[0]
+        self.send(f"* STATUS {name} ({items})\r\n")
+
+    def cmd_search(self, mailbox, tag, arguments, use_uid):
+        count_only = arguments.upper().startswith("RETURN (COUNT)")
+        match = re.search(r'SUBJECT "((?:[^"\\]|\\.)*)"', arguments, re.IGNORECASE)
+        if match:
+            needle = re.sub(r"\\(.)", r"\1", match.group(1)).lower()
+            hits = [
+                (number, message) for number, message in enumerate(mailbox.messages, 1)
+                if needle in message.subject().lower()
+            ]
+        else:
+            hits = list(enumerate(mailbox.messages, 1))
+        if count_only:
+            self.send(f'* ESEARCH (TAG "{tag}") COUNT {len(hits)}\r\n')
+            return
+        ids = [str(message.uid if use_uid else number) for number, message in hits]
+        self.send("* SEARCH" + "".join(" " + value for value in ids) + "\r\n")
+
+    def _select(self, mailbox, sequence_set, use_uid):
+        if use_uid:
+            highest = mailbox.messages[-1].uid if mailbox.messages else 0
+            wanted = _parse_sequence_set(sequence_set, highest)
+            return [(n, m) for n, m in enumerate(mailbox.messages, 1) if m.uid in wanted]
+        wanted = _parse_sequence_set(sequence_set, len(mailbox.messages))
+        return [(n, m) for n, m in enumerate(mailbox.messages, 1) if n in wanted]
+
+    def cmd_fetch(self, mailbox, tag, arguments, use_uid):
+        sequence_set, _, items = arguments.partition(" ")
+        upper_items = items.upper()
+        for number, message in self._select(mailbox, sequence_set, use_uid):
+            out = f"* {number} FETCH (UID {message.uid}".encode()
+            if "RFC822.SIZE" in upper_items:
+                out += f" RFC822.SIZE {len(message.raw)}".encode()
+            if "BODYSTRUCTURE" in upper_items:
+                out += b" BODYSTRUCTURE " + bodystructure(message.message).encode("utf-8")
+            if re.search(r"RFC822(?![.])", upper_items):
+                out += f" RFC822 {{{len(message.raw)}}}\r\n".encode() + message.raw
+            for section, offset, length in _SECTION_PATTERN.findall(items):
+                data = fetch_section(message.message, message.raw, section.upper())
+                origin = ""
+                if offset:
+                    data = data[int(offset):int(offset) + int(length)]
+                    origin = f"<{offset}>"
+                out += f" BODY[{section}]{origin} {{{len(data)}}}\r\n".encode() + data
+            self.send(out + b")\r\n")
+
+    def cmd_store(self, mailbox, tag, arguments, use_uid):
+        sequence_set, _, change = arguments.partition(" ")
+        for _, message in self._select(mailbox, sequence_set, use_uid):
+            if "\\DELETED" in change.upper():
+                if change.startswith("-"):
+                    message.flags.discard("\\Deleted")
+                else:
+                    message.flags.add("\\Deleted")
+                mailbox.modseq += 1
+
+    def cmd_expunge(self, mailbox, tag, arguments, use_uid):
+        allowed = None
+        if use_uid and arguments:
+            allowed = {message.uid for _, message in self._select(mailbox, arguments, True)}
+        for number in range(len(mailbox.messages), 0, -1):
+            message = mailbox.messages[number - 1]
+            if "\\Deleted" in message.flags and (allowed is None or message.uid in allowed):
+                self.send(f"* {number} EXPUNGE\r\n")
+                del mailbox.messages[number - 1]
+                mailbox.modseq += 1
+                if message.uid in self.known:
+                    self.known.remove(message.uid)
+        mailbox.changed.notify_all()
+
+class StandInIMAPServer(socketserver.ThreadingTCPServer):
+    """Serwer IMAP na 127.0.0.1 z losowym portem; start() uruchamia go w wątku tła"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, compress=False):
+        super().__init__(("127.0.0.1", 0), IMAPHandler)
+        self.mailbox = Mailbox()
+        self.latency = latency
+        self.compress = compress
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="imap-stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def make_png(seed, size=2048):
+    """Poprawny (1x1) PNG dopełniony blokiem tEXt do zadanego rozmiaru"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    header = chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 2, 0, 0, 0))
+    pixel = chunk(b"IDAT", zlib.compress(b"\x00" + hashlib.sha256(seed.encode()).digest()[:3]))
+    padding = max(0, size - 8 - len(header) - len(pixel) - 12 - 12)
+    text = chunk(b"tEXt", b"pad\x00" + b"x" * max(0, padding - 4))
+    return b"\x89PNG\r\n\x1a\n" + header + text + pixel + chunk(b"IEND", b"")
+
+TRACKING_GIF = (
+    b"GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00"
+    b",\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
+)
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    """/img/<nazwa>.png - obrazek, /r/<id> - przekierowanie, /landing/<id> - strona, /o/<id>.gif - piksel"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b"", content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+        path = self.path.split("?", 1)[0]
+        if path.startswith("/img/"):
+            etag = '"' + hashlib.sha1(path.encode()).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.reply(304, headers={"ETag": etag})
+                return
+            body = make_png(path, server.image_size)
+            self.reply(200, body, "image/png", {"ETag": etag, "Cache-Control": "max-age=3600"})
+        elif path.startswith("/r/"):
+            self.reply(302, headers={"Location": "/landing/" + path[len("/r/"):]})
+        elif path.startswith("/landing/"):
+            page_id = path[len("/landing/"):]
+            body = (
+                f'<html><body><h1>Oferta {page_id}</h1>'
+                f'<img src="/o/{page_id}.gif" width="1" height="1"></body></html>'
+            ).encode()
+            self.reply(200, body, "text/html; charset=utf-8")
+        elif path.startswith("/o/"):
+            self.reply(200, TRACKING_GIF, "image/gif", {"Cache-Control": "no-store"})
+        else:
+            self.reply(404, b"not found")
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    """Serwer HTTP z obrazkami i linkami na 127.0.0.1; base_url wstawiany jest do generowanych maili"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, image_size=2048):
+        super().__init__(("127.0.0.1", 0), HTTPHandler)
+        self.latency = latency
+        self.image_size = image_size
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="http-stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
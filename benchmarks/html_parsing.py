@@ -0,0 +1,91 @@
+"""Benchmark przetwarzania HTML: BeautifulSoup (dotychczasowa ścieżka) vs podmiana atrybutów w miejscu.
+
+Użycie:
+    python benchmarks/html_parsing.py [plik.html ...]
+
+Bez argumentów używany jest wygenerowany, duży newsletter. Najlepiej podać
+prawdziwe maile zapisane jako HTML.
+"""
+import argparse
+import random
+import time
+
+from _app import import_app
+
+app = import_app()
+
+def generate_newsletter(blocks=400, seed=1):
+    """Generuje newsletter o typowym kształcie: tabele, style inline, dużo obrazków i linków"""
+    rng = random.Random(seed)
+    chunks = [
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Newsletter</title>',
+        '<style>td{font-family:Arial} .btn{color:#fff}</style></head>',
+        '<body style="margin:0"><!-- preheader --><table width="100%" cellpadding="0" cellspacing="0">'
+    ]
+    for i in range(blocks):
+        chunks.append(
+            f'<tr><td style="padding:10px 20px;background:#f{rng.randint(0, 9)}f">'
+            f'<img src="cid:image{i % 20}@campaign" width="560" height="200" alt="Baner {i}" style="display:block">'
+            f'<h2 style="font-size:20px">Nagłówek sekcji {i}</h2>'
+            f'<p style="line-height:1.5">Zażółć gęślą jaźń &amp; inne treści promocyjne numer {i}. ' + 'Lorem ipsum dolor sit amet. ' * 8 + '</p>'
+            f'<a class="btn" href="https://click.leadingmail.pl/r/{rng.getrandbits(64):x}?u={i}&amp;c=42">Zobacz ofertę</a>'
+            f'<img src="https://cdn.example.com/img/{i}.png" width="120" height="60">'
+            '</td></tr>'
+        )
+    chunks.append('<img src="https://open.leadingmail.pl/o/abc" width="1" height="1"></table></body></html>')
+    return ''.join(chunks)
+
+def rewrite(html_content, mode, parser=None):
+    """Ta sama praca co process_html_content, bez sieci: podmiana src/href i styl body"""
+    if mode == "soup":
+        soup = app.BeautifulSoup(html_content, parser)
+    else:
+        soup = app.parse_html_document(html_content, mode)
+    for img in soup.find_all('img'):
+        src = img.get('src')
+        if src:
+            img['src'] = 'data:image/png;base64,AAAA'
+    links = [a for a in soup.find_all('a') if a.get('href')]
+    if links:
+        links[0]['href'] = 'https://example.com/clicked'
+    body = soup.find('body')
+    if body:
+        body['style'] = 'max-width: 800px; margin: auto; padding: 20px; font-family: Arial, sans-serif;'
+    return str(soup)
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), sum(timings) / len(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help="pliki HTML z prawdziwymi newsletterami")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    documents = []
+    for path in args.files:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            documents.append((path, f.read()))
+    if not documents:
+        documents.append(("syntetyczny newsletter", generate_newsletter()))
+
+    variants = [("soup / html.parser (dotychczas)", lambda h: rewrite(h, "soup", "html.parser"))]
+    if app._detect_html_parser() == 'lxml':
+        variants.append(("soup / lxml", lambda h: rewrite(h, "soup", "lxml")))
+    variants.append(("fast (podmiana w miejscu)", lambda h: rewrite(h, "fast")))
+    variants.append(("piksele: soup / html.parser", lambda h: app.find_tracking_images(h, "soup")))
+    variants.append(("piksele: fast", lambda h: app.find_tracking_images(h, "fast")))
+
+    for name, html_content in documents:
+        print(f"\n{name}: {len(html_content) / 1024:.0f} KiB")
+        for label, func in variants:
+            best, mean = measure(lambda: func(html_content), args.repeat)
+            print(f"  {label:<34} min {best * 1000:8.1f} ms   średnio {mean * 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    main()
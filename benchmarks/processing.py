@@ -0,0 +1,165 @@
+"""Benchmark przetwarzania maili offline: lokalny serwer IMAP i HTTP + syntetyczne skrzynki.
+
+Użycie:
+    python benchmarks/processing.py [--sizes 50 200] [--imap-latency-ms 0] [--http-latency-ms 0] [--compress]
+
+Dla każdego rozmiaru skrzynki mierzone są etapy: decode_content,
+process_html_content, process_email (z pobraniem z IMAP i usunięciem) oraz
+cały przebieg open_emails_by_subject. Z --process-pool N dwa ostatnie etapy
+parsują i przepisują HTML w puli N procesów, a z --compress serwer
+zastępczy oferuje COMPRESS=DEFLATE i na końcu podany jest ruch IMAP przed
+i po kompresji w pełnym przebiegu. Każdy etap dostaje świeżo
+wygenerowaną skrzynkę, więc obrazki zewnętrzne nie pochodzą z pamięci
+poprzedniego etapu. Klikanie linków jest domyślnie wyłączone - aplikacja
+celowo czeka po kliknięciu 0,5-2 s, co zdominowałoby wyniki.
+"""
+import argparse
+import email
+import os
+import tempfile
+import time
+from collections import Counter
+
+from _mailbox import DEFAULT_MIX, SUBJECT_PREFIX, generate_mailbox
+from _servers import StandInHTTPServer, StandInIMAPServer
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def report(label, latencies, elapsed):
+    count = len(latencies)
+    throughput = count / elapsed if elapsed else 0.0
+    print(
+        f"  {label:<28} {count:>6} {throughput:>9.1f} "
+        f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.95) * 1000:>9.1f} "
+        f"{max(latencies, default=0) * 1000:>9.1f}"
+    )
+
+def bench_decode_content(app, messages):
+    latencies = []
+    parsed = [email.message_from_bytes(raw) for _, raw in messages]
+    started = time.perf_counter()
+    for message in parsed:
+        sender_key = app.get_sender_key(message)
+        begin = time.perf_counter()
+        for part in message.walk():
+            if part.get_content_type() in ("text/plain", "text/html"):
+                app.decode_content(part, sender_key)
+        latencies.append(time.perf_counter() - begin)
+    return latencies, time.perf_counter() - started
+
+def bench_process_html_content(app, messages, click_percentage):
+    prepared = []
+    for _, raw in messages:
+        message = email.message_from_bytes(raw)
+        html_parts = [part for part in message.walk() if part.get_content_type() == "text/html"]
+        if html_parts:
+            prepared.append((message, app.decode_content(html_parts[-1])))
+    latencies = []
+    started = time.perf_counter()
+    for number, (message, html_content) in enumerate(prepared):
+        should_click = number * 100 < len(prepared) * click_percentage
+        begin = time.perf_counter()
+        app.process_html_content(html_content, message, should_click)
+        latencies.append(time.perf_counter() - begin)
+    return latencies, time.perf_counter() - started
+
+def bench_process_email(app, imap_server, messages, click_percentage, partial):
+    imap_server.mailbox.load(raw for _, raw in messages)
+    use_process_pool = app.PROCESS_POOL_SIZE > 0
+    latencies = []
+    with app.get_imap_pool().connection() as mail:
+        mail.select("inbox")
+        uids = mail.uid('SEARCH', 'ALL')[1][0].split()
+        started = time.perf_counter()
+        with app.make_deleter("batched", mail, True) as deleter:
+            for number, uid in enumerate(uids):
+                should_click = number * 100 < len(uids) * click_percentage
+                begin = time.perf_counter()
+                app.process_email(uid, mail, should_click, None, True, deleter, partial, None, use_process_pool)
+                latencies.append(time.perf_counter() - begin)
+        return latencies, time.perf_counter() - started
+
+def bench_full_run(app, imap_server, messages, click_percentage, partial, transfers):
+    imap_server.mailbox.load(raw for _, raw in messages)
+    job = app.Job()
+    started = time.perf_counter()
+    results = app.open_emails_by_subject(
+        SUBJECT_PREFIX, interval=0, click_percentage=click_percentage, partial=partial, job=job
+    )
+    elapsed = time.perf_counter() - started
+    transfers.append(job.snapshot()['transfer'])
+    latencies = [row.fetch_time + row.process_time for row in results.rows] if results else []
+    return latencies, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 200], help="rozmiary skrzynek (liczba maili)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--imap-latency-ms', type=float, default=0, help="opóźnienie każdej komendy IMAP")
+    parser.add_argument('--http-latency-ms', type=float, default=0, help="opóźnienie każdego żądania HTTP")
+    parser.add_argument('--click-percentage', type=int, default=0)
+    parser.add_argument('--full-fetch', action='store_true', help="pobieraj całe maile zamiast wybranych części")
+    parser.add_argument('--attachment-kb', type=int, default=1024, help="rozmiar załącznika w kształcie 'attachment'")
+    parser.add_argument('--cid-images', type=int, default=10, help="liczba obrazków cid: w kształcie 'cid'")
+    parser.add_argument('--process-pool', type=int, default=0, help="PROCESS_POOL_SIZE dla process_email i pełnego przebiegu (0 = bez puli)")
+    parser.add_argument('--compress', action='store_true', help="serwer IMAP oferuje COMPRESS=DEFLATE")
+    args = parser.parse_args()
+
+    imap_server = StandInIMAPServer(latency=args.imap_latency_ms / 1000, compress=args.compress).start()
+    http_server = StandInHTTPServer(latency=args.http_latency_ms / 1000).start()
+    workdir = tempfile.mkdtemp(prefix="mail-opener-bench-data-")
+
+    from _app import import_app
+    app = import_app(
+        IMAP_SERVER="127.0.0.1",
+        IMAP_PORT=imap_server.port,
+        IMAP_SSL=False,
+        LOG_LEVEL="WARNING",
+        IMAGE_CACHE_DIR=os.path.join(workdir, "images"),
+        HEADER_INDEX_PATH=os.path.join(workdir, "headers.sqlite3"),
+        PROCESS_POOL_SIZE=args.process_pool,
+    )
+    partial = not args.full_fetch
+    options = {"attachment_size": args.attachment_kb * 1024, "cid_images": args.cid_images}
+
+    print(f"IMAP 127.0.0.1:{imap_server.port} (opóźnienie {args.imap_latency_ms:g} ms), "
+          f"HTTP {http_server.base_url} (opóźnienie {args.http_latency_ms:g} ms), "
+          f"klikanie {args.click_percentage}%, pobieranie {'częściowe' if partial else 'pełne'}, "
+          f"pula procesów {args.process_pool or 'wyłączona'}, kompresja {'COMPRESS=DEFLATE' if args.compress else 'wyłączona'}")
+    transfers = []
+    stages = [
+        ("decode_content", lambda messages: bench_decode_content(app, messages)),
+        ("process_html_content", lambda messages: bench_process_html_content(app, messages, args.click_percentage)),
+        ("process_email", lambda messages: bench_process_email(app, imap_server, messages, args.click_percentage, partial)),
+        ("open_emails_by_subject", lambda messages: bench_full_run(app, imap_server, messages, args.click_percentage, partial, transfers)),
+    ]
+    for size in args.sizes:
+        sample = generate_mailbox(size, http_server.base_url, args.seed, prefix=f"s{size}-", **options)
+        shapes = Counter(shape for shape, _ in sample)
+        total_bytes = sum(len(raw) for _, raw in sample)
+        print(f"\nSkrzynka: {size} maili ({', '.join(f'{shape} {shapes[shape]}' for shape in DEFAULT_MIX if shapes[shape])}), "
+              f"{total_bytes / 1024 / 1024:.1f} MiB")
+        print(f"  {'etap':<28} {'maili':>6} {'maili/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for index, (label, bench) in enumerate(stages):
+            # Osobna skrzynka dla każdego etapu - zimna pamięć obrazów, te same kształty
+            messages = sample if index == 0 else generate_mailbox(size, http_server.base_url, args.seed, prefix=f"s{size}-{label}-", **options)
+            latencies, elapsed = bench(messages)
+            report(label, latencies, elapsed)
+        # Rozbicie na etapy z pomiarów wbudowanych w aplikację (span)
+        print(f"  {'etapy wewnętrzne (span)':<28} {'liczba':>6} {'MiB':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for stage, entry in app.get_metrics().snapshot().items():
+            print(f"    {stage:<26} {entry['count']:>6} {entry['bytes'] / 1024 / 1024:>9.1f} "
+                  f"{entry['p50'] * 1000:>9.1f} {entry['p95'] * 1000:>9.1f} {entry['max'] * 1000:>9.1f}")
+        app.get_metrics().reset()
+        if transfers[-1]:
+            print(f"  transfer IMAP przebiegu: {app.format_transfer(transfers[-1])}")
+    if args.process_pool:
+        app.get_process_pool().shutdown()
+    print(f"\nKomendy IMAP: {imap_server.mailbox.commands}, żądania HTTP: {http_server.requests}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+"""Funkcje uruchamiane w procesach roboczych puli (PROCESS_POOL_SIZE).
+
+Pod `streamlit run` aplikacja jest modułem __main__, więc jej funkcji nie da
+się przekazać do ProcessPoolExecutor - procesy robocze nie znalazłyby ich po
+imporcie. Ten moduł jest importowalny z każdego procesu, a streamlit_app
+importuje dopiero w samym wywołaniu (raz na proces roboczy).
+"""
+
+
+def analyze_email(email_body):
+    """Surowe bajty maila -> temat, wybrany HTML, obrazy i linki (analyze_email_bytes)"""
+    import streamlit_app
+    return streamlit_app.analyze_email_bytes(email_body)
+
+
+def rewrite_html(html_content, image_map, link_map):
+    """Podmiana adresów obrazów i klikniętego linku (rewrite_html_references)"""
+    import streamlit_app
+    return streamlit_app.rewrite_html_references(html_content, image_map, link_map)
@@ -0,0 +1,43 @@
+"""Zasoby współdzielone między przebiegami skryptu Streamlit i wątkami tła.
+
+Streamlit przy każdej interakcji wykonuje streamlit_app.py od nowa, więc
+zwykłe zmienne modułu nie przetrwają. st.cache_resource przechowuje obiekty
+między przebiegami, ale odczyt działa tylko w wątku skryptu - w wątkach tła
+(pobieranie obrazów, zadania w tle) i poza `streamlit run` każde wywołanie
+tworzyłoby nowy obiekt. Ten moduł nie jest wykonywany ponownie, więc
+trzymamy tu po jednej instancji każdego zasobu na proces.
+"""
+import functools
+import threading
+
+_lock = threading.RLock()
+_resources = {}
+
+def shared_resource(func):
+    """Dekorator: funkcja bez argumentów tworząca zasób jest wywoływana raz na proces"""
+    key = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper():
+        try:
+            return _resources[key]
+        except KeyError:
+            pass
+        with _lock:
+            if key not in _resources:
+                _resources[key] = func()
+            return _resources[key]
+
+    def clear(expected=None):
+        """Usuwa zasób (następne wywołanie tworzy nowy) i zwraca go albo None.
+
+        Z expected zasób jest usuwany tylko, jeśli to wciąż ten obiekt - inny
+        wątek mógł go już wymienić.
+        """
+        with _lock:
+            if expected is not None and _resources.get(key) is not expected:
+                return None
+            return _resources.pop(key, None)
+
+    wrapper.clear = clear
+    return wrapper
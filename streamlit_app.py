@@ -1,145 +1,1362 @@
 import streamlit as st
 import imaplib
 import email
-from email.header import decode_header
+from email.header import decode_header, make_header
 import base64
+import binascii
+import codecs
+import quopri
 import logging
-from io import StringIO
 import chardet
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from bs4 import BeautifulSoup, SoupStrainer
+from urllib.parse import urljoin, unquote, urlsplit, urlunsplit, urlencode, parse_qsl
 import time
 import random
+import re
+import threading
+import queue
+from contextlib import contextmanager, closing
+from collections import namedtuple, OrderedDict, Counter, deque
+import itertools
+from functools import lru_cache
+import html
+import os
+import tempfile
+import shutil
+import hashlib
+import zlib
+import socket
+import atexit
+import sqlite3
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from requests.adapters import HTTPAdapter
+from shared_resources import shared_resource
+from email.utils import parseaddr
+
+class RingBufferLogHandler(logging.Handler):
+    """Handler logów o stałej pojemności - osobny bufor cykliczny dla każdego poziomu.
+
+    Przechowuje same rekordy, a tekst komunikatu jest formatowany dopiero przy
+    wyświetlaniu, więc długie przebiegi nie zwiększają zużycia pamięci, a
+    zalew komunikatów DEBUG nie wypycha ostrzeżeń i błędów.
+    """
+
+    def __init__(self, capacity_per_level):
+        super().__init__()
+        self._levels = sorted(capacity_per_level)
+        self._buffers = {level: deque(maxlen=capacity) for level, capacity in capacity_per_level.items()}
+        self._sequence = itertools.count()
+
+    def _bucket(self, levelno):
+        bucket = self._levels[0]
+        for level in self._levels:
+            if levelno >= level:
+                bucket = level
+        return bucket
+
+    def emit(self, record):
+        if record.exc_info:
+            # Traceback trzymałby przy życiu całe ramki stosu - zachowujemy tylko tekst
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.acquire()
+        try:
+            self._buffers[self._bucket(record.levelno)].append((next(self._sequence), record))
+        finally:
+            self.release()
+
+    def records(self, min_level=logging.NOTSET, text=None):
+        """Rekordy (najnowsze pierwsze) od poziomu min_level, opcjonalnie zawierające text"""
+        self.acquire()
+        try:
+            entries = [entry for level, buffer in self._buffers.items() for entry in buffer]
+        finally:
+            self.release()
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        records = [record for _, record in entries if record.levelno >= min_level]
+        if text:
+            needle = text.lower()
+            records = [record for record in records if needle in record.getMessage().lower()]
+        return records
+
+    def clear(self):
+        self.acquire()
+        try:
+            for buffer in self._buffers.values():
+                buffer.clear()
+        finally:
+            self.release()
 
 # Konfiguracja logowania
-logging.basicConfig(level=logging.DEBUG)
+LOG_LEVEL = str(st.secrets.get("LOG_LEVEL", "DEBUG")).upper()
+LOG_RETENTION = {
+    logging.DEBUG: int(st.secrets.get("LOG_RETENTION_DEBUG", 2000)),
+    logging.INFO: int(st.secrets.get("LOG_RETENTION_INFO", 1000)),
+    logging.WARNING: int(st.secrets.get("LOG_RETENTION_WARNING", 500)),
+}
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger(__name__)
+logger.setLevel(LOG_LEVEL)
+
+@shared_resource
+def get_log_handler():
+    """Bufor logów dla panelu "Logi debugowania", wspólny dla wszystkich przebiegów"""
+    handler = RingBufferLogHandler(LOG_RETENTION)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    return handler
+
+# Streamlit wykonuje skrypt przy każdej interakcji - handler dodajemy tylko raz
+log_handler = get_log_handler()
+if log_handler not in logger.handlers:
+    logger.addHandler(log_handler)
+
+class StageMetrics:
+    """Zbiorcze czasy i bajty etapów przetwarzania (p50/p95/max), wspólne dla wątków.
+
+    Dla percentyli trzymanych jest najwyżej samples ostatnich pomiarów na
+    etap; liczniki, suma czasu, maksimum i bajty obejmują wszystkie pomiary.
+    """
+
+    def __init__(self, samples=10000):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._stages = OrderedDict()
+        self.started_at = time.time()
+
+    def record(self, stage, seconds, transferred=0):
+        with self._lock:
+            entry = self._stages.get(stage)
+            if entry is None:
+                entry = self._stages[stage] = {
+                    'count': 0, 'sum': 0.0, 'max': 0.0, 'bytes': 0, 'durations': deque(maxlen=self.samples)
+                }
+            entry['count'] += 1
+            entry['sum'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['bytes'] += transferred
+            entry['durations'].append(seconds)
+
+    def snapshot(self):
+        """{etap: {count, sum, max, p50, p95, bytes}} w kolejności pierwszego wystąpienia"""
+        with self._lock:
+            stages = [(stage, dict(entry, durations=sorted(entry['durations']))) for stage, entry in self._stages.items()]
+        result = OrderedDict()
+        for stage, entry in stages:
+            durations = entry.pop('durations')
+            entry['p50'] = _percentile(durations, 0.5)
+            entry['p95'] = _percentile(durations, 0.95)
+            result[stage] = entry
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self.started_at = time.time()
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+class Span:
+    """Pomiar jednego etapu: with span("imap_fetch") as timer: ...; timer.bytes += n"""
+
+    __slots__ = ('stage', 'bytes', 'metrics', '_started')
+
+    def __init__(self, stage, metrics):
+        self.stage = stage
+        self.metrics = metrics
+        self.bytes = 0
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.stage, time.perf_counter() - self._started, self.bytes)
+        return False
 
-# Bufor dla logów
-log_buffer = StringIO()
-stream_handler = logging.StreamHandler(log_buffer)
-stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logger.addHandler(stream_handler)
+@shared_resource
+def get_metrics():
+    return StageMetrics(int(st.secrets.get("METRICS_SAMPLES", 10000)))
+
+def span(stage):
+    return Span(stage, get_metrics())
+
+METRICS_PREFIX = "mail_opener"
+
+def metrics_to_json(snapshot):
+    return json.dumps({
+        'generated_at': time.time(),
+        'stages': snapshot,
+    }, indent=2)
+
+def metrics_to_prometheus(snapshot):
+    """Format tekstowy Prometheusa (summary z kwantylami + maksimum i bajty)"""
+    lines = [
+        f"# HELP {METRICS_PREFIX}_stage_seconds Duration of processing stages.",
+        f"# TYPE {METRICS_PREFIX}_stage_seconds summary",
+    ]
+    for stage, entry in snapshot.items():
+        label = f'stage="{stage}"'
+        lines.append(f'{METRICS_PREFIX}_stage_seconds{{{label},quantile="0.5"}} {entry["p50"]:.6f}')
+        lines.append(f'{METRICS_PREFIX}_stage_seconds{{{label},quantile="0.95"}} {entry["p95"]:.6f}')
+        lines.append(f'{METRICS_PREFIX}_stage_seconds_sum{{{label}}} {entry["sum"]:.6f}')
+        lines.append(f'{METRICS_PREFIX}_stage_seconds_count{{{label}}} {entry["count"]}')
+    lines += [
+        f"# HELP {METRICS_PREFIX}_stage_max_seconds Longest observed duration of a stage.",
+        f"# TYPE {METRICS_PREFIX}_stage_max_seconds gauge",
+    ]
+    for stage, entry in snapshot.items():
+        lines.append(f'{METRICS_PREFIX}_stage_max_seconds{{stage="{stage}"}} {entry["max"]:.6f}')
+    lines += [
+        f"# HELP {METRICS_PREFIX}_stage_bytes_total Bytes transferred by a stage.",
+        f"# TYPE {METRICS_PREFIX}_stage_bytes_total counter",
+    ]
+    for stage, entry in snapshot.items():
+        lines.append(f'{METRICS_PREFIX}_stage_bytes_total{{stage="{stage}"}} {entry["bytes"]}')
+    return "\n".join(lines) + "\n"
+
+def export_metrics(directory=None):
+    """Zapisuje metrics.json i metrics.prom (atomowo - podmiana gotowego pliku)"""
+    directory = directory or METRICS_EXPORT_DIR
+    os.makedirs(directory, exist_ok=True)
+    snapshot = get_metrics().snapshot()
+    for filename, content in (("metrics.json", metrics_to_json(snapshot)), ("metrics.prom", metrics_to_prometheus(snapshot))):
+        path = os.path.join(directory, filename)
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, encoding='utf-8') as f:
+            f.write(content)
+        os.replace(f.name, path)
+    logger.debug("Exported metrics of %s stages to %s", len(snapshot), directory)
+    return directory
+
+# Katalog eksportu metryk (np. dla node_exportera z textfile collectorem)
+METRICS_EXPORT_DIR = st.secrets.get("METRICS_EXPORT_DIR", os.path.join(tempfile.gettempdir(), "mail-opener-metrics"))
+
+def _setting_flag(value):
+    """Wartość logiczna z sekretów - TOML true/false albo napis "1"/"true"/"yes"/"on" (inny = wyłączone)"""
+    if isinstance(value, str):
+        return value.strip().lower() in {"1", "true", "yes", "on"}
+    return bool(value)
 
 # Pobieranie danych logowania z sekretów Streamlit Cloud
 EMAIL_ACCOUNT = st.secrets["EMAIL_USERNAME"]
 EMAIL_PASSWORD = st.secrets["EMAIL_PASSWORD"]
 IMAP_SERVER = st.secrets["IMAP_SERVER"]
 IMAP_PORT = int(st.secrets["IMAP_PORT"])
+# Połączenie bez TLS tylko dla lokalnych serwerów testowych (benchmarki)
+IMAP_SSL = _setting_flag(st.secrets.get("IMAP_SSL", True))
+# Kompresja transmisji (RFC 4978) - włączana, gdy serwer ogłasza COMPRESS=DEFLATE
+IMAP_COMPRESS = _setting_flag(st.secrets.get("IMAP_COMPRESS", True))
 
-def decode_content(part):
-    content = part.get_payload(decode=True)
-    charset = part.get_content_charset()
-    if charset is None:
-        detected = chardet.detect(content)
-        charset = detected['encoding']
-    if charset:
+# Ustawienia puli połączeń IMAP (opcjonalne, z wartościami domyślnymi)
+IMAP_POOL_SIZE = int(st.secrets.get("IMAP_POOL_SIZE", 3))
+IMAP_POOL_IDLE_TIMEOUT = int(st.secrets.get("IMAP_POOL_IDLE_TIMEOUT", 300))
+IMAP_POOL_HEALTH_CHECK_INTERVAL = int(st.secrets.get("IMAP_POOL_HEALTH_CHECK_INTERVAL", 10))
+
+# Domyślny rozmiar paczki dla UID FETCH w trybie UID
+UID_FETCH_BATCH_SIZE = int(st.secrets.get("UID_FETCH_BATCH_SIZE", 50))
+
+# Lokalny indeks nagłówków (SQLite) do wyszukiwania tematów bez SEARCH na serwerze
+USE_HEADER_INDEX = _setting_flag(st.secrets.get("USE_HEADER_INDEX", True))
+HEADER_INDEX_PATH = st.secrets.get("HEADER_INDEX_PATH", os.path.join(tempfile.gettempdir(), "mail-opener-header-index.sqlite3"))
+HEADER_INDEX_FETCH_CHUNK = int(st.secrets.get("HEADER_INDEX_FETCH_CHUNK", 1000))
+
+# Potok przebiegu w trybie UID: ile maili pobierać z wyprzedzeniem (0 = szeregowo)
+PIPELINE_PREFETCH = int(st.secrets.get("PIPELINE_PREFETCH", 8))
+
+# Pula procesów dla pracy CPU (parsowanie MIME, dekodowanie, przepisywanie HTML); 0 = wyłączona
+PROCESS_POOL_SIZE = int(st.secrets.get("PROCESS_POOL_SIZE", 0))
+
+# Widok wyników: ile podglądów HTML trzymać w pamięci w trakcie przebiegu i ile renderować
+# naraz (po zakończeniu zadania w pamięci zostaje tylko tyle, ile renderowanych naraz)
+RESULTS_PREVIEW_KEEP = int(st.secrets.get("RESULTS_PREVIEW_KEEP", 200))
+RESULTS_LIVE_PREVIEWS = int(st.secrets.get("RESULTS_LIVE_PREVIEWS", 5))
+# Katalog, do którego trafiają podglądy wszystkich maili przebiegu ("" = tylko ostatnie w pamięci)
+RESULTS_SPILL_DIR = st.secrets.get("RESULTS_SPILL_DIR", "")
+
+# Zadania w tle: ile przebiegów naraz (dla wszystkich sesji), ile zakończonych pamiętać
+# i co ile sekund UI odpytuje o postęp
+JOB_CONCURRENCY = int(st.secrets.get("JOB_CONCURRENCY", 2))
+JOB_HISTORY = int(st.secrets.get("JOB_HISTORY", 20))
+JOB_POLL_INTERVAL = float(st.secrets.get("JOB_POLL_INTERVAL", 1.0))
+
+# Obserwacja skrzynki (IMAP IDLE): co ile sekund odnawiać IDLE, po ilu sekundach bez
+# odczytu kończyć obserwację, odstęp NOOP bez IDLE i przerwa przed ponownym połączeniem
+IMAP_IDLE_RENEW = int(st.secrets.get("IMAP_IDLE_RENEW", 600))
+WATCH_TTL = int(st.secrets.get("WATCH_TTL", 60))
+WATCH_NOOP_INTERVAL = int(st.secrets.get("WATCH_NOOP_INTERVAL", 15))
+WATCH_RETRY_DELAY = int(st.secrets.get("WATCH_RETRY_DELAY", 5))
+# Limit czasu odpowiedzi serwera na połączeniu obserwacji (po nim połączenie jest otwierane od nowa)
+# i co ile sekund wątek w IDLE sprawdza, czy ma zakończyć albo odnowić IDLE
+WATCH_READ_TIMEOUT = int(st.secrets.get("WATCH_READ_TIMEOUT", 30))
+WATCH_POLL_INTERVAL = float(st.secrets.get("WATCH_POLL_INTERVAL", 1.0))
+
+# Jak długo wynik sprawdzenia połączenia IMAP jest uznawany za aktualny (sekundy)
+IMAP_HEALTH_TTL = int(st.secrets.get("IMAP_HEALTH_TTL", 60))
+
+# Pobieranie tylko renderowanych części maila (BODYSTRUCTURE + BODY.PEEK[sekcja])
+PARTIAL_FETCH = _setting_flag(st.secrets.get("PARTIAL_FETCH", True))
+
+class IMAPConnectionPool:
+    """Pula zalogowanych sesji IMAP współdzielona między przebiegami skryptu.
+
+    Połączenie pożyczone z puli jest sprawdzane komendą NOOP (jeśli leżało
+    dłużej niż health_check_interval), a sesje bezczynne dłużej niż
+    idle_timeout są zamykane zamiast ponownie używane.
+    """
+
+    def __init__(self, factory, max_size=3, idle_timeout=300, health_check_interval=10, acquire_timeout=60):
+        self._factory = factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self._idle = []  # lista par (połączenie, czas ostatniego użycia)
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    def _is_alive(self, mail):
+        try:
+            status, _ = mail.noop()
+            return status == 'OK'
+        except (imaplib.IMAP4.error, OSError) as e:
+            logger.debug("IMAP health check failed: %s", e)
+            return False
+
+    def _discard(self, mail):
         try:
-            return content.decode(charset)
-        except UnicodeDecodeError:
-            return content.decode(charset, errors='replace')
-    return content.decode('utf-8', errors='replace')
+            mail.logout()
+        except Exception:
+            pass
+
+    def _expire_idle(self):
+        """Usuwa z puli sesje bezczynne dłużej niż idle_timeout (wywoływać pod blokadą)"""
+        now = time.monotonic()
+        expired = [mail for mail, last_used in self._idle if now - last_used > self.idle_timeout]
+        self._idle = [(mail, last_used) for mail, last_used in self._idle if now - last_used <= self.idle_timeout]
+        return expired
+
+    def acquire(self):
+        """Pożycza zalogowane połączenie; otwiera nowe, jeśli pula nie jest pełna"""
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            expired = self._expire_idle()
+            while True:
+                if self._idle:
+                    mail, last_used = self._idle.pop()
+                    break
+                if self._in_use < self.max_size:
+                    mail, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No free IMAP connection after {self.acquire_timeout}s (pool size {self.max_size})")
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        for stale in expired:
+            logger.debug("Closing idle IMAP connection")
+            self._discard(stale)
+
+        try:
+            if mail is not None and time.monotonic() - last_used > self.health_check_interval:
+                if not self._is_alive(mail):
+                    logger.debug("Pooled IMAP connection is dead, reconnecting")
+                    self._discard(mail)
+                    mail = None
+            if mail is None:
+                mail = self._factory()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return mail
+
+    def release(self, mail, broken=False):
+        """Zwraca połączenie do puli (albo je zamyka, jeśli jest zepsute)"""
+        if broken or mail.state == 'LOGOUT':
+            self._discard(mail)
+            mail = None
+        with self._cond:
+            self._in_use -= 1
+            if mail is not None:
+                self._idle.append((mail, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Pożycza połączenie na czas bloku with; zerwane połączenia nie wracają do puli"""
+        mail = self.acquire()
+        broken = False
+        try:
+            yield mail
+        except (imaplib.IMAP4.abort, OSError):
+            broken = True
+            raise
+        finally:
+            self.release(mail, broken)
+
+    def run(self, func, retries=1):
+        """Wykonuje func(mail) na pożyczonym połączeniu, ponawiając po zerwaniu sesji"""
+        for attempt in range(retries + 1):
+            try:
+                with self.connection() as mail:
+                    return func(mail)
+            except imaplib.IMAP4.abort as e:
+                if attempt >= retries:
+                    raise
+                logger.warning("IMAP connection aborted (%s), reconnecting", e)
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for mail, _ in idle:
+            self._discard(mail)
+
+def refresh_capabilities(mail):
+    """Po zalogowaniu serwer zwykle ogłasza więcej rozszerzeń (ESEARCH, UIDPLUS...) niż przed"""
+    status, data = mail.capability()
+    if status == 'OK' and data and data[-1]:
+        mail.capabilities = tuple(data[-1].decode('ascii', errors='replace').upper().split())
+    return mail.capabilities
+
+# imaplib nie zna komendy COMPRESS - dozwolona po zalogowaniu
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+
+class SocketReader:
+    """Odczyt odpowiedzi IMAP prosto z gniazda (recv) zamiast mail.file.
+
+    Plik z socket.makefile() po przekroczeniu limitu czasu nie nadaje się
+    do dalszego odczytu; tu timeout przerywa tylko bieżące readline(), a
+    odebrany fragment linii zostaje w buforze.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+        self._buffer += data
+        return True
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, limit=-1):
+        while b'\n' not in self._buffer and (limit < 0 or len(self._buffer) < limit):
+            if not self._fill():
+                break
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        return self._take(min(end, limit) if limit >= 0 else end)
+
+    def read(self, size):
+        while len(self._buffer) < size and self._fill():
+            pass
+        return self._take(size)
+
+    def close(self):
+        pass
+
+def use_socket_reader(mail):
+    """Podmienia mail.file na SocketReader (między komendami - bufor pliku jest wtedy pusty)"""
+    if not isinstance(mail.file, SocketReader):
+        mail.file.close()
+        mail.file = SocketReader(mail.sock)
+
+class DeflateStream(SocketReader):
+    """Warstwa COMPRESS=DEFLATE (RFC 4978) między imaplib a gniazdem.
+
+    Zastępuje mail.file (odczyt) i mail.send (zapis). Surowy deflate w obu
+    kierunkach, każda wysyłana komenda kończy się Z_SYNC_FLUSH. Liczy bajty
+    przed kompresją i w sieci.
+    """
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.plain_received = 0
+        self.wire_received = 0
+        self.plain_sent = 0
+        self.wire_sent = 0
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            return False
+        self.wire_received += len(data)
+        plain = self._decompressor.decompress(data)
+        self.plain_received += len(plain)
+        self._buffer += plain
+        return True
+
+    def send(self, data):
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.plain_sent += len(data)
+        self.wire_sent += len(compressed)
+        self.sock.sendall(compressed)
+
+def enable_compression(mail):
+    """COMPRESS DEFLATE na zalogowanym połączeniu; True, jeśli kompresja działa"""
+    status, data = mail._simple_command('COMPRESS', 'DEFLATE')
+    if status != 'OK':
+        logger.warning("Server rejected COMPRESS DEFLATE: %s", data)
+        return False
+    stream = DeflateStream(mail.sock)
+    mail.file.close()
+    mail.file = stream
+    mail.send = stream.send
+    mail.compression = stream
+    return True
+
+def imap_transfer_stats(mail):
+    """(bajty po dekompresji, bajty w sieci) od otwarcia połączenia; None bez kompresji"""
+    stream = getattr(mail, 'compression', None)
+    if stream is None:
+        return None
+    return stream.plain_received + stream.plain_sent, stream.wire_received + stream.wire_sent
+
+def format_transfer(transfer):
+    plain, wire = transfer
+    saved = plain - wire
+    return f"{wire / 1024 / 1024:.1f} MB w sieci z {plain / 1024 / 1024:.1f} MB (oszczędność {saved / 1024 / 1024:.1f} MB, {100 * saved / plain if plain else 0:.0f}%)"
+
+def _connect_imap():
+    if IMAP_SSL:
+        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
+    else:
+        mail = imaplib.IMAP4(IMAP_SERVER, IMAP_PORT)
+    mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
+    refresh_capabilities(mail)
+    if IMAP_COMPRESS and 'COMPRESS=DEFLATE' in mail.capabilities:
+        enable_compression(mail)
+    logger.debug("Opened new IMAP connection to %s:%s (compression: %s)", IMAP_SERVER, IMAP_PORT, hasattr(mail, 'compression'))
+    return mail
+
+@shared_resource
+def get_imap_pool():
+    """Pula połączeń przechowywana między przebiegami skryptu Streamlit"""
+    return IMAPConnectionPool(
+        _connect_imap,
+        max_size=IMAP_POOL_SIZE,
+        idle_timeout=IMAP_POOL_IDLE_TIMEOUT,
+        health_check_interval=IMAP_POOL_HEALTH_CHECK_INTERVAL
+    )
+
+def close_imap_pool():
+    """Wylogowuje bezczynne sesje puli i usuwa ją - następne get_imap_pool() tworzy nową"""
+    pool = get_imap_pool.clear()
+    if pool is not None:
+        pool.close_all()
+
+atexit.register(close_imap_pool)
+
+# Wykrywanie kodowania: ile bajtów trafia do chardet i ilu nadawców pamiętamy
+CHARSET_SAMPLE_SIZE = int(st.secrets.get("CHARSET_SAMPLE_SIZE", 32 * 1024))
+CHARSET_CACHE_SIZE = int(st.secrets.get("CHARSET_CACHE_SIZE", 512))
+
+class CharsetCache:
+    """Pamięć LRU ostatnio wykrytego kodowania dla nadawcy / listy mailingowej.
+
+    Liczy też trafienia poszczególnych etapów dekodowania w stats
+    (declared, utf8, sender_cache, sample_detect, fallback).
+    """
+
+    def __init__(self, max_size=512):
+        self.max_size = max_size
+        self.stats = Counter()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            charset = self._entries.get(key)
+            if charset is not None:
+                self._entries.move_to_end(key)
+            return charset
+
+    def put(self, key, charset):
+        with self._lock:
+            self._entries[key] = charset
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def count_tier(self, tier):
+        with self._lock:
+            self.stats[tier] += 1
+
+@shared_resource
+def get_charset_cache():
+    """Pamięć kodowań przechowywana między przebiegami skryptu Streamlit"""
+    return CharsetCache(CHARSET_CACHE_SIZE)
+
+def get_sender_key(email_message):
+    """Klucz nadawcy do pamięci kodowań - List-Id, a gdy go brak, adres From"""
+    list_id = email_message.get('List-Id')
+    if list_id:
+        return list_id.strip().lower()
+    address = parseaddr(email_message.get('From', ''))[1]
+    return address.lower() or None
+
+_NON_ASCII_BYTE = re.compile(rb'[\x80-\xff]')
+
+def detect_charset(content, sender_key=None):
+    """Wykrywa kodowanie części bez zadeklarowanego charsetu (patrz detect_and_decode)"""
+    return detect_and_decode(content, sender_key)[0]
+
+def detect_and_decode(content, sender_key=None):
+    """Wykrywa kodowanie części bez zadeklarowanego charsetu; zwraca (kodowanie, tekst).
+
+    Kolejno: szybka, ścisła próba UTF-8, kodowanie zapamiętane dla nadawcy,
+    a dopiero na końcu chardet na ograniczonej próbce treści (gdy próbka
+    jest czystym ASCII - na próbce od pierwszego bajtu spoza ASCII). Tekst
+    z udanej próby dekodowania jest zwracany, żeby nie dekodować drugi raz;
+    po chardet tekst to None.
+    """
+    charset_cache = get_charset_cache()
+    try:
+        text = content.decode('utf-8')
+        charset_cache.count_tier('utf8')
+        return 'utf-8', text
+    except UnicodeDecodeError:
+        pass
+    
+    if sender_key:
+        cached = charset_cache.get(sender_key)
+        if cached:
+            try:
+                text = content.decode(cached)
+                charset_cache.count_tier('sender_cache')
+                return cached, text
+            except (UnicodeDecodeError, LookupError):
+                pass
+    
+    charset = chardet.detect(content[:CHARSET_SAMPLE_SIZE])['encoding']
+    if len(content) > CHARSET_SAMPLE_SIZE and charset in (None, 'ascii'):
+        # Próbka z samego ASCII (długi <head>, style CSS) nic nie mówi o kodowaniu -
+        # druga próbka od pierwszego bajtu spoza ASCII, a w ostateczności cała treść
+        first_non_ascii = _NON_ASCII_BYTE.search(content)
+        if first_non_ascii:
+            start = first_non_ascii.start()
+            charset = chardet.detect(content[start:start + CHARSET_SAMPLE_SIZE])['encoding']
+        if charset in (None, 'ascii'):
+            charset = chardet.detect(content)['encoding']
+    if charset:
+        charset_cache.count_tier('sample_detect')
+        # 'ascii' dla treści spoza UTF-8 byłoby błędne dla kolejnych maili nadawcy
+        if sender_key and charset.lower() != 'ascii':
+            charset_cache.put(sender_key, charset)
+    else:
+        charset_cache.count_tier('fallback')
+    return charset, None
+
+def decode_content(part, sender_key=None):
+    with span("decode_content") as timer:
+        content = part.get_payload(decode=True)
+        timer.bytes = len(content or b'')
+        charset = part.get_content_charset()
+        if charset is None:
+            charset, text = detect_and_decode(content, sender_key)
+            if text is not None:
+                return text
+        else:
+            get_charset_cache().count_tier('declared')
+        if charset:
+            try:
+                return content.decode(charset)
+            except UnicodeDecodeError:
+                return content.decode(charset, errors='replace')
+        return content.decode('utf-8', errors='replace')
+
+def _setting_list(value):
+    """Lista z sekretów - jako lista TOML albo napis z elementami po przecinku"""
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() for item in value if item and item.strip()]
+
+# Domeny linków śledzących - części HTML z nimi są preferowane przy otwieraniu
+TRACKING_DOMAINS = _setting_list(st.secrets.get("TRACKING_DOMAINS", "leadingmail.pl"))
+
+LinkMatch = namedtuple('LinkMatch', ['start', 'end', 'domain', 'url'])
+
+class TrackingLinkExtractor:
+    """Wyszukiwanie linków do wielu domen w jednym przejściu po tekście.
+
+    Wszystkie domeny są w jednym skompilowanym wzorcu (bez rozróżniania
+    wielkości liter, bez kopii tekstu w lower()). Dla każdego trafienia
+    zwracany jest cały otaczający adres (start, koniec, domena, URL z
+    odkodowanymi encjami HTML); kilka trafień w jednym adresie liczy się raz.
+    """
+
+    MAX_URL_LENGTH = 2048
+    URL_DELIMITERS = ' \t\r\n"\'<>()'
+
+    def __init__(self, domains):
+        self.domains = sorted({domain.lower() for domain in domains}, key=len, reverse=True)
+        self._pattern = re.compile('|'.join(re.escape(domain) for domain in self.domains), re.IGNORECASE) if self.domains else None
+        self._url_rest = re.compile(r'[^\s"\'<>()]*')
+
+    def scan(self, text):
+        """Lista LinkMatch dla wszystkich adresów z domenami w tekście"""
+        matches = []
+        if self._pattern is None:
+            return matches
+        url_end = 0
+        for found in self._pattern.finditer(text):
+            if found.start() < url_end:
+                continue
+            window_start = max(url_end, found.start() - self.MAX_URL_LENGTH)
+            start = max(text.rfind(char, window_start, found.start()) for char in self.URL_DELIMITERS) + 1
+            start = max(start, window_start)
+            url_end = self._url_rest.match(text, found.end()).end()
+            matches.append(LinkMatch(start, url_end, found.group(0).lower(), html.unescape(text[start:url_end])))
+        return matches
+
+    def scanner(self):
+        return LinkScanner(self)
+
+class LinkScanner:
+    """Przyrostowe scan() dla treści podawanej fragmentami (pozycje liczone od początku treści).
+
+    Adres przecięty granicą fragmentu czeka na następny fragment; w pamięci
+    zostaje tylko końcówka poprzedniego fragmentu.
+    """
+
+    def __init__(self, extractor):
+        self.extractor = extractor
+        self._tail = ''
+        self._base = 0
+        self._done = 0
+
+    def feed(self, text, final=False):
+        text = self._tail + text
+        found = []
+        cut = None
+        for match in self.extractor.scan(text):
+            if self._base + match.start < self._done:
+                continue
+            if not final and match.end >= len(text) and len(text) - match.start < 2 * self.extractor.MAX_URL_LENGTH:
+                cut = match.start
+                break
+            found.append(match._replace(start=self._base + match.start, end=self._base + match.end))
+            self._done = self._base + match.end
+        keep_from = cut if cut is not None else max(0, len(text) - self.extractor.MAX_URL_LENGTH)
+        self._tail = text[keep_from:]
+        self._base += keep_from
+        return found
+
+TRACKING_LINKS = TrackingLinkExtractor(TRACKING_DOMAINS)
+
+# Inspektor maili (debugowanie) - treść części jest pobierana fragmentami dopiero po rozwinięciu
+INSPECTOR_PREVIEW_BYTES = int(st.secrets.get("INSPECTOR_PREVIEW_BYTES", 16 * 1024))
+INSPECTOR_SEARCH_CHUNK = int(st.secrets.get("INSPECTOR_SEARCH_CHUNK", 256 * 1024))
+INSPECTOR_MAX_MATCHES = int(st.secrets.get("INSPECTOR_MAX_MATCHES", 20))
+
+class TransferDecoder:
+    """Przyrostowe dekodowanie Content-Transfer-Encoding kolejnych fragmentów części.
+
+    Niepełna grupa base64 albo niedokończona linia quoted-printable czeka
+    na następny fragment, więc granice fragmentów nie psują treści.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or '7bit').lower()
+        self._pending = b''
+
+    def feed(self, data, final=False):
+        data = self._pending + data
+        self._pending = b''
+        if self.encoding == 'base64':
+            data = re.sub(rb'[^A-Za-z0-9+/=]', b'', data)
+            usable = len(data) if final else len(data) - len(data) % 4
+            data, self._pending = data[:usable], data[usable:]
+            try:
+                return base64.b64decode(data + b'=' * (-len(data) % 4))
+            except (binascii.Error, ValueError):
+                return b''
+        if self.encoding == 'quoted-printable':
+            if not final:
+                cut = data.rfind(b'\n') + 1
+                data, self._pending = data[:cut], data[cut:]
+            return quopri.decodestring(data)
+        return data
+
+def _part_text_decoder(part, sample):
+    charset = part.params.get('charset') or detect_charset(sample) or 'utf-8'
+    try:
+        return codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+def inspect_email(mail, uid):
+    """Nagłówki, rozmiar i drzewo części (BODYSTRUCTURE) maila - bez pobierania treści"""
+    fields = _fetch_items(mail, uid, ['BODY.PEEK[HEADER]', 'BODYSTRUCTURE', 'RFC822.SIZE'], use_uid=True)
+    if not fields:
+        return None
+    headers = email.message_from_bytes(fields.get('BODY[HEADER]') or b'')
+    structure = fields.get('BODYSTRUCTURE')
+    return {
+        'uid': _as_text(uid),
+        'subject': decode_mime_header(headers['Subject']),
+        'headers': [(name, decode_mime_header(value)) for name, value in headers.items()],
+        'size': int(fields.get('RFC822.SIZE') or 0),
+        'parts': parse_bodystructure(structure) if structure else [],
+    }
+
+def fetch_part_range(mail, uid, section, offset, length):
+    """Surowe (zakodowane) bajty sekcji od offset, najwyżej length; None, gdy maila już nie ma"""
+    item = f"BODY[{section}]"
+    fields = _fetch_items(mail, uid, [f"BODY.PEEK[{section}]<{offset}.{length}>"], use_uid=True)
+    if item not in fields:
+        return None
+    return fields[item] or b''
+
+def preview_part(mail, uid, part, offset=0, length=INSPECTOR_PREVIEW_BYTES):
+    """Zdekodowany podgląd fragmentu części: tekst dla części text/*, bajty dla pozostałych"""
+    data = fetch_part_range(mail, uid, part.section, offset, length)
+    if data is None:
+        return None
+    if offset and part.encoding in ('base64', 'quoted-printable'):
+        # Środek zakodowanej treści - zaczynamy od najbliższej pełnej linii
+        data = data[data.find(b'\n') + 1:]
+    decoded = TransferDecoder(part.encoding).feed(data, final=offset + length >= part.size)
+    if not part.content_type.startswith('text/'):
+        return decoded
+    return _part_text_decoder(part, decoded).decode(decoded, True)
+
+def search_part(mail, uid, part, extractor=TRACKING_LINKS, chunk_size=INSPECTOR_SEARCH_CHUNK, max_matches=INSPECTOR_MAX_MATCHES):
+    """Linki do domen extractor w zdekodowanej treści części, pobieranej fragmentami.
+
+    Treść przechodzi przez LinkScanner, więc w pamięci jest tylko bieżący
+    fragment i jego końcówka. Zwraca (liczba linków na domenę, pierwsze
+    max_matches LinkMatch, przeszukane bajty).
+    """
+    transfer = TransferDecoder(part.encoding)
+    text_decoder = None
+    scanner = extractor.scanner()
+    counts = Counter()
+    matches = []
+    offset = 0
+    final = False
+    while not final:
+        chunk = fetch_part_range(mail, uid, part.section, offset, chunk_size)
+        if not chunk:
+            break
+        offset += len(chunk)
+        final = len(chunk) < chunk_size or bool(part.size and offset >= part.size)
+        decoded = transfer.feed(chunk, final)
+        if text_decoder is None:
+            text_decoder = _part_text_decoder(part, decoded)
+        found = scanner.feed(text_decoder.decode(decoded, final), final)
+        counts.update(match.domain for match in found)
+        matches.extend(found[:max_matches - len(matches)])
+    if not final:
+        found = scanner.feed('', True)
+        counts.update(match.domain for match in found)
+        matches.extend(found[:max_matches - len(matches)])
+    return counts, matches, offset
 
 def debug_email_structure(email_id, mail):
-    """Funkcja debugowania - pokazuje surową strukturę maila"""
+    """Funkcja debugowania - zapamiętuje w sesji strukturę maila (UID) dla inspektora"""
     try:
-        _, msg_data = mail.fetch(email_id, '(RFC822)')
-        email_body = msg_data[0][1]
-        email_message = email.message_from_bytes(email_body)
-        
-        subject = decode_header(email_message["Subject"])[0][0]
-        if isinstance(subject, bytes):
-            subject = subject.decode('utf-8', errors='replace')
-        
-        debug_info = {
-            'subject': subject,
-            'raw_size': len(email_body),
-            'headers': dict(email_message.items()),
-            'parts': []
-        }
-        
-        st.subheader(f"Debugowanie maila: {subject}")
-        
-        # Pokaż główne nagłówki
-        st.write("**Główne nagłówki:**")
-        for header, value in email_message.items():
-            st.text(f"{header}: {value}")
-        
-        # Pokaż surową treść (pierwsze 2000 znaków)
-        st.write("**Surowa treść maila (pierwsze 2000 znaków):**")
-        raw_text = email_body.decode('utf-8', errors='replace')
-        st.code(raw_text[:2000], language='text')
-        
-        if len(raw_text) > 2000:
-            st.write(f"... (ukryto {len(raw_text) - 2000} znaków)")
-        
-        # Analizuj wszystkie części
-        st.write("**Analiza części multipart:**")
-        part_num = 0
-        
-        for part in email_message.walk():
-            part_num += 1
-            content_type = part.get_content_type()
-            content_disposition = part.get('Content-Disposition')
-            
-            st.write(f"**Część {part_num}:**")
-            st.write(f"- Content-Type: `{content_type}`")
-            st.write(f"- Content-Disposition: `{content_disposition}`")
-            st.write(f"- Charset: `{part.get_content_charset()}`")
-            
-            # Pokaż nagłówki tej części
-            part_headers = dict(part.items())
-            if part_headers:
-                st.write("- Nagłówki części:")
-                for h_name, h_value in part_headers.items():
-                    st.text(f"  {h_name}: {h_value}")
-            
-            # Spróbuj zdekodować treść
-            if content_type in ['text/plain', 'text/html']:
-                try:
-                    decoded_content = decode_content(part)
-                    
-                    # Szukaj linków leadingmail w treści
-                    leadingmail_links = []
-                    for line in decoded_content.split('\n'):
-                        if 'leadingmail.pl' in line.lower():
-                            leadingmail_links.append(line.strip())
-                    
-                    st.write(f"- Rozmiar treści: {len(decoded_content)} znaków")
-                    
-                    if leadingmail_links:
-                        st.success(f"**ZNALEZIONO {len(leadingmail_links)} linków LeadingMail!**")
-                        for i, link in enumerate(leadingmail_links[:3]):  # Pokaż max 3
-                            st.code(link, language='text')
-                        if len(leadingmail_links) > 3:
-                            st.write(f"... i {len(leadingmail_links) - 3} więcej")
-                    
-                    # Pokaż fragment treści
-                    st.write("- Fragment treści:")
-                    if content_type == 'text/html':
-                        # Pokaż surowy HTML
-                        st.code(decoded_content[:500], language='html')
-                    else:
-                        st.text(decoded_content[:500])
-                    
-                    if len(decoded_content) > 500:
-                        st.write(f"... (ukryto {len(decoded_content) - 500} znaków)")
-                        
-                except Exception as e:
-                    st.error(f"Błąd dekodowania części {part_num}: {e}")
-            
-            st.divider()
-        
-        return debug_info
-        
+        inspection = inspect_email(mail, email_id)
+        if inspection is None:
+            st.warning("Mail nie jest już dostępny na serwerze")
+            return None
+        st.session_state['inspection'] = inspection
+        st.session_state.pop('inspector_previews', None)
+        return inspection
     except Exception as e:
         st.error(f"Błąd podczas debugowania maila: {e}")
-        logger.error(f"Error in debug_email_structure: {e}")
+        logger.error("Error in debug_email_structure: %s", e)
         return None
 
-def load_image(url):
-    """Ładuje obrazy z lepszymi nagłówkami do symulacji prawdziwej przeglądarki"""
+def _format_size(size):
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f} MB"
+    if size >= 1024:
+        return f"{size / 1024:.1f} KB"
+    return f"{size} B"
+
+def render_part_preview(uid, part):
+    """Podgląd jednej części: fragment od wybranego bajtu i wyszukiwanie w całej części"""
+    key = f"inspector_{uid}_{part.section}"
+    offset = 0
+    if part.size > INSPECTOR_PREVIEW_BYTES:
+        offset = int(st.number_input(
+            f"Od bajtu (fragmenty po {_format_size(INSPECTOR_PREVIEW_BYTES)} zakodowanej treści)",
+            min_value=0,
+            max_value=part.size - 1,
+            value=0,
+            step=INSPECTOR_PREVIEW_BYTES,
+            key=f"{key}_offset"
+        ))
+    # Podgląd zostaje w sesji - kolejne przebiegi skryptu (także odświeżanie co sekundę
+    # przy zadaniach w tle) nie pobierają go z IMAP, dopóki nie zmieni się fragment
+    previews = st.session_state.setdefault('inspector_previews', {})
+    preview_key = (uid, part.section, offset)
+    if preview_key not in previews:
+        with get_imap_pool().connection() as mail:
+            mail.select("inbox")
+            preview = preview_part(mail, uid, part, offset)
+        for cached_key in [cached_key for cached_key in previews if cached_key[:2] == preview_key[:2]]:
+            del previews[cached_key]
+        previews[preview_key] = preview
+    preview = previews[preview_key]
+    if preview is None:
+        st.warning("Mail nie jest już dostępny na serwerze")
+        return
+    if isinstance(preview, bytes):
+        st.code(binascii.hexlify(preview[:512], ' ').decode(), language='text')
+    elif part.content_type == 'text/html':
+        st.code(preview, language='html')
+    else:
+        st.text(preview)
+    
+    if not part.content_type.startswith('text/'):
+        return
+    search_col, button_col = st.columns([3, 1])
+    with search_col:
+        domains = _setting_list(st.text_input(
+            "Szukaj linków w całej części (domeny po przecinku)",
+            value=", ".join(TRACKING_DOMAINS),
+            key=f"{key}_domains"
+        ))
+    with button_col:
+        search = st.button("Szukaj", key=f"{key}_search")
+    # Wynik wyszukiwania zostaje w sesji - zmiana podglądu nie skanuje części ponownie
+    searches = st.session_state.setdefault('inspector_searches', {})
+    search_key = (uid, part.section, tuple(sorted(domain.lower() for domain in domains)))
+    if search and domains and search_key not in searches:
+        extractor = TRACKING_LINKS if set(search_key[2]) == set(TRACKING_LINKS.domains) else TrackingLinkExtractor(domains)
+        with st.spinner("Przeszukiwanie części..."):
+            with get_imap_pool().connection() as mail:
+                mail.select("inbox")
+                searches[search_key] = search_part(mail, uid, part, extractor)
+    if search_key in searches:
+        counts, matches, scanned = searches[search_key]
+        total = sum(counts.values())
+        if total:
+            per_domain = ", ".join(f"{domain}: {count}" for domain, count in counts.most_common())
+            st.success(f"**ZNALEZIONO {total} linków** ({per_domain}; przeszukano {_format_size(scanned)})")
+            st.code("\n".join(f"{match.start:>10}  {match.url}" for match in matches), language='text')
+            if total > len(matches):
+                st.write(f"... i {total - len(matches)} więcej")
+        else:
+            st.info(f"Brak linków do {', '.join(domains)} (przeszukano {_format_size(scanned)})")
+
+def render_email_inspector(inspection):
+    """Nagłówki i drzewo części; treść części pobierana dopiero po jej zaznaczeniu"""
+    uid = inspection['uid']
+    st.subheader(f"Debugowanie maila: {inspection['subject']}")
+    st.caption(f"UID {uid}, rozmiar {_format_size(inspection['size'])}, części: {len(inspection['parts'])}")
+    
+    with st.expander("Główne nagłówki", expanded=True):
+        st.text("\n".join(f"{name}: {value}" for name, value in inspection['headers']))
+    
+    if st.checkbox("Pokaż surową treść maila (pierwsze 2000 bajtów)", key=f"inspector_{uid}_raw"):
+        previews = st.session_state.setdefault('inspector_previews', {})
+        if (uid, '', 0) not in previews:
+            with get_imap_pool().connection() as mail:
+                mail.select("inbox")
+                previews[(uid, '', 0)] = fetch_part_range(mail, uid, '', 0, 2000)
+        raw = previews[(uid, '', 0)]
+        if raw is None:
+            st.warning("Mail nie jest już dostępny na serwerze")
+        else:
+            st.code(raw.decode('utf-8', errors='replace'), language='text')
+            if inspection['size'] > len(raw):
+                st.write(f"... (ukryto {inspection['size'] - len(raw)} bajtów)")
+    
+    st.write("**Części wiadomości:**")
+    for part in inspection['parts']:
+        depth = part.section.count('.')
+        details = [part.content_type, _format_size(part.size), part.encoding, part.disposition or 'inline']
+        if part.params.get('charset'):
+            details.append(part.params['charset'])
+        if part.content_id:
+            details.append(f"cid:{part.content_id}")
+        label = "\u2003" * depth + f"[{part.section}] " + ", ".join(details)
+        if st.checkbox(label, key=f"inspector_{uid}_{part.section}"):
+            try:
+                render_part_preview(uid, part)
+            except Exception as e:
+                st.error(f"Błąd dekodowania części {part.section}: {e}")
+                logger.error("Error previewing part %s of %s: %s", part.section, uid, e)
+    
+    st.button("Zamknij podgląd", key=f"inspector_{uid}_close", on_click=close_email_inspector)
+
+def close_email_inspector():
+    st.session_state.pop('inspection', None)
+    st.session_state.pop('inspector_searches', None)
+    st.session_state.pop('inspector_previews', None)
+
+def _detect_html_parser():
+    """Najszybszy dostępny backend BeautifulSoup - lxml, jeśli jest zainstalowany"""
+    try:
+        import lxml  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'html.parser'
+
+# Tryb przetwarzania HTML: "fast" podmienia atrybuty w miejscu, "soup" buduje pełne drzewo BeautifulSoup
+HTML_REWRITE_MODE = st.secrets.get("HTML_REWRITE_MODE", "fast")
+HTML_PARSER = st.secrets.get("HTML_PARSER", "auto")
+if HTML_PARSER == "auto":
+    HTML_PARSER = _detect_html_parser()
+
+_HTML_ATTRIBUTE_PATTERN = re.compile(r'''([^\s"'>/=]+)(?:\s*=\s*(?:"[^"]*"|'[^']*'|[^\s"'>]+))?''')
+
+@lru_cache(maxsize=None)
+def _html_tag_pattern(tag_names):
+    # Komentarze, <script> i <style> są dopasowywane tylko po to, żeby je pominąć
+    names = '|'.join(re.escape(name) for name in tag_names)
+    return re.compile(
+        r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|<(' + names + r''')\b((?:[^>"']|"[^"]*"|'[^']*')*)>''',
+        re.IGNORECASE | re.DOTALL
+    )
+
+class HtmlTag:
+    """Znacznik znaleziony przez OffsetHtmlDocument - interfejs jak bs4.Tag (get, [], []=)"""
+
+    def __init__(self, name, insert_at, attributes):
+        self.name = name
+        self.insert_at = insert_at
+        self.attributes = attributes  # nazwa -> (wartość, początek, koniec atrybutu)
+        self.changes = {}
+
+    def get(self, name, default=None):
+        if name in self.changes:
+            return self.changes[name]
+        if name in self.attributes:
+            return self.attributes[name][0]
+        return default
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        self.changes[name] = value
+
+class OffsetHtmlDocument:
+    """Lekki dokument HTML, który zna tylko wybrane znaczniki.
+
+    Zamiast budować całe drzewo, jedno przejście wyrażeniem regularnym
+    zapisuje pozycje znaczników i ich atrybutów. Zmienione atrybuty są
+    wklejane w oryginalny tekst przy str(), a reszta dokumentu zostaje
+    bajt w bajt taka sama.
+    """
+
+    def __init__(self, html_content, tag_names=('img', 'a', 'body')):
+        self.html = html_content
+        self.tags = []
+        for match in _html_tag_pattern(tuple(tag_names)).finditer(html_content):
+            if not match.group(2):
+                continue
+            attributes = {}
+            offset = match.start(3)
+            for attribute in _HTML_ATTRIBUTE_PATTERN.finditer(match.group(3)):
+                name = attribute.group(1).lower()
+                if name in attributes:
+                    continue
+                raw_value = attribute.group(0)[len(attribute.group(1)):].lstrip()
+                value = ''
+                if raw_value.startswith('='):
+                    value = raw_value[1:].strip()
+                    if value[:1] in ('"', "'"):
+                        value = value[1:-1]
+                    value = html.unescape(value)
+                attributes[name] = (value, offset + attribute.start(), offset + attribute.end())
+            self.tags.append(HtmlTag(match.group(2).lower(), match.end(2), attributes))
+
+    def find_all(self, name):
+        return [tag for tag in self.tags if tag.name == name]
+
+    def find(self, name):
+        for tag in self.tags:
+            if tag.name == name:
+                return tag
+        return None
+
+    def __str__(self):
+        edits = []
+        for tag in self.tags:
+            for name, value in tag.changes.items():
+                replacement = f'{name}="{html.escape(value, quote=True)}"'
+                if name in tag.attributes:
+                    _, start, end = tag.attributes[name]
+                    edits.append((start, end, replacement))
+                else:
+                    edits.append((tag.insert_at, tag.insert_at, ' ' + replacement))
+        if not edits:
+            return self.html
+        chunks = []
+        position = 0
+        for start, end, replacement in sorted(edits):
+            chunks.append(self.html[position:start])
+            chunks.append(replacement)
+            position = end
+        chunks.append(self.html[position:])
+        return ''.join(chunks)
+
+def parse_html_document(html_content, mode=None):
+    """Zwraca dokument z metodami find_all/find i str() - OffsetHtmlDocument albo BeautifulSoup"""
+    if (mode or HTML_REWRITE_MODE) == "fast":
+        return OffsetHtmlDocument(html_content)
+    return BeautifulSoup(html_content, HTML_PARSER)
+
+def find_tracking_images(html_content, mode=None):
+    """Szuka obrazków 1x1 i ukrytych (display:none) - parsując wyłącznie znaczniki <img>"""
+    if (mode or HTML_REWRITE_MODE) == "fast":
+        images = OffsetHtmlDocument(html_content, tag_names=('img',)).find_all('img')
+    else:
+        images = BeautifulSoup(html_content, HTML_PARSER, parse_only=SoupStrainer('img')).find_all('img')
+    tracking_images = []
+    for img in images:
+        style = (img.get('style') or '').replace(' ', '')
+        if (img.get('width') == '1' and img.get('height') == '1') or 'display:none' in style:
+            tracking_images.append(img)
+    return tracking_images
+
+# Współdzielony klient HTTP: limit połączeń na host i równoległe pobieranie obrazów
+HTTP_MAX_CONNECTIONS_PER_HOST = int(st.secrets.get("HTTP_MAX_CONNECTIONS_PER_HOST", 6))
+HTTP_MAX_HOSTS = int(st.secrets.get("HTTP_MAX_HOSTS", 32))
+IMAGE_FETCH_WORKERS = int(st.secrets.get("IMAGE_FETCH_WORKERS", 8))
+IMAGE_FETCH_DEADLINE = float(st.secrets.get("IMAGE_FETCH_DEADLINE", 15))
+
+@shared_resource
+def get_http_adapter():
+    """Pula połączeń keep-alive współdzielona przez wszystkie sesje HTTP aplikacji"""
+    return HTTPAdapter(
+        pool_connections=HTTP_MAX_HOSTS,
+        pool_maxsize=HTTP_MAX_CONNECTIONS_PER_HOST,
+        pool_block=True
+    )
+
+def new_http_session(headers):
+    """Nowa sesja (własne ciasteczka) korzystająca ze wspólnej puli połączeń"""
+    session = requests.Session()
+    adapter = get_http_adapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(headers)
+    return session
+
+@shared_resource
+def get_image_executor():
+    """Pula wątków do równoległego pobierania obrazów z podglądów"""
+    return ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
+
+# Pamięć podręczna obrazów z podglądów (pamięć RAM + dysk)
+IMAGE_CACHE_DIR = st.secrets.get("IMAGE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mail-opener-image-cache"))
+IMAGE_CACHE_MEMORY_BYTES = int(st.secrets.get("IMAGE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+IMAGE_CACHE_DISK_BYTES = int(st.secrets.get("IMAGE_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+IMAGE_CACHE_FRESH_TTL = int(st.secrets.get("IMAGE_CACHE_FRESH_TTL", 3600))
+IMAGE_CACHE_MAX_AGE = int(st.secrets.get("IMAGE_CACHE_MAX_AGE", 7 * 24 * 3600))
+
+CachedImage = namedtuple('CachedImage', ['data', 'digest', 'etag', 'last_modified', 'content_type', 'stored_at', 'must_revalidate'])
+
+def normalize_image_url(url):
+    """Klucz pamięci obrazów: mała litera schematu i hosta, bez domyślnego portu, fragmentu i z posortowanym query"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and not (scheme == 'http' and parts.port == 80) and not (scheme == 'https' and parts.port == 443):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+class ImageCache:
+    """Dwupoziomowa pamięć obrazów adresowana treścią.
+
+    Poziom pierwszy to LRU w pamięci, drugi - pliki na dysku nazwane skrótem
+    SHA-256 treści (te same bajty spod różnych adresów zapisywane są raz) z
+    indeksem w SQLite. Wpis młodszy niż fresh_ttl jest zwracany bez sieci,
+    starszy wymaga rewalidacji (If-None-Match / If-Modified-Since), a po
+    max_age jest usuwany. Oba poziomy mają też limit rozmiaru.
+    """
+
+    def __init__(self, directory, memory_limit=64 * 1024 * 1024, disk_limit=512 * 1024 * 1024, fresh_ttl=3600, max_age=7 * 24 * 3600):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self.stats = Counter()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(directory, 'blobs'), exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS images ('
+            ' url TEXT PRIMARY KEY, digest TEXT NOT NULL, etag TEXT, last_modified TEXT,'
+            ' content_type TEXT, size INTEGER NOT NULL, stored_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL, must_revalidate INTEGER NOT NULL DEFAULT 0)'
+        )
+        self._db.commit()
+
+    def _blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+
+    def _remember(self, key, entry):
+        """Dodaje wpis do poziomu pamięci, wyrzucając najdawniej używane ponad limit"""
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old.data)
+        if len(entry.data) > self.memory_limit:
+            return
+        self._memory[key] = entry
+        self._memory_bytes += len(entry.data)
+        while self._memory_bytes > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted.data)
+
+    def _forget(self, key):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_bytes -= len(old.data)
+        row = self._db.execute('SELECT digest FROM images WHERE url = ?', (key,)).fetchone()
+        self._db.execute('DELETE FROM images WHERE url = ?', (key,))
+        if row:
+            self._drop_blob_if_unused(row[0])
+        self._db.commit()
+
+    def _drop_blob_if_unused(self, digest):
+        if not self._db.execute('SELECT 1 FROM images WHERE digest = ? LIMIT 1', (digest,)).fetchone():
+            try:
+                os.remove(self._blob_path(digest))
+            except OSError:
+                pass
+
+    def get(self, url):
+        """Zwraca CachedImage albo None; wpisy starsze niż max_age są usuwane"""
+        key = normalize_image_url(url)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if now - entry.stored_at > self.max_age:
+                    self._forget(key)
+                    return None
+                self._memory.move_to_end(key)
+                self.stats['memory_hit'] += 1
+                return entry
+            row = self._db.execute(
+                'SELECT digest, etag, last_modified, content_type, stored_at, must_revalidate FROM images WHERE url = ?',
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.stats['miss'] += 1
+                return None
+            digest, etag, last_modified, content_type, stored_at, must_revalidate = row
+            if now - stored_at > self.max_age:
+                self._forget(key)
+                self.stats['miss'] += 1
+                return None
+            try:
+                with open(self._blob_path(digest), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                self._forget(key)
+                self.stats['miss'] += 1
+                return None
+            self._db.execute('UPDATE images SET accessed_at = ? WHERE url = ?', (now, key))
+            self._db.commit()
+            entry = CachedImage(data, digest, etag, last_modified, content_type, stored_at, bool(must_revalidate))
+            self._remember(key, entry)
+            self.stats['disk_hit'] += 1
+            return entry
+
+    def is_fresh(self, entry):
+        return not entry.must_revalidate and time.time() - entry.stored_at <= self.fresh_ttl
+
+    def put(self, url, data, etag=None, last_modified=None, content_type=None, must_revalidate=False):
+        key = normalize_image_url(url)
+        digest = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        entry = CachedImage(data, digest, etag, last_modified, content_type, now, must_revalidate)
+        with self._lock:
+            blob_path = self._blob_path(digest)
+            if not os.path.exists(blob_path):
+                temp_path = f"{blob_path}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, blob_path)
+            previous = self._db.execute('SELECT digest FROM images WHERE url = ?', (key,)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO images (url, digest, etag, last_modified, content_type, size, stored_at, accessed_at, must_revalidate)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, digest, etag, last_modified, content_type, len(data), now, now, int(must_revalidate))
+            )
+            if previous and previous[0] != digest:
+                self._drop_blob_if_unused(previous[0])
+            self._db.commit()
+            self._remember(key, entry)
+            self._evict_disk()
+        return entry
+
+    def revalidated(self, url, entry):
+        """Odświeża znacznik czasu po odpowiedzi 304 Not Modified"""
+        key = normalize_image_url(url)
+        now = time.time()
+        entry = entry._replace(stored_at=now)
+        with self._lock:
+            self._db.execute('UPDATE images SET stored_at = ?, accessed_at = ? WHERE url = ?', (now, now, key))
+            self._db.commit()
+            self._remember(key, entry)
+            self.stats['revalidated'] += 1
+        return entry
+
+    def _evict_disk(self):
+        """Usuwa przeterminowane wpisy, a potem najdawniej używane ponad limit rozmiaru dysku"""
+        expired = self._db.execute('SELECT url FROM images WHERE stored_at < ?', (time.time() - self.max_age,)).fetchall()
+        for (key,) in expired:
+            self._forget(key)
+        total = self._db.execute('SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT digest, size FROM images)').fetchone()[0]
+        if total <= self.disk_limit:
+            return
+        for key, digest, size in self._db.execute('SELECT url, digest, size FROM images ORDER BY accessed_at').fetchall():
+            if total <= self.disk_limit:
+                break
+            self._forget(key)
+            if not os.path.exists(self._blob_path(digest)):
+                total -= size
+
+@shared_resource
+def get_image_cache():
+    """Pamięć obrazów przechowywana między przebiegami skryptu Streamlit"""
+    return ImageCache(
+        IMAGE_CACHE_DIR,
+        memory_limit=IMAGE_CACHE_MEMORY_BYTES,
+        disk_limit=IMAGE_CACHE_DISK_BYTES,
+        fresh_ttl=IMAGE_CACHE_FRESH_TTL,
+        max_age=IMAGE_CACHE_MAX_AGE
+    )
+
+def load_image(url, cache=None):
+    """Ładuje obrazy z lepszymi nagłówkami do symulacji prawdziwej przeglądarki
+
+    Obrazy są serwowane z pamięci podręcznej; nieświeże wpisy są rewalidowane
+    przez ETag / Last-Modified. Odpowiedzi z Cache-Control: no-store nie są
+    zapamiętywane, a no-cache są zawsze rewalidowane, więc piksele śledzące
+    nadal trafiają do serwera.
+    """
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
         'Accept': 'image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
@@ -150,16 +1367,69 @@ def load_image(url):
     }
     
     try:
-        session = requests.Session()
-        session.headers.update(headers)
-        response = session.get(url, timeout=10)
+        if cache is None:
+            cache = get_image_cache()
+        cached = cache.get(url)
+        if cached is not None and cache.is_fresh(cached):
+            logger.debug("Loaded image from cache: %s", url)
+            return cached.data
+        
+        # Żądanie warunkowe - serwer odpowie 304, jeśli obraz się nie zmienił
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        
+        session = new_http_session(headers)
+        with span("image_request") as timer:
+            response = session.get(url, timeout=10)
+            timer.bytes = len(response.content)
+        if response.status_code == 304 and cached is not None:
+            cache.revalidated(url, cached)
+            logger.debug("Image not modified, served from cache: %s", url)
+            return cached.data
         response.raise_for_status()
-        logger.debug(f"Loaded image from {url} - Status: {response.status_code}")
+        logger.debug("Loaded image from %s - Status: %s", url, response.status_code)
+        
+        cache_control = response.headers.get('Cache-Control', '').lower()
+        if 'no-store' not in cache_control:
+            cache.put(
+                url,
+                response.content,
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'),
+                content_type=response.headers.get('Content-Type'),
+                must_revalidate='no-cache' in cache_control
+            )
         return response.content
     except Exception as e:
-        logger.error(f"Failed to load image from {url}: {e}")
+        logger.error("Failed to load image from %s: %s", url, e)
         return None
 
+def load_images(urls, deadline=IMAGE_FETCH_DEADLINE):
+    """Pobiera obrazy równolegle i zwraca {url: bajty} dla tych, które zdążyły przed terminem.
+
+    Obrazy spóźnione dalej pobierają się w tle (i trafią do pamięci
+    podręcznej), ale nie wstrzymują renderowania maila.
+    """
+    executor = get_image_executor()
+    cache = get_image_cache()
+    futures = {executor.submit(load_image, url, cache): url for url in urls}
+    if not futures:
+        return {}
+    with span("image_download") as timer:
+        done, not_done = wait(futures, timeout=deadline)
+        if not_done:
+            logger.warning("%s of %s images not loaded within %ss, rendering without them", len(not_done), len(futures), deadline)
+        images = {}
+        for future in done:
+            img_data = future.result()
+            if img_data:
+                images[futures[future]] = img_data
+                timer.bytes += len(img_data)
+    return images
+
 def simulate_link_click(url, referer=None):
     """Poprawiona funkcja symulacji kliknięcia w link"""
     headers = {
@@ -179,49 +1449,49 @@ def simulate_link_click(url, referer=None):
     
     try:
         # Użyj sesji do zachowania ciasteczek
-        session = requests.Session()
-        session.headers.update(headers)
+        session = new_http_session(headers)
         
         # Symuluj prawdziwe kliknięcie - użyj GET i pobierz treść
-        response = session.get(
-            url, 
-            allow_redirects=True, 
-            timeout=15,
-            stream=False
-        )
+        with span("link_click") as timer:
+            response = session.get(
+                url, 
+                allow_redirects=True, 
+                timeout=15,
+                stream=False
+            )
+            timer.bytes = len(response.content)
         
         # Sprawdź czy żądanie było udane
         response.raise_for_status()
         
         # Loguj szczegóły odpowiedzi
-        logger.debug(f"Clicked link {url}")
-        logger.debug(f"Final URL after redirects: {response.url}")
-        logger.debug(f"Status code: {response.status_code}")
-        logger.debug(f"Response headers: {dict(response.headers)}")
-        logger.debug(f"Content length: {len(response.content)} bytes")
+        logger.debug("Clicked link %s", url)
+        logger.debug("Final URL after redirects: %s", response.url)
+        logger.debug("Status code: %s", response.status_code)
+        logger.debug("Response headers: %s", response.headers)
+        logger.debug("Content length: %s bytes", len(response.content))
         
         # Jeśli to strona HTML, spróbuj znaleźć dodatkowe tracking pixele
         content_type = response.headers.get('content-type', '').lower()
         if 'text/html' in content_type:
             try:
-                soup = BeautifulSoup(response.content, 'html.parser')
-                
                 # Szukaj dodatkowych obrazów trackingowych
-                tracking_images = soup.find_all('img', {'width': '1', 'height': '1'})
-                tracking_images.extend(soup.find_all('img', style=lambda x: x and 'display:none' in x.replace(' ', '')))
+                tracking_images = find_tracking_images(response.text)
                 
                 for img in tracking_images:
                     img_src = img.get('src')
                     if img_src:
                         img_url = urljoin(response.url, img_src)
                         try:
-                            img_response = session.get(img_url, timeout=5)
-                            logger.debug(f"Loaded tracking pixel: {img_url}")
+                            with span("tracking_pixel") as timer:
+                                img_response = session.get(img_url, timeout=5)
+                                timer.bytes = len(img_response.content)
+                            logger.debug("Loaded tracking pixel: %s", img_url)
                         except:
                             pass
                             
             except Exception as e:
-                logger.debug(f"Could not parse HTML content for additional tracking: {e}")
+                logger.debug("Could not parse HTML content for additional tracking: %s", e)
         
         # Dodaj małe opóźnienie dla symulacji prawdziwego zachowania
         time.sleep(random.uniform(0.5, 2.0))
@@ -229,56 +1499,216 @@ def simulate_link_click(url, referer=None):
         return response.url
         
     except requests.exceptions.Timeout:
-        logger.error(f"Timeout while clicking link {url}")
+        logger.error("Timeout while clicking link %s", url)
         return url
     except requests.exceptions.RequestException as e:
-        logger.error(f"HTTP error while clicking link {url}: {e}")
+        logger.error("HTTP error while clicking link %s: %s", url, e)
         return url
     except Exception as e:
-        logger.error(f"Unexpected error while clicking link {url}: {e}")
+        logger.error("Unexpected error while clicking link %s: %s", url, e)
         return url
 
-def process_html_content(html_content, email_message, should_click_links=True):
+# Obrazy w podglądzie: "inline" (adresy data:) albo "asset_store" (pliki serwowane przez Streamlit)
+PREVIEW_IMAGE_MODE = st.secrets.get("PREVIEW_IMAGE_MODE", "inline")
+PREVIEW_ASSET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "previews")
+PREVIEW_ASSET_URL = "/app/static/previews"
+PREVIEW_ASSET_MAX_BYTES = int(st.secrets.get("PREVIEW_ASSET_MAX_BYTES", 256 * 1024 * 1024))
+
+class PreviewAssetStore:
+    """Lokalny magazyn obrazów z podglądów adresowany skrótem SHA-256 treści.
+
+    Pliki leżą w katalogu static/ aplikacji, który Streamlit serwuje pod
+    /app/static/ (server.enableStaticServing), więc HTML odwołuje się do
+    obrazu krótkim adresem, a przeglądarka pobiera każdy obraz raz, nawet
+    jeśli powtarza się w wielu mailach. Obrazy użyte w zachowanych podglądach
+    (retain/release) nie są usuwane przy przycinaniu magazynu.
+    """
+
+    # Streamlit serwuje z poprawnym typem tylko te rozszerzenia
+    SERVABLE_TYPES = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/webp': '.webp'}
+
+    def __init__(self, directory, url_prefix, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._added_bytes = 0
+        self._references = Counter()
+        self._name_pattern = re.compile(re.escape(url_prefix) + r'/([0-9a-f]{64}\.[a-z]+)')
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, data, content_type):
+        """Zapisuje obraz (jeśli go jeszcze nie ma) i zwraca jego adres albo None dla nieobsługiwanego typu"""
+        extension = self.SERVABLE_TYPES.get((content_type or '').lower())
+        if extension is None:
+            return None
+        name = hashlib.sha256(data).hexdigest() + extension
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if os.path.exists(path):
+                # Czas modyfikacji = ostatnie użycie, przycinanie usuwa najdawniej używane
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            else:
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+                self._added_bytes += len(data)
+                if self._added_bytes > self.max_bytes // 10:
+                    self._added_bytes = 0
+                    self._prune()
+        return f"{self.url_prefix}/{name}"
+
+    def retain(self, html):
+        """Chroni obrazy, do których odwołuje się podgląd, i zwraca ich nazwy (dla release)"""
+        names = set(self._name_pattern.findall(html))
+        with self._lock:
+            self._references.update(names)
+        return names
+
+    def release(self, names):
+        """Zwalnia obrazy podglądu, który nie jest już przechowywany"""
+        with self._lock:
+            for name in names:
+                self._references[name] -= 1
+                if self._references[name] <= 0:
+                    del self._references[name]
+
+    def _prune(self):
+        """Usuwa najdawniej używane pliki, gdy magazyn przekroczy max_bytes.
+
+        Pliki z odwołaniami z zachowanych podglądów zostają, nawet jeśli
+        magazyn jest przez to większy niż max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp') and entry.name not in self._references:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+@shared_resource
+def get_preview_asset_store():
+    return PreviewAssetStore(PREVIEW_ASSET_DIR, PREVIEW_ASSET_URL, PREVIEW_ASSET_MAX_BYTES)
+
+def image_src(img_data, mime_type, asset_store=None):
+    """Adres obrazu do podglądu - z magazynu zasobów, jeśli podano, w przeciwnym razie data:"""
+    if asset_store is not None:
+        url = asset_store.add(img_data, mime_type)
+        if url:
+            return url
+    encoded_image = base64.b64encode(img_data).decode()
+    return f"data:{mime_type};base64,{encoded_image}"
+
+class ContentIdIndex:
+    """Indeks Content-ID -> część maila budowany jednym przejściem po walk().
+
+    Adresy obrazów (data: albo z magazynu zasobów) są zapamiętywane, więc ten
+    sam cid: użyty wielokrotnie w HTML jest dekodowany tylko raz.
+    """
+
+    def __init__(self, email_message, asset_store=None):
+        self.asset_store = asset_store
+        self._parts = {}
+        self._image_srcs = {}
+        for part in email_message.walk():
+            content_id = part.get('Content-ID')
+            if content_id:
+                # Pierwsza część z danym Content-ID wygrywa - tak jak w pętli walk()
+                self._parts.setdefault(content_id.strip().strip('<>'), part)
+
+    def __len__(self):
+        return len(self._parts)
+
+    def find_part(self, cid):
+        part = self._parts.get(cid)
+        if part is None:
+            # Adresy cid: mogą być zakodowane jak URL (RFC 2392)
+            part = self._parts.get(unquote(cid))
+        return part
+
+    def image_src(self, cid):
+        """Zwraca adres obrazu albo None, jeśli w mailu nie ma takiej części"""
+        if cid in self._image_srcs:
+            return self._image_srcs[cid]
+        part = self.find_part(cid)
+        src = None
+        if part is not None:
+            img_data = part.get_payload(decode=True)
+            if img_data is not None:
+                src = image_src(img_data, part.get_content_type(), self.asset_store)
+        self._image_srcs[cid] = src
+        return src
+
+PREVIEW_BODY_STYLE = 'max-width: 800px; margin: auto; padding: 20px; font-family: Arial, sans-serif;'
+
+# Sygnatury formatów obrazów (imghdr zniknął z biblioteki standardowej w Pythonie 3.13)
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+)
+
+def sniff_image_type(img_data):
+    """Typ MIME obrazu na podstawie pierwszych bajtów (domyślnie image/png)"""
+    img_data = img_data or b''
+    if img_data[:4] == b'RIFF' and img_data[8:12] == b'WEBP':
+        return "image/webp"
+    for signature, img_type in IMAGE_SIGNATURES:
+        if img_data.startswith(signature):
+            return f"image/{img_type}"
+    return "image/png"
+
+def process_html_content(html_content, email_message, should_click_links=True, cid_index=None, asset_store=None):
     """Przetwarzanie treści HTML z opcjonalnym klikaniem jednego losowego linku"""
-    soup = BeautifulSoup(html_content, 'html.parser')
+    with span("html_parse") as timer:
+        timer.bytes = len(html_content)
+        soup = parse_html_document(html_content)
+    if cid_index is None:
+        cid_index = ContentIdIndex(email_message, asset_store)
     
     # Liczniki do śledzenia ilości przetworzonych elementów
     processed_images = 0
     clicked_links = 0
     
+    # Obrazy zewnętrzne pobieramy równolegle, z limitem czasu na cały mail
+    base_url = email_message.get('From', '')
+    external_urls = {
+        urljoin(base_url, img.get('src'))
+        for img in soup.find_all('img')
+        if img.get('src') and not img.get('src').startswith('cid:')
+    }
+    external_images = load_images(external_urls)
+    
     # Przetwarzanie obrazów (zawsze)
     for img in soup.find_all('img'):
         src = img.get('src')
         if src:
             if src.startswith('cid:'):
                 # Obraz osadzony
-                cid = src[4:]
-                for part in email_message.walk():
-                    if part.get('Content-ID') and part.get('Content-ID').strip('<>') == cid:
-                        img_data = part.get_payload(decode=True)
-                        img_type = part.get_content_type()
-                        encoded_image = base64.b64encode(img_data).decode()
-                        img['src'] = f"data:{img_type};base64,{encoded_image}"
-                        processed_images += 1
-                        break
+                cid_src = cid_index.image_src(src[4:])
+                if cid_src:
+                    img['src'] = cid_src
+                    processed_images += 1
             else:
                 # Obraz zewnętrzny - ładuj z nagłówkami przeglądarki
-                full_url = urljoin(email_message.get('From', ''), src)
-                img_data = load_image(full_url)
+                full_url = urljoin(base_url, src)
+                img_data = external_images.get(full_url)
                 if img_data:
-                    # Spróbuj określić typ obrazu na podstawie nagłówków
-                    try:
-                        import imghdr
-                        img_type = imghdr.what(None, h=img_data)
-                        if img_type:
-                            mime_type = f"image/{img_type}"
-                        else:
-                            mime_type = "image/png"  # fallback
-                    except:
-                        mime_type = "image/png"
-                    
-                    encoded_image = base64.b64encode(img_data).decode()
-                    img['src'] = f"data:{mime_type};base64,{encoded_image}"
+                    img['src'] = image_src(img_data, sniff_image_type(img_data), asset_store)
                     processed_images += 1
     
     # Przetwarzanie linków - kliknij w jeden losowy link jeśli should_click_links=True
@@ -303,292 +1733,2233 @@ def process_html_content(html_content, email_message, should_click_links=True):
             chosen_link['href'] = clicked_url
             clicked_links = 1
             
-            logger.debug(f"Clicked random link: {href} (chosen from {len(links_to_choose_from)} available links)")
+            logger.debug("Clicked random link: %s (chosen from %s available links)", href, len(links_to_choose_from))
         else:
             logger.debug("No valid links found to click")
         
-        logger.debug(f"Processed {processed_images} images and clicked {clicked_links} link")
+        logger.debug("Processed %s images and clicked %s link", processed_images, clicked_links)
     else:
-        logger.debug(f"Processed {processed_images} images, links not clicked")
+        logger.debug("Processed %s images, links not clicked", processed_images)
     
     # Dodanie stylów do body
     body = soup.find('body')
     if body:
-        body['style'] = 'max-width: 800px; margin: auto; padding: 20px; font-family: Arial, sans-serif;'
+        body['style'] = PREVIEW_BODY_STYLE
+    
+    with span("html_serialize"):
+        return str(soup), clicked_links
+
+def analyze_email_bytes(email_body):
+    """Cała praca CPU na surowych bajtach maila - wersja dla puli procesów.
+
+    Zwraca mały słownik (temat, nadawca, treść tekstowa, wybrany HTML, adresy
+    obrazów i pierwsze linki oraz dane obrazów cid:, do których HTML się
+    odwołuje), który tanio przechodzi między procesami.
+    """
+    with span("mime_parse") as timer:
+        timer.bytes = len(email_body)
+        email_message = email.message_from_bytes(email_body)
+    sender_key = get_sender_key(email_message)
+    subject, content, html_content = extract_email_content(email_message, sender_key)
+    
+    images = []
+    links = []
+    cid_images = {}
+    if html_content:
+        with span("html_parse") as timer:
+            timer.bytes = len(html_content)
+            document = parse_html_document(html_content)
+        for img in document.find_all('img'):
+            src = img.get('src')
+            if src and src not in images:
+                images.append(src)
+        # Tak jak process_html_content - losujemy spośród pierwszych 10 linków
+        links = [a.get('href') for a in document.find_all('a') if a.get('href')][:10]
+        cid_index = ContentIdIndex(email_message)
+        for src in images:
+            if src.startswith('cid:'):
+                part = cid_index.find_part(src[4:])
+                img_data = part.get_payload(decode=True) if part is not None else None
+                if img_data is not None:
+                    cid_images[src[4:]] = (part.get_content_type(), img_data)
+    
+    return {
+        'subject': subject,
+        'from': email_message.get('From', ''),
+        'text': content,
+        'html': html_content,
+        'images': images,
+        'links': links,
+        'cid_images': cid_images,
+    }
+
+def rewrite_html_references(html_content, image_map, link_map):
+    """Podmienia src obrazów i href wybranych linków oraz dodaje styl body"""
+    link_map = dict(link_map)
+    with span("html_parse") as timer:
+        timer.bytes = len(html_content)
+        document = parse_html_document(html_content)
+    for img in document.find_all('img'):
+        src = img.get('src')
+        if src in image_map:
+            img['src'] = image_map[src]
+    for a in document.find_all('a'):
+        href = a.get('href')
+        if href in link_map:
+            # Jak w process_html_content - zmieniony jest tylko kliknięty element
+            a['href'] = link_map.pop(href)
+    body = document.find('body')
+    if body:
+        body['style'] = PREVIEW_BODY_STYLE
+    with span("html_serialize"):
+        return str(document)
+
+@shared_resource
+def get_process_pool():
+    """Pula procesów roboczych (spawn - fork procesu z wątkami serwera Streamlit nie jest bezpieczny)"""
+    return ProcessPoolExecutor(max_workers=PROCESS_POOL_SIZE or 1, mp_context=multiprocessing.get_context("spawn"))
+
+def discard_process_pool(pool):
+    """Zamyka zepsutą pulę (proces roboczy padł) - następne get_process_pool() utworzy nową"""
+    if get_process_pool.clear(pool) is not None:
+        logger.error("Process pool broken, starting a new one")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+class PoolTask:
+    """Zadanie zlecone aktualnej wspólnej puli procesów.
+
+    Pula jest pobierana przy zleceniu, nie zapamiętywana przez wywołującego.
+    Gdy padnie (zleceniem albo w trakcie zadania), jest zamykana, a zadanie
+    raz ponawiane w nowej - kolejny błąd przechodzi do wywołującego.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.pool, self.future = self._submit()
+
+    def _submit(self):
+        pool = get_process_pool()
+        try:
+            return pool, pool.submit(self.func, *self.args)
+        except BrokenProcessPool:
+            discard_process_pool(pool)
+            pool = get_process_pool()
+            return pool, pool.submit(self.func, *self.args)
+
+    def cancel(self):
+        return self.future.cancel()
+
+    def result(self):
+        try:
+            return self.future.result()
+        except BrokenProcessPool:
+            discard_process_pool(self.pool)
+            self.pool, self.future = self._submit()
+            return self.future.result()
+
+def render_analyzed_email(analysis, should_click_links=True, asset_store=None):
+    """Część I/O przetwarzania (obrazy, kliknięcie) dla wyniku analyze_email_bytes.
+
+    Przepisanie HTML odbywa się znów w puli procesów. Zwraca (treść, liczba
+    klikniętych linków) - tak jak process_html_content.
+    """
+    import mail_worker
+    html_content = analysis['html']
+    if not html_content:
+        return analysis['text'], 0
+    
+    base_url = analysis['from']
+    external_images = load_images({
+        urljoin(base_url, src) for src in analysis['images'] if not src.startswith('cid:')
+    })
+    image_map = {}
+    for src in analysis['images']:
+        if src.startswith('cid:'):
+            cid_image = analysis['cid_images'].get(src[4:])
+            if cid_image:
+                image_map[src] = image_src(cid_image[1], cid_image[0], asset_store)
+        else:
+            img_data = external_images.get(urljoin(base_url, src))
+            if img_data:
+                image_map[src] = image_src(img_data, sniff_image_type(img_data), asset_store)
+    
+    link_map = {}
+    if should_click_links and analysis['links']:
+        href = random.choice(analysis['links'])
+        link_map[href] = simulate_link_click(urljoin(base_url, href), referer=base_url)
+        logger.debug("Clicked random link: %s (chosen from %s available links)", href, len(analysis['links']))
+    logger.debug("Processed %s images and clicked %s link", len(image_map), len(link_map))
+    
+    with span("process_pool_rewrite"):
+        final_content = PoolTask(mail_worker.rewrite_html, html_content, image_map, link_map).result()
+    return final_content, len(link_map)
+
+def delete_email(mail, email_id, use_uid=False):
+    try:
+        with span("delete"):
+            if use_uid:
+                mail.uid('STORE', email_id, '+FLAGS', '\\Deleted')
+            else:
+                mail.store(email_id, '+FLAGS', '\\Deleted')
+            mail.expunge()
+        logger.debug("Deleted email %s", email_id)
+        return True
+    except Exception as e:
+        logger.error("Error deleting email %s: %s", email_id, e)
+        return False
+
+class ImmediateDeleter:
+    """Usuwanie po każdym mailu (STORE + EXPUNGE) - dotychczasowe zachowanie.
+
+    on_deleted (opcjonalnie) dostaje listę UID skutecznie usuniętych maili.
+    """
+
+    def __init__(self, mail, use_uid=False, on_deleted=None):
+        self.mail = mail
+        self.use_uid = use_uid
+        self.on_deleted = on_deleted
+        self.failed_count = 0
+
+    def add(self, email_id):
+        success = delete_email(self.mail, email_id, self.use_uid)
+        if not success:
+            self.failed_count += 1
+        elif self.use_uid:
+            self._deleted([email_id])
+        return success
+
+    def _deleted(self, uids):
+        if self.on_deleted is None:
+            return
+        try:
+            self.on_deleted(uids)
+        except Exception as e:
+            logger.warning("Deleted-email callback failed: %s", e)
+
+    def flush(self):
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        return False
+
+class BatchedDeleter(ImmediateDeleter):
+    """Odroczone usuwanie - zbiera UID przetworzonych maili i usuwa je paczkami.
+
+    Flaga \\Deleted jest ustawiana jednym UID STORE na cały zakres, a EXPUNGE
+    wykonywane raz na paczkę i na końcu przebiegu. Jeśli serwer obsługuje
+    UIDPLUS, używane jest UID EXPUNGE, więc znikają tylko nasze wiadomości.
+    """
+
+    def __init__(self, mail, batch_size=UID_FETCH_BATCH_SIZE, on_deleted=None):
+        super().__init__(mail, use_uid=True, on_deleted=on_deleted)
+        self.batch_size = batch_size
+        self.pending = []
+        self.uidplus = 'UIDPLUS' in mail.capabilities
+
+    def add(self, email_id):
+        self.pending.append(email_id)
+        if len(self.pending) >= self.batch_size:
+            return self.flush()
+        return True
+
+    def flush(self):
+        if not self.pending:
+            return True
+        uids, self.pending = self.pending, []
+        uid_set = format_uid_set(uids)
+        try:
+            with span("delete"):
+                status, _ = self.mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                if status != 'OK':
+                    raise imaplib.IMAP4.error(f"UID STORE returned {status}")
+                if self.uidplus:
+                    status, _ = self.mail.uid('EXPUNGE', uid_set)
+                else:
+                    status, _ = self.mail.expunge()
+            if status != 'OK':
+                raise imaplib.IMAP4.error(f"EXPUNGE returned {status}")
+            logger.debug("Deleted %s emails (UID %s, UIDPLUS: %s)", len(uids), uid_set, self.uidplus)
+            self._deleted(uids)
+            return True
+        except Exception as e:
+            self.failed_count += len(uids)
+            logger.error("Error deleting emails %s: %s", uid_set, e)
+            return False
+
+DELETE_STRATEGIES = {
+    "batched": "Paczkami (UID STORE + UID EXPUNGE)",
+    "immediate": "Po każdym mailu (STORE + EXPUNGE)",
+}
+
+def make_deleter(strategy, mail, use_uid=False, batch_size=UID_FETCH_BATCH_SIZE, on_deleted=None):
+    """Tworzy obiekt usuwający maile zgodnie z wybraną strategią"""
+    if strategy == "batched":
+        if use_uid:
+            return BatchedDeleter(mail, batch_size, on_deleted)
+        # Bez UID ponowne wyszukiwanie zwracałoby wciąż ten sam, nieusunięty mail
+        logger.warning("Batched deletion requires UID mode, falling back to immediate deletion")
+    return ImmediateDeleter(mail, use_uid, on_deleted)
+
+_STATUS_ITEM_PATTERN = re.compile(rb'(MESSAGES|UIDNEXT|UIDVALIDITY|HIGHESTMODSEQ) (\d+)')
+
+def get_mailbox_state(mail, mailbox="inbox"):
+    """Jeden STATUS - krotka zmieniająca się przy każdej zmianie zawartości skrzynki.
+
+    UIDNEXT rośnie z każdym nowym mailem, MESSAGES maleje po EXPUNGE,
+    a HIGHESTMODSEQ (CONDSTORE) zmienia się przy każdej modyfikacji.
+    """
+    items = ['MESSAGES', 'UIDNEXT', 'UIDVALIDITY']
+    if 'CONDSTORE' in mail.capabilities:
+        items.append('HIGHESTMODSEQ')
+    status, data = mail.status(mailbox, f"({' '.join(items)})")
+    if status != 'OK' or not data or not data[0]:
+        return None
+    values = dict(_STATUS_ITEM_PATTERN.findall(data[0]))
+    return tuple(int(values.get(item.encode(), -1)) for item in items)
+
+def imap_quote(text):
+    """Napis IMAP w cudzysłowie (z escapowaniem backslasha i cudzysłowu)"""
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def subject_search_criteria(mail, subject):
+    """Kryteria SEARCH SUBJECT; temat spoza ASCII idzie jako literał UTF-8 z CHARSET"""
+    try:
+        subject.encode('ascii')
+        return ['SUBJECT', imap_quote(subject)]
+    except UnicodeEncodeError:
+        # imaplib dokleja mail.literal jako {n} na końcu polecenia
+        mail.literal = subject.encode('utf-8')
+        return ['CHARSET', 'UTF-8', 'SUBJECT']
+
+def search_by_subject(mail, subject, use_uid=False):
+    """SEARCH SUBJECT na serwerze - zwraca listę numerów (albo UID)"""
+    criteria = subject_search_criteria(mail, subject)
+    if use_uid:
+        _, search_data = mail.uid('SEARCH', *criteria)
+    else:
+        _, search_data = mail.search(None, *criteria)
+    return search_data[0].split() if search_data and search_data[0] else []
+
+def esearch_count(mail, subject):
+    """Liczy maile po stronie serwera przez SEARCH RETURN (COUNT) (RFC 4731)"""
+    mail.response('ESEARCH')  # usuń ewentualne stare odpowiedzi
+    status, _ = mail.search(None, 'RETURN', '(COUNT)', *subject_search_criteria(mail, subject))
+    if status != 'OK':
+        raise imaplib.IMAP4.error(f"ESEARCH returned {status}")
+    _, responses = mail.response('ESEARCH')
+    for response in reversed(responses or []):
+        match = re.search(rb'COUNT (\d+)', response or b'')
+        if match:
+            return int(match.group(1))
+    return 0
+
+class SubjectCountCache:
+    """Liczby maili per (skrzynka, temat) ważne tak długo, jak stan skrzynki z STATUS się nie zmienił"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, mailbox, subject, state):
+        with self._lock:
+            entry = self._entries.get((mailbox, subject))
+        if entry is not None and state is not None and entry[0] == state:
+            return entry[1]
+        return None
+
+    def put(self, mailbox, subject, state, count):
+        if state is None:
+            return
+        with self._lock:
+            self._entries[(mailbox, subject)] = (state, count)
+
+@shared_resource
+def get_count_cache():
+    return SubjectCountCache()
+
+SUBJECT_MATCH_MODES = {
+    "substring": "Zawiera",
+    "prefix": "Zaczyna się od",
+    "exact": "Dokładnie",
+}
+
+def decode_mime_header(value):
+    """Pełne dekodowanie nagłówka (wszystkie fragmenty =?...?=), a nie tylko pierwszego"""
+    if not value:
+        return ''
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+def normalize_subject(subject):
+    return ' '.join(subject.split()).casefold()
+
+class HeaderIndex:
+    """Lokalny indeks nagłówków (UID, temat, nadawca, data, rozmiar) w SQLite.
+
+    Synchronizacja jest przyrostowa: STATUS podaje UIDVALIDITY i UIDNEXT,
+    a nagłówki pobierane są tylko dla UID większych niż przy poprzedniej
+    synchronizacji. Zmiana UIDVALIDITY unieważnia indeks skrzynki. Gdy
+    liczba maili w indeksie różni się od MESSAGES (w którąkolwiek stronę)
+    albo zmienił się HIGHESTMODSEQ (CONDSTORE), jedno UID SEARCH ALL usuwa
+    z niego maile skasowane poza aplikacją i uzupełnia brakujące.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.RLock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS mailboxes ('
+            ' mailbox TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, uidnext INTEGER NOT NULL, highestmodseq INTEGER);'
+            'CREATE TABLE IF NOT EXISTS headers ('
+            ' mailbox TEXT NOT NULL, uid INTEGER NOT NULL, subject TEXT, subject_norm TEXT,'
+            ' sender TEXT, date TEXT, size INTEGER, PRIMARY KEY (mailbox, uid));'
+            'CREATE INDEX IF NOT EXISTS headers_subject ON headers (mailbox, subject_norm);'
+        )
+        # Indeks zapisany przez starszą wersję nie ma kolumny HIGHESTMODSEQ
+        if 'highestmodseq' not in {column[1] for column in self._db.execute('PRAGMA table_info(mailboxes)')}:
+            self._db.execute('ALTER TABLE mailboxes ADD COLUMN highestmodseq INTEGER')
+        self._db.commit()
+
+    def sync(self, mail, mailbox="inbox", state=None):
+        """Dociąga nagłówki nowych maili; zwraca liczbę dodanych wpisów"""
+        key = header_index_key(mailbox)
+        if state is None:
+            state = get_mailbox_state(mail, mailbox)
+        if state is None:
+            raise imaplib.IMAP4.error(f"STATUS failed for {mailbox}")
+        messages, uidnext, uidvalidity = state[:3]
+        modseq = state[3] if len(state) > 3 and state[3] >= 0 else None
+        with self._lock:
+            row = self._db.execute('SELECT uidvalidity, uidnext, highestmodseq FROM mailboxes WHERE mailbox = ?', (key,)).fetchone()
+            if row is None or row[0] != uidvalidity:
+                if row is not None:
+                    logger.info("UIDVALIDITY of %s changed, rebuilding header index", mailbox)
+                self._db.execute('DELETE FROM headers WHERE mailbox = ?', (key,))
+                last_uidnext, last_modseq = 1, None
+            else:
+                last_uidnext, last_modseq = row[1], row[2]
+
+            added = 0
+            if uidnext > last_uidnext:
+                mail.select(mailbox)
+                for start in range(last_uidnext, uidnext, HEADER_INDEX_FETCH_CHUNK):
+                    end = min(start + HEADER_INDEX_FETCH_CHUNK, uidnext) - 1
+                    added += self._fetch_headers(mail, key, start, end)
+
+            indexed = self._db.execute('SELECT COUNT(*) FROM headers WHERE mailbox = ?', (key,)).fetchone()[0]
+            # Równa liczba nie wyklucza zmian: skasowany mail i brakujący wpis
+            # się znoszą - HIGHESTMODSEQ rośnie przy każdym EXPUNGE
+            if indexed != messages or (last_modseq is not None and modseq != last_modseq):
+                added += self._reconcile(mail, mailbox, key, uidnext)
+
+            self._db.execute(
+                'INSERT OR REPLACE INTO mailboxes (mailbox, uidvalidity, uidnext, highestmodseq) VALUES (?, ?, ?, ?)',
+                (key, uidvalidity, uidnext, modseq)
+            )
+            self._db.commit()
+        if added:
+            logger.debug("Header index of %s: added %s messages (UIDNEXT %s)", mailbox, added, uidnext)
+        return added
+
+    def built(self, mailbox, uidvalidity):
+        """Czy indeks skrzynki już istnieje - inaczej sync() pobierze nagłówki wszystkich maili"""
+        with self._lock:
+            row = self._db.execute('SELECT uidvalidity FROM mailboxes WHERE mailbox = ?', (header_index_key(mailbox),)).fetchone()
+        return row is not None and row[0] == uidvalidity
+
+    def _reconcile(self, mail, mailbox, key, uidnext):
+        """Porównuje indeks z UID SEARCH ALL: usuwa maile skasowane poza
+        aplikacją i dociąga nagłówki maili, których w indeksie brakuje"""
+        mail.select(mailbox)
+        live = {int(uid) for uid in mail.uid('SEARCH', 'ALL')[1][0].split()}
+        indexed = {uid for (uid,) in self._db.execute('SELECT uid FROM headers WHERE mailbox = ?', (key,))}
+        stale = indexed - live
+        self._db.executemany('DELETE FROM headers WHERE mailbox = ? AND uid = ?', [(key, uid) for uid in stale])
+        # Maile nowsze niż UIDNEXT ze STATUS dociągnie następna synchronizacja
+        missing = sorted(uid for uid in live - indexed if uid < uidnext)
+        added = 0
+        for start in range(0, len(missing), HEADER_INDEX_FETCH_CHUNK):
+            rows = fetch_header_rows(mail, format_uid_set(missing[start:start + HEADER_INDEX_FETCH_CHUNK]))
+            self._insert(key, rows)
+            added += len(rows)
+        logger.debug("Header index reconciled: removed %s expunged, added %s missing messages", len(stale), added)
+        return added
+
+    def _fetch_headers(self, mail, key, start, end):
+        rows = fetch_header_rows(mail, f"{start}:{end}", start)
+        self._insert(key, rows)
+        return len(rows)
+
+    def _insert(self, key, rows):
+        self._db.executemany(
+            'INSERT OR REPLACE INTO headers (mailbox, uid, subject, subject_norm, sender, date, size) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(key, row.uid, row.subject, normalize_subject(row.subject), row.sender, row.date, row.size) for row in rows]
+        )
+
+    def add(self, mailbox, rows, uidnext):
+        """Dopisuje nagłówki pobrane poza sync() (np. przez MailboxWatcher) i przesuwa UIDNEXT"""
+        key = header_index_key(mailbox)
+        with self._lock:
+            self._insert(key, rows)
+            self._db.execute('UPDATE mailboxes SET uidnext = MAX(uidnext, ?) WHERE mailbox = ?', (uidnext, key))
+            self._db.commit()
+
+    def subjects(self, mailbox):
+        """{uid: znormalizowany temat} dla wszystkich maili skrzynki w indeksie"""
+        with self._lock:
+            return dict(self._db.execute('SELECT uid, subject_norm FROM headers WHERE mailbox = ?', (header_index_key(mailbox),)))
+
+    def _where(self, subject, match):
+        needle = normalize_subject(subject)
+        if match == "exact":
+            return 'subject_norm = ?', (needle,)
+        if match == "prefix":
+            return 'substr(subject_norm, 1, ?) = ?', (len(needle), needle)
+        return 'instr(subject_norm, ?) > 0', (needle,)
+
+    def find(self, mailbox, subject, match="substring", limit=None):
+        """UID pasujących maili (rosnąco) jako bytes - tak jak zwraca je UID SEARCH"""
+        condition, params = self._where(subject, match)
+        query = f'SELECT uid FROM headers WHERE mailbox = ? AND {condition} ORDER BY uid'
+        if limit:
+            query += f' LIMIT {int(limit)}'
+        with self._lock:
+            rows = self._db.execute(query, (header_index_key(mailbox),) + params).fetchall()
+        return [str(uid).encode() for (uid,) in rows]
+
+    def count(self, mailbox, subject, match="substring"):
+        condition, params = self._where(subject, match)
+        with self._lock:
+            return self._db.execute(
+                f'SELECT COUNT(*) FROM headers WHERE mailbox = ? AND {condition}',
+                (header_index_key(mailbox),) + params
+            ).fetchone()[0]
+
+    def remove(self, mailbox, uids):
+        """Usuwa z indeksu maile skasowane przez aplikację"""
+        with self._lock:
+            self._db.executemany(
+                'DELETE FROM headers WHERE mailbox = ? AND uid = ?',
+                [(header_index_key(mailbox), int(uid)) for uid in uids]
+            )
+            self._db.commit()
+
+HeaderRow = namedtuple('HeaderRow', ['uid', 'subject', 'sender', 'date', 'size'])
+
+def fetch_header_rows(mail, uid_set, min_uid=0):
+    """UID FETCH samych nagłówków (temat, nadawca, data) i rozmiaru - lista HeaderRow"""
+    _, msg_data = mail.uid('FETCH', uid_set, '(UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (SUBJECT FROM DATE)])')
+    rows = []
+    for fields in parse_fetch_response(msg_data):
+        uid = int(fields.get('UID') or 0)
+        # "n:m" może zwrócić ostatni mail, nawet jeśli jego UID jest mniejszy niż n
+        if uid < min_uid:
+            continue
+        # Serwery różnie zapisują nazwę sekcji w odpowiedzi (wielkość liter, cudzysłowy)
+        header_bytes = next((value for name, value in fields.items() if name.upper().startswith('BODY[HEADER.FIELDS')), b'')
+        headers = email.message_from_bytes(header_bytes or b'')
+        rows.append(HeaderRow(
+            uid, decode_mime_header(headers.get('Subject')), decode_mime_header(headers.get('From')),
+            headers.get('Date'), int(fields.get('RFC822.SIZE') or 0)
+        ))
+    return rows
+
+def header_index_key(mailbox):
+    # Jeden plik indeksu może obsługiwać kilka kont i serwerów
+    return f"{EMAIL_ACCOUNT}@{IMAP_SERVER}:{IMAP_PORT}/{mailbox}"
+
+@shared_resource
+def get_header_index():
+    return HeaderIndex(HEADER_INDEX_PATH)
+
+def find_uids_by_subject(mail, subject, mailbox="inbox", match="substring", limit=None):
+    """UID maili o danym temacie - z lokalnego indeksu albo przez UID SEARCH na serwerze"""
+    if USE_HEADER_INDEX:
+        index = get_header_index()
+        index.sync(mail, mailbox)
+        return index.find(mailbox, subject, match, limit)
+    if match != "substring":
+        logger.warning("Subject match mode %r needs the header index, using substring search", match)
+    mail.select(mailbox)
+    uids = search_by_subject(mail, subject, use_uid=True)
+    return uids[:limit] if limit else uids
+
+def count_emails_by_subject(subject, mailbox="inbox", match="substring"):
+    """Liczba maili o danym temacie.
+
+    Z włączonym i zbudowanym indeksem nagłówków liczenie odbywa się lokalnie
+    po przyrostowej synchronizacji. Dopóki indeksu nie ma (pierwsze
+    uruchomienie, zmiana UIDVALIDITY), pobieranie nagłówków całej skrzynki
+    tylko po to, by podać liczbę, byłoby zbyt drogie - indeks zbuduje dopiero
+    wyszukiwanie maili do otwarcia. Wtedy, a także bez indeksu albo po błędzie
+    SQLite: gdy stan skrzynki (STATUS) się nie zmienił, wynik pochodzi
+    z pamięci bez żadnego wyszukiwania. W przeciwnym razie serwer z ESEARCH
+    zwraca samą liczbę, a pozostałe - pełną listę numerów, którą liczymy lokalnie.
+    Tryby "prefix" i "exact" zawsze korzystają z indeksu.
+    """
+    cache = get_count_cache()
+    
+    def count(mail):
+        state = get_mailbox_state(mail, mailbox)
+        if USE_HEADER_INDEX:
+            index = get_header_index()
+            try:
+                if match != "substring" or (state is not None and index.built(mailbox, state[2])):
+                    index.sync(mail, mailbox, state)
+                    return index.count(mailbox, subject, match)
+            except sqlite3.Error as e:
+                if match != "substring":
+                    raise
+                logger.warning("Header index unavailable, counting on the server: %s", e)
+        cached = cache.get(mailbox, subject, state)
+        if cached is not None:
+            logger.debug("Count for %r served from cache (mailbox state %s)", subject, state)
+            return cached
+        mail.select(mailbox)
+        if 'ESEARCH' in mail.capabilities:
+            email_count = esearch_count(mail, subject)
+        else:
+            email_count = len(search_by_subject(mail, subject))
+        cache.put(mailbox, subject, state, email_count)
+        return email_count
     
-    return str(soup), clicked_links
+    try:
+        return get_imap_pool().run(count)
+    except Exception as e:
+        logger.error("Error counting emails: %s", e)
+        return 0
+
+def subject_matches(subject_norm, needle, match="substring"):
+    """Dopasowanie znormalizowanego tematu - te same tryby co w HeaderIndex"""
+    if match == "exact":
+        return subject_norm == needle
+    if match == "prefix":
+        return subject_norm.startswith(needle)
+    return needle in subject_norm
+
+_MAILBOX_EVENT_PATTERN = re.compile(rb'\* (\d+) (EXISTS|EXPUNGE)\b', re.IGNORECASE)
+
+class MailboxWatcher:
+    """Obserwacja skrzynki na osobnym połączeniu w IMAP IDLE (RFC 2177).
+
+    Liczby maili dla obserwowanych tematów są aktualizowane przyrostowo: po
+    EXISTS pobierane są nagłówki tylko nowych UID, a numer z EXPUNGE jest
+    zamieniany na UID według lokalnej listy. Lista UID jest wczytywana raz
+    przy starcie (FETCH), potem nie ma żadnych wyszukiwań. Serwer bez IDLE
+    jest obsługiwany tak samo na odpowiedziach NOOP co WATCH_NOOP_INTERVAL.
+    Wątek kończy się, gdy przez WATCH_TTL sekund nikt nie odczytał liczby.
+
+    Z połączenia korzysta tylko wątek obserwacji (także DONE kończące IDLE
+    wysyła on sam). Odczyt ma limit czasu WATCH_READ_TIMEOUT, więc zerwane
+    bez ostrzeżenia połączenie jest wykrywane i otwierane ponownie.
+    """
+
+    def __init__(self, connection_factory=_connect_imap, mailbox="inbox"):
+        self.connection_factory = connection_factory
+        self.mailbox = mailbox
+        self.state = "stopped"
+        self.mode = None
+        self.error = None
+        self.updated_at = None
+        self._watches = {}  # (temat znormalizowany, tryb) -> [liczba, czas ostatniego odczytu]
+        self._uids = []
+        self._subjects = {}
+        self._exists = 0
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, subject, match="substring"):
+        """Rejestruje (albo odświeża) obserwację tematu; zwraca liczbę maili albo None przed wczytaniem"""
+        key = (normalize_subject(subject), match)
+        with self._lock:
+            entry = self._watches.get(key)
+            if entry is None:
+                entry = self._watches[key] = [self._count(key) if self._loaded else None, 0]
+            entry[1] = time.monotonic()
+            email_count = entry[0]
+        self._start()
+        return email_count
+
+    def unwatch(self, subject, match="substring"):
+        with self._lock:
+            self._watches.pop((normalize_subject(subject), match), None)
+            empty = not self._watches
+        if empty:
+            self.stop()
+
+    def status(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'mode': self.mode,
+                'error': self.error,
+                'updated_at': self.updated_at,
+                'messages': len(self._uids),
+                'watches': len(self._watches),
+            }
+
+    def stop(self):
+        """Zatrzymuje obserwację - wątek kończy IDLE najpóźniej po WATCH_POLL_INTERVAL"""
+        self._stop.set()
+
+    def _start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.state = "starting"
+        self._thread = threading.Thread(target=self._run, daemon=True, name="mailbox-watcher")
+        self._thread.start()
+
+    def _count(self, key):
+        needle, match = key
+        return sum(1 for subject in self._subjects.values() if subject_matches(subject, needle, match))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                mail = self.connection_factory()
+                try:
+                    use_socket_reader(mail)
+                    mail.sock.settimeout(WATCH_READ_TIMEOUT)
+                    self._watch_mailbox(mail)
+                except Exception:
+                    # Połączenie mogło zamilknąć - LOGOUT czekałby na odpowiedź do limitu czasu
+                    try:
+                        mail.shutdown()
+                    except OSError:
+                        pass
+                    raise
+                try:
+                    mail.logout()
+                except Exception:
+                    pass
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                self.state = "error"
+                self.error = str(e)
+                logger.warning("Mailbox watcher error, reconnecting in %ss: %s", WATCH_RETRY_DELAY, e)
+                self._stop.wait(WATCH_RETRY_DELAY)
+        with self._lock:
+            self._loaded = False
+            self._uids, self._subjects = [], {}
+        self.state = "stopped"
+        logger.info("Mailbox watcher stopped")
+
+    def _watch_mailbox(self, mail):
+        self.state = "loading"
+        self._load(mail)
+        self.mode = "IDLE" if 'IDLE' in mail.capabilities else "NOOP"
+        self.state = "watching"
+        self.error = None
+        logger.info("Watching %s (%s messages) using %s", self.mailbox, len(self._uids), self.mode)
+        while self._keep_watching():
+            events = self._idle(mail) if self.mode == "IDLE" else self._noop(mail)
+            self._apply(mail, events)
+
+    def _keep_watching(self):
+        """Usuwa obserwacje, których nikt nie odczytywał przez WATCH_TTL; False, gdy żadnej nie ma"""
+        now = time.monotonic()
+        with self._lock:
+            for key in [key for key, entry in self._watches.items() if now - entry[1] > WATCH_TTL]:
+                del self._watches[key]
+            if not self._watches:
+                self._stop.set()
+        return not self._stop.is_set()
+
+    def _load(self, mail):
+        """Lista UID skrzynki (jeden FETCH) i tematy - z indeksu nagłówków albo pobrane"""
+        _, data = mail.select(self.mailbox)
+        exists = int(data[0]) if data and data[0] else 0
+        uids = []
+        if exists:
+            _, msg_data = mail.fetch('1:*', '(UID)')
+            uids = sorted(int(fields['UID']) for fields in parse_fetch_response(msg_data) if fields.get('UID'))
+        known = {}
+        if USE_HEADER_INDEX:
+            index = get_header_index()
+            index.sync(mail, self.mailbox)
+            known = index.subjects(self.mailbox)
+        subjects = {uid: known[uid] for uid in uids if uid in known}
+        missing = [uid for uid in uids if uid not in subjects]
+        for start in range(0, len(missing), HEADER_INDEX_FETCH_CHUNK):
+            for row in fetch_header_rows(mail, format_uid_set(missing[start:start + HEADER_INDEX_FETCH_CHUNK])):
+                subjects[row.uid] = normalize_subject(row.subject)
+        _pending_mailbox_events(mail)
+        with self._lock:
+            self._uids = uids
+            self._subjects = subjects
+            self._exists = len(uids)
+            self._loaded = True
+            for key, entry in self._watches.items():
+                entry[0] = self._count(key)
+            self.updated_at = time.time()
+
+    def _idle(self, mail):
+        """Jeden cykl IDLE: czeka na EXISTS/EXPUNGE (albo odnowienie) i zwraca zdarzenia"""
+        tag = mail._new_tag()
+        events = []
+        mail.send(tag + b' IDLE\r\n')
+        try:
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed before IDLE")
+                if line.startswith(b'+'):
+                    break
+                if line.startswith(tag + b' '):
+                    raise imaplib.IMAP4.error(f"IDLE rejected: {line.decode(errors='replace').strip()}")
+                self._collect(line, events)
+            # IDLE trzeba odnawiać (serwery rozłączają po ~30 minutach bezczynności);
+            # odnowienie sprawdza też, czy połączenie wciąż odpowiada
+            renew_at = time.monotonic() + min(IMAP_IDLE_RENEW, WATCH_TTL)
+            done_deadline = None
+            mail.sock.settimeout(WATCH_POLL_INTERVAL)
+            while True:
+                if done_deadline is None and (events or self._stop.is_set() or time.monotonic() >= renew_at):
+                    # Kończymy IDLE, żeby pobrać nagłówki; reszta zdarzeń przyjdzie przed odpowiedzią
+                    mail.send(b'DONE\r\n')
+                    done_deadline = time.monotonic() + WATCH_READ_TIMEOUT
+                try:
+                    line = mail.readline()
+                except socket.timeout:
+                    if done_deadline is not None and time.monotonic() > done_deadline:
+                        raise imaplib.IMAP4.abort("no response to DONE, connection lost")
+                    continue
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                if line.startswith(tag + b' '):
+                    if not line[len(tag) + 1:].upper().startswith(b'OK'):
+                        raise imaplib.IMAP4.error(f"IDLE failed: {line.decode(errors='replace').strip()}")
+                    break
+                self._collect(line, events)
+        finally:
+            mail.sock.settimeout(WATCH_READ_TIMEOUT)
+            mail.tagged_commands.pop(tag, None)
+        return events
 
-def delete_email(mail, email_id):
-    try:
-        mail.store(email_id, '+FLAGS', '\\Deleted')
-        mail.expunge()
-        logger.debug(f"Deleted email {email_id}")
-        return True
-    except Exception as e:
-        logger.error(f"Error deleting email {email_id}: {e}")
-        return False
+    def _collect(self, line, events):
+        match = _MAILBOX_EVENT_PATTERN.match(line)
+        if match:
+            events.append((match.group(2).decode().upper(), int(match.group(1))))
+        return bool(match)
 
-def count_emails_by_subject(subject):
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-        mail.select("inbox")
-        
-        _, search_data = mail.search(None, f'SUBJECT "{subject}"')
-        email_ids = search_data[0].split()
-        
-        mail.close()
-        mail.logout()
-        
-        return len(email_ids)
-    except Exception as e:
-        logger.error(f"Error counting emails: {e}")
-        return 0
+    def _noop(self, mail):
+        self._stop.wait(WATCH_NOOP_INTERVAL)
+        mail.noop()
+        return _pending_mailbox_events(mail)
+
+    def _apply(self, mail, events):
+        while events:
+            new_mail = False
+            for kind, number in events:
+                if kind == 'EXPUNGE':
+                    self._expunged(number)
+                else:
+                    self._exists = number
+                    new_mail = new_mail or number > len(self._uids)
+            if new_mail:
+                self._fetch_new(mail)
+            # Odpowiedzi nieoznaczone, które przyszły w trakcie naszego FETCH
+            events = _pending_mailbox_events(mail)
+        if len(self._uids) != self._exists:
+            logger.warning("Watcher lost track of %s (%s UIDs, EXISTS %s), reloading", self.mailbox, len(self._uids), self._exists)
+            self._load(mail)
+        with self._lock:
+            self.updated_at = time.time()
 
-def get_first_email_by_subject(mail, subject):
-    """Pobiera ID pierwszego maila o danym temacie"""
+    def _expunged(self, number):
+        self._exists -= 1
+        if not 0 < number <= len(self._uids):
+            return
+        with self._lock:
+            uid = self._uids.pop(number - 1)
+            subject = self._subjects.pop(uid, None)
+            if subject is not None:
+                for (needle, match), entry in self._watches.items():
+                    if entry[0] and subject_matches(subject, needle, match):
+                        entry[0] -= 1
+        if USE_HEADER_INDEX:
+            get_header_index().remove(self.mailbox, [uid])
+
+    def _fetch_new(self, mail):
+        last_uid = self._uids[-1] if self._uids else 0
+        rows = sorted(fetch_header_rows(mail, f"{last_uid + 1}:*", last_uid + 1), key=lambda row: row.uid)
+        with self._lock:
+            for row in rows:
+                subject = normalize_subject(row.subject)
+                self._uids.append(row.uid)
+                self._subjects[row.uid] = subject
+                for (needle, match), entry in self._watches.items():
+                    if entry[0] is not None and subject_matches(subject, needle, match):
+                        entry[0] += 1
+        if USE_HEADER_INDEX and rows:
+            get_header_index().add(self.mailbox, rows, rows[-1].uid + 1)
+        logger.debug("Watcher: %s new messages in %s", len(rows), self.mailbox)
+
+def _pending_mailbox_events(mail):
+    """EXPUNGE/EXISTS zebrane przez imaplib z odpowiedzi na zwykłe komendy"""
+    events = [('EXPUNGE', int(number)) for number in mail.untagged_responses.pop('EXPUNGE', [])]
+    exists = mail.untagged_responses.pop('EXISTS', [])
+    if exists:
+        events.append(('EXISTS', int(exists[-1])))
+    return events
+
+@shared_resource
+def get_mailbox_watcher():
+    return MailboxWatcher()
+
+def get_first_email_by_subject(mail, subject, use_uid=False, match="substring"):
+    """Pobiera ID (albo UID przy use_uid) pierwszego maila o danym temacie"""
     try:
-        _, search_data = mail.search(None, f'SUBJECT "{subject}"')
-        email_ids = search_data[0].split()
+        if use_uid:
+            email_ids = find_uids_by_subject(mail, subject, match=match, limit=1)
+        else:
+            email_ids = search_by_subject(mail, subject)
         
         if email_ids:
             return email_ids[0]
         return None
     except Exception as e:
-        logger.error(f"Error searching emails: {e}")
+        logger.error("Error searching emails: %s", e)
         return None
 
-def process_email(email_id, mail, should_click_links=True):
-    """Przetwarzanie pojedynczego maila z opcjonalnym klikaniem linków"""
-    try:
-        _, msg_data = mail.fetch(email_id, '(RFC822)')
-        email_body = msg_data[0][1]
-        email_message = email.message_from_bytes(email_body)
-        
-        subject = decode_header(email_message["Subject"])[0][0]
-        if isinstance(subject, bytes):
-            subject = subject.decode('utf-8', errors='replace')
+def format_uid_set(uids):
+    """Zamienia listę UID na zwięzły zbiór sekwencji IMAP, np. 101:150,153"""
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+# Tokeny odpowiedzi IMAP: nawiasy, napisy w cudzysłowie, literały {n} i atomy
+# (atom może zawierać sekcję w nawiasach kwadratowych, np. BODY[HEADER.FIELDS (SUBJECT)]<0>)
+_IMAP_TOKEN_PATTERN = re.compile(
+    rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|\{(?P<literal>\d+)\}\s*$'
+    rb'|(?P<atom>[^\s()"\[\]{]+(?:\[[^\]]*\](?:<\d+(?:\.\d+)?>)?)?))'
+)
+
+def _tokenize_imap_chunks(msg_data):
+    """Zamienia odpowiedź imaplib (bajty i krotki z literałami) na płaską listę tokenów"""
+    tokens = []
+    for item in msg_data:
+        if item is None:
+            continue
+        if isinstance(item, tuple):
+            text, literal = item
+        else:
+            text, literal = item, None
+        position = 0
+        while position < len(text):
+            match = _IMAP_TOKEN_PATTERN.match(text, position)
+            if not match or match.end() == position:
+                break
+            position = match.end()
+            if match.group('open'):
+                tokens.append('(')
+            elif match.group('close'):
+                tokens.append(')')
+            elif match.group('quoted') is not None:
+                tokens.append(re.sub(rb'\\(.)', rb'\1', match.group('quoted')))
+            elif match.group('atom'):
+                atom = match.group('atom').decode('utf-8', errors='replace')
+                tokens.append(None if atom.upper() == 'NIL' else atom)
+        if literal is not None:
+            tokens.append(literal)
+    return tokens
+
+def parse_imap_response(msg_data):
+    """Parsuje odpowiedź IMAP do zagnieżdżonych list.
+
+    Atomy są zwracane jako str, napisy i literały jako bytes, a NIL jako None.
+    """
+    root = []
+    stack = [root]
+    for token in _tokenize_imap_chunks(msg_data):
+        if isinstance(token, str) and token == '(':
+            stack.append([])
+        elif isinstance(token, str) and token == ')':
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        else:
+            stack[-1].append(token)
+    while len(stack) > 1:
+        finished = stack.pop()
+        stack[-1].append(finished)
+    return root
+
+def _normalize_fetch_item(name):
+    # BODY.PEEK[1]<0> w żądaniu wraca jako BODY[1]<0> - porównujemy bez PEEK i zakresu
+    name = name.upper().replace('.PEEK', '')
+    return re.sub(r'<\d+(?:\.\d+)?>$', '', name)
+
+def parse_fetch_response(msg_data):
+    """Zwraca listę słowników {element: wartość} dla każdej wiadomości z odpowiedzi FETCH"""
+    messages = []
+    for node in parse_imap_response(msg_data):
+        if not isinstance(node, list):
+            continue
+        fields = {}
+        for name, value in zip(node[::2], node[1::2]):
+            if isinstance(name, str):
+                fields[_normalize_fetch_item(name)] = value
+        messages.append(fields)
+    return messages
+
+def _as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return value
+
+BodyPart = namedtuple('BodyPart', ['section', 'content_type', 'params', 'content_id', 'encoding', 'size', 'disposition'])
+
+def parse_bodystructure(structure, section=''):
+    """Spłaszcza BODYSTRUCTURE do listy liści BodyPart z numerami sekcji IMAP"""
+    if structure and isinstance(structure[0], list):
+        parts = []
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            parts.extend(parse_bodystructure(child, f"{section}.{number}" if section else str(number)))
+        return parts
+
+    fields = [_as_text(value) if not isinstance(value, list) else value for value in structure]
+    main_type = (fields[0] or 'text').lower()
+    sub_type = (fields[1] or 'plain').lower()
+    raw_params = structure[2] if isinstance(structure[2], list) else []
+    params = {_as_text(k).lower(): _as_text(v) for k, v in zip(raw_params[::2], raw_params[1::2])}
+    content_id = fields[3].strip('<>') if fields[3] else None
+    encoding = (fields[5] or '7bit').lower()
+    size = int(fields[6]) if fields[6] and str(fields[6]).isdigit() else 0
+
+    # Indeks pola disposition zależy od typu części (RFC 3501, body-ext-1part)
+    if main_type == 'text':
+        disposition_index = 9
+    elif main_type == 'message' and sub_type == 'rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = None
+    if len(structure) > disposition_index and isinstance(structure[disposition_index], list) and structure[disposition_index]:
+        disposition = _as_text(structure[disposition_index][0]).lower()
+
+    return [BodyPart(section or '1', f"{main_type}/{sub_type}", params, content_id, encoding, size, disposition)]
+
+_CID_REFERENCE_PATTERN = re.compile(r'cid:([^"\'\s)>]+)', re.IGNORECASE)
+
+def _response_bytes(msg_data):
+    """Przybliżona liczba bajtów odpowiedzi FETCH (linie i literały)"""
+    total = 0
+    for item in msg_data or []:
+        if isinstance(item, tuple):
+            total += sum(len(chunk) for chunk in item if isinstance(chunk, bytes))
+        elif isinstance(item, bytes):
+            total += len(item)
+    return total
+
+def _fetch_items(mail, email_id, items, use_uid=False):
+    query = '(' + ' '.join(items) + ')'
+    with span("imap_fetch") as timer:
+        if use_uid:
+            _, msg_data = mail.uid('FETCH', email_id, query)
+        else:
+            _, msg_data = mail.fetch(email_id, query)
+        timer.bytes = _response_bytes(msg_data)
+    messages = parse_fetch_response(msg_data)
+    return messages[0] if messages else {}
+
+def _strip_content_headers(header_bytes):
+    """Usuwa z nagłówka wiadomości pola Content-Type i Content-Transfer-Encoding (z kontynuacjami)"""
+    kept = []
+    skipping = False
+    for line in header_bytes.splitlines(keepends=True):
+        if not line.strip():
+            break
+        if line[:1] in (b' ', b'\t'):
+            if not skipping:
+                kept.append(line)
+            continue
+        name = line.split(b':', 1)[0].strip().lower()
+        skipping = name in (b'content-type', b'content-transfer-encoding')
+        if not skipping:
+            kept.append(line)
+    return b''.join(kept)
+
+def _assemble_partial_message(header_bytes, part_chunks):
+    """Składa z pobranych sekcji wiadomość multipart/mixed zawierającą tylko potrzebne części"""
+    boundary = f"=_partial_{random.getrandbits(64):016x}".encode()
+    chunks = [_strip_content_headers(header_bytes)]
+    chunks.append(b'MIME-Version: 1.0\r\nContent-Type: multipart/mixed; boundary="' + boundary + b'"\r\n\r\n')
+    for mime_headers, body in part_chunks:
+        chunks.append(b'--' + boundary + b'\r\n')
+        chunks.append(mime_headers.rstrip(b'\r\n') + b'\r\n\r\n')
+        chunks.append(body)
+        chunks.append(b'\r\n')
+    chunks.append(b'--' + boundary + b'--\r\n')
+    return b''.join(chunks)
+
+def _is_attachment(part):
+    return part.disposition == 'attachment'
+
+def fetch_partial_email(mail, email_id, use_uid=False, structure=None, full_size=0, max_part_bytes=None):
+    """Pobiera tylko te części maila, które są renderowane.
+
+    Najpierw (jeśli nie podano) pobierany jest BODYSTRUCTURE, potem nagłówki
+    i części text/html oraz text/plain (BODY.PEEK[<sekcja>], opcjonalnie
+    obcięte do max_part_bytes), a na końcu tylko obrazy, do których HTML
+    odwołuje się przez cid:. Zwraca (bajty wiadomości, info).
+    """
+    if structure is None:
+        fields = _fetch_items(mail, email_id, ['BODYSTRUCTURE', 'RFC822.SIZE'], use_uid)
+        structure = fields.get('BODYSTRUCTURE')
+        full_size = int(fields.get('RFC822.SIZE') or 0)
+    info = {'size': full_size, 'fetched_bytes': 0, 'parts': [], 'skipped_parts': []}
+
+    if not structure or not isinstance(structure[0], list):
+        # Wiadomość jednoczęściowa - nie ma czego pomijać
+        fields = _fetch_items(mail, email_id, ['BODY.PEEK[]'], use_uid)
+        email_body = fields.get('BODY[]') or b''
+        info['fetched_bytes'] = len(email_body)
+        return email_body, info
+
+    parts = parse_bodystructure(structure)
+    text_parts = [p for p in parts if p.content_type in ('text/html', 'text/plain') and not _is_attachment(p)]
+
+    range_suffix = f"<0.{max_part_bytes}>" if max_part_bytes else ''
+    items = ['BODY.PEEK[HEADER]']
+    for part in text_parts:
+        items.append(f"BODY.PEEK[{part.section}.MIME]")
+        items.append(f"BODY.PEEK[{part.section}]{range_suffix}")
+    fields = _fetch_items(mail, email_id, items, use_uid)
+
+    header_bytes = fields.get('BODY[HEADER]') or b''
+    part_chunks = []
+    referenced_cids = set()
+    for part in text_parts:
+        mime_headers = fields.get(f"BODY[{part.section}.MIME]") or b''
+        body = fields.get(f"BODY[{part.section}]") or b''
+        part_chunks.append((mime_headers, body))
+        if part.content_type == 'text/html':
+            html_bytes = email.message_from_bytes(mime_headers + b'\r\n' + body).get_payload(decode=True) or b''
+            referenced_cids.update(_CID_REFERENCE_PATTERN.findall(html_bytes.decode('latin-1')))
+
+    image_parts = [p for p in parts if p.content_id and p.content_id in referenced_cids and p not in text_parts]
+    if image_parts:
+        items = []
+        for part in image_parts:
+            items.append(f"BODY.PEEK[{part.section}.MIME]")
+            items.append(f"BODY.PEEK[{part.section}]")
+        fields = _fetch_items(mail, email_id, items, use_uid)
+        for part in image_parts:
+            part_chunks.append((fields.get(f"BODY[{part.section}.MIME]") or b'', fields.get(f"BODY[{part.section}]") or b''))
+
+    selected = text_parts + image_parts
+    info['parts'] = [p.section for p in selected]
+    info['skipped_parts'] = [p for p in parts if p not in selected]
+    email_body = _assemble_partial_message(header_bytes, part_chunks)
+    info['fetched_bytes'] = len(email_body)
+    logger.debug("Partial fetch of %s: %s of %s parts, %s of %s bytes", email_id, len(selected), len(parts), info['fetched_bytes'], full_size or '?')
+    return email_body, info
+
+def parse_uid_fetch_response(msg_data, item='RFC822'):
+    """Zamienia odpowiedź UID FETCH na słownik {uid: wartość elementu}"""
+    messages = {}
+    for fields in parse_fetch_response(msg_data):
+        if fields.get('UID') and item in fields:
+            messages[fields['UID'].encode()] = fields[item]
+    return messages
+
+def fetch_emails_by_uid(mail, uids):
+    """Pobiera treść wielu maili jednym poleceniem UID FETCH"""
+    with span("imap_fetch") as timer:
+        _, msg_data = mail.uid('FETCH', format_uid_set(uids), '(UID RFC822)')
+        timer.bytes = _response_bytes(msg_data)
+    return parse_uid_fetch_response(msg_data)
+
+def iter_emails_by_uid(mail, uids, batch_size=UID_FETCH_BATCH_SIZE, partial=False):
+    """Zwraca kolejne pary (uid, treść maila), pobierając je paczkami po batch_size
+
+    W trybie partial jedną komendą pobierany jest BODYSTRUCTURE całej paczki,
+    a potem dla każdego maila tylko potrzebne sekcje. Oddany mail nie jest
+    dalej trzymany przez paczkę, więc pamięć zwalnia się mail po mailu.
+    """
+    for start in range(0, len(uids), batch_size):
+        batch = uids[start:start + batch_size]
+        if partial:
+            with span("imap_fetch") as timer:
+                _, msg_data = mail.uid('FETCH', format_uid_set(batch), '(UID RFC822.SIZE BODYSTRUCTURE)')
+                timer.bytes = _response_bytes(msg_data)
+            fetched = {}
+            for fields in parse_fetch_response(msg_data):
+                if fields.get('UID'):
+                    fetched[fields['UID'].encode()] = fields
+        else:
+            fetched = fetch_emails_by_uid(mail, batch)
+        logger.debug("Fetched %s of %s emails in UID batch %s", len(fetched), len(batch), format_uid_set(batch))
+        for uid in batch:
+            if uid not in fetched:
+                logger.warning("Email UID %s disappeared before fetch", uid.decode())
+            elif partial:
+                fields = fetched.pop(uid)
+                yield uid, fetch_partial_email(
+                    mail, uid, use_uid=True,
+                    structure=fields.get('BODYSTRUCTURE'),
+                    full_size=int(fields.get('RFC822.SIZE') or 0)
+                )[0]
+            else:
+                yield uid, fetched.pop(uid)
+
+class PrefetchStage:
+    """Etap pobierania w osobnym wątku.
+
+    Kolejne pary (uid, treść) ze źródła trafiają do kolejki o pojemności
+    capacity, więc pobieranie następnych maili z IMAP nakłada się na
+    przetwarzanie bieżącego. imaplib nie jest bezpieczny wątkowo - każde
+    odwołanie do połączenia odbywa się pod lock, wspólnym z etapem usuwania.
+    """
+
+    _END = object()
+
+    def __init__(self, source, capacity, lock):
+        self.name = "Pobrane"
+        self.capacity = capacity
+        self.max_depth = 0
+        self._source = source
+        self._lock = lock
+        self._queue = queue.Queue(maxsize=capacity)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="imap-prefetch", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self.max_depth = max(self.max_depth, self._queue.qsize())
+            return True
+        return False
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    item = next(self._source, self._END)
+                if item is self._END or not self._put(item):
+                    break
+        except Exception as e:
+            logger.error("Error prefetching emails: %s", e)
+            self._put(e)
+            return
+        self._put(self._END)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is self._END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """Zatrzymuje wątek; czeka, aż odda połączenie (najwyżej bieżąca komenda)"""
+        self._stop.set()
+        self._thread.join()
+
+class AsyncDeleter:
+    """Etap usuwania w osobnym wątku.
+
+    add() tylko kolejkuje UID i od razu wraca, a wątek tła przekazuje je do
+    właściwego deletera (np. BatchedDeleter) pod wspólnym lockiem połączenia.
+    Nieudane usunięcia widać w failed_count po flush().
+    """
+
+    _STOP = object()
+
+    def __init__(self, deleter, lock, capacity):
+        self.name = "Do usunięcia"
+        self.deleter = deleter
+        self.capacity = capacity
+        self.max_depth = 0
+        self._lock = lock
+        self._queue = queue.Queue(maxsize=capacity)
+        self._thread = threading.Thread(target=self._run, name="imap-delete", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    @property
+    def failed_count(self):
+        return self.deleter.failed_count
+
+    def add(self, email_id):
+        self._queue.put(email_id)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def flush(self):
+        """Czeka na usunięcie wszystkiego, co już trafiło do kolejki"""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+        return True
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                return
+            try:
+                with self._lock:
+                    if isinstance(item, threading.Event):
+                        self.deleter.flush()
+                    else:
+                        self.deleter.add(item)
+            except Exception as e:
+                logger.error("Error in delete stage: %s", e)
+            finally:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+        self._queue.put(self._STOP)
+        self._thread.join()
+        return False
+
+class AnalysisStage:
+    """Zleca analizę treści do puli procesów z wyprzedzeniem lookahead maili.
+
+    Dzięki temu parsowanie kolejnych maili trwa na innych rdzeniach, gdy
+    bieżący czeka na obrazy, kliknięcie albo interwał. Zwraca krotki
+    (email_id, email_body, PoolTask z wynikiem analyze_email_bytes).
+    """
+
+    name = "Analiza"
+
+    def __init__(self, source, lookahead):
+        self.source = source
+        self.capacity = lookahead
+        self.max_depth = 0
+        self._pending = deque()
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def _submit(self, email_id, email_body):
+        import mail_worker
+        task = PoolTask(mail_worker.analyze_email, email_body) if email_body is not None else None
+        self._pending.append((email_id, email_body, task))
+        self.max_depth = max(self.max_depth, len(self._pending))
+
+    def __iter__(self):
+        source = iter(self.source)
+        for email_id, email_body in source:
+            self._submit(email_id, email_body)
+            if len(self._pending) > self.capacity:
+                yield self._pending.popleft()
+        while self._pending:
+            yield self._pending.popleft()
+
+    def close(self):
+        while self._pending:
+            _, _, task = self._pending.popleft()
+            if task is not None:
+                task.cancel()
+
+def iter_emails_by_search(mail, subject, limit):
+    """Tryb klasyczny - przed każdym mailem ponownie wyszukuje pierwszy pasujący numer"""
+    for _ in range(limit):
+        email_id = get_first_email_by_subject(mail, subject)
+        if not email_id:
+            return
+        yield email_id, None
+
+def extract_email_content(email_message, sender_key=None):
+    """Temat, treść tekstowa i wybrana część HTML maila (z trackingiem, jeśli dostępna)"""
+    subject = decode_header(email_message["Subject"])[0][0]
+    if isinstance(subject, bytes):
+        subject = subject.decode('utf-8', errors='replace')
+    
+    content = ""
+    html_content = ""
+    html_parts = []
+    
+    # Zbierz wszystkie części HTML i sprawdź które zawierają linki trackingowe
+    for part in email_message.walk():
+        if part.get_content_type() == "text/plain":
+            content += decode_content(part, sender_key)
+        elif part.get_content_type() == "text/html":
+            decoded_html = decode_content(part, sender_key)
+            html_parts.append({
+                'content': decoded_html,
+                'tracking_links': TRACKING_LINKS.scan(decoded_html)
+            })
+    
+    # Wybierz najlepszą część HTML (z trackingiem jeśli dostępna)
+    if html_parts:
+        # Preferuj części z linkami do domen śledzących (TRACKING_DOMAINS)
+        tracking_parts = [p for p in html_parts if p['tracking_links']]
         
-        logger.debug(f"Processing email with subject: {subject}, click_links: {should_click_links}")
+        if tracking_parts:
+            # Wybierz część z największą liczbą linków trackingowych
+            best_part = max(tracking_parts, key=lambda x: len(x['tracking_links']))
+            html_content = best_part['content']
+            logger.debug("Using HTML part with %s tracking links", len(best_part['tracking_links']))
+        else:
+            # Jeśli żadna część nie ma linków trackingowych, użyj ostatniej
+            html_content = html_parts[-1]['content']
+            logger.debug("No tracking links found in any HTML part, using last part")
         
-        content = ""
-        html_content = ""
-        html_parts = []
+        logger.debug("Total HTML parts found: %s, parts with tracking: %s", len(html_parts), len(tracking_parts))
+    
+    return subject, content, html_content
+
+def process_email(email_id, mail, should_click_links=True, email_body=None, use_uid=False, deleter=None, partial=False, asset_store=None, use_process_pool=False, analysis=None):
+    """Przetwarzanie pojedynczego maila z opcjonalnym klikaniem linków
+
+    Z use_process_pool parsowanie MIME i przepisywanie HTML odbywa się we
+    wspólnej puli procesów (analysis może być już zleconą analizą - PoolTask
+    z wynikiem analyze_email_bytes), a w tym procesie zostaje tylko I/O.
+    """
+    try:
+        if email_body is None and partial:
+            email_body, _ = fetch_partial_email(mail, email_id, use_uid)
+        elif email_body is None:
+            with span("imap_fetch") as timer:
+                if use_uid:
+                    _, msg_data = mail.uid('FETCH', email_id, '(RFC822)')
+                else:
+                    _, msg_data = mail.fetch(email_id, '(RFC822)')
+                email_body = msg_data[0][1]
+                timer.bytes = len(email_body)
         
-        # Zbierz wszystkie części HTML i sprawdź które zawierają linki trackingowe
-        for part in email_message.walk():
-            if part.get_content_type() == "text/plain":
-                content += decode_content(part)
-            elif part.get_content_type() == "text/html":
-                decoded_html = decode_content(part)
-                html_parts.append({
-                    'content': decoded_html,
-                    'has_leadingmail': 'leadingmail.pl' in decoded_html.lower(),
-                    'leadingmail_count': decoded_html.lower().count('leadingmail.pl')
-                })
-        
-        # Wybierz najlepszą część HTML (z trackingiem jeśli dostępna)
-        links_clicked = 0
-        if html_parts:
-            # Preferuj części z linkami LeadingMail
-            tracking_parts = [p for p in html_parts if p['has_leadingmail']]
+        if use_process_pool:
+            import mail_worker
+            with span("process_pool_analyze") as timer:
+                timer.bytes = len(email_body)
+                if analysis is None:
+                    analysis = PoolTask(mail_worker.analyze_email, email_body)
+                analysis = analysis.result()
+            subject = analysis['subject']
+            logger.debug("Processing email with subject: %s, click_links: %s", subject, should_click_links)
+            final_content, links_clicked = render_analyzed_email(analysis, should_click_links, asset_store)
+        else:
+            with span("mime_parse") as timer:
+                timer.bytes = len(email_body)
+                email_message = email.message_from_bytes(email_body)
+            cid_index = ContentIdIndex(email_message, asset_store)
+            sender_key = get_sender_key(email_message)
+            subject, content, html_content = extract_email_content(email_message, sender_key)
+            logger.debug("Processing email with subject: %s, click_links: %s", subject, should_click_links)
             
-            if tracking_parts:
-                # Wybierz część z największą liczbą linków trackingowych
-                best_part = max(tracking_parts, key=lambda x: x['leadingmail_count'])
-                html_content = best_part['content']
-                logger.debug(f"Using HTML part with {best_part['leadingmail_count']} LeadingMail links")
+            if html_content:
+                content = None  # tekst nie trafia do podglądu, gdy jest HTML
+                final_content, links_clicked = process_html_content(html_content, email_message, should_click_links, cid_index, asset_store)
             else:
-                # Jeśli żadna część nie ma linków trackingowych, użyj ostatniej
-                html_content = html_parts[-1]['content']
-                logger.debug("No LeadingMail links found in any HTML part, using last part")
-            
-            logger.debug(f"Total HTML parts found: {len(html_parts)}, parts with tracking: {len(tracking_parts)}")
-        
-        if html_content:
-            final_content, links_clicked = process_html_content(html_content, email_message, should_click_links)
-        else:
-            final_content = content
-            links_clicked = 0
+                final_content = content
+                links_clicked = 0
         
         # Usuń wiadomość po przetworzeniu
-        delete_success = delete_email(mail, email_id)
+        if deleter is not None:
+            delete_success = deleter.add(email_id)
+        else:
+            delete_success = delete_email(mail, email_id, use_uid)
         
         if delete_success:
-            logger.debug(f"Email processed and deleted successfully")
+            logger.debug("Email processed and deleted successfully")
         else:
-            logger.warning(f"Email processed but deletion failed")
+            logger.warning("Email processed but deletion failed")
             
         return subject, final_content, delete_success, links_clicked
+    except BrokenProcessPool as e:
+        # Pula padła też przy ponowieniu (PoolTask) - ten mail jest błędem, kolejne dostaną nową pulę
+        logger.error("Process pool broken twice while processing email: %s", e)
+        return None, None, False, 0
     except Exception as e:
-        logger.error(f"Error processing email: {e}")
+        logger.error("Error processing email: %s", e)
         return None, None, False, 0
 
-def open_emails_by_subject(subject, count=None, interval=10, click_percentage=100):
-    """Otwieranie maili z kontrolą procentu klikanych linków"""
-    try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-        mail.select("inbox")
+EmailResult = namedtuple('EmailResult', ['number', 'email_id', 'subject', 'status', 'clicked', 'deleted', 'size', 'fetch_time', 'process_time'])
+
+RESULT_STATUSES = {
+    "clicked": "✅ Kliknięto losowy link",
+    "no_links": "⚠️ Planowano kliknięcie, ale nie znaleziono linków",
+    "opened": "📧 Tylko otwarty",
+    "error": "❌ Błąd",
+}
+
+class RunResults:
+    """Wyniki przebiegu: zwięzły wiersz na mail plus ograniczona pamięć podglądów.
+
+    Wiersze są lekkie i trzymane dla całego przebiegu, a przetworzony HTML
+    tylko dla ostatnich preview_keep maili - starsze podglądy są zwalniane.
+    Ze spill_dir podglądy wszystkich maili są zapisywane w osobnym katalogu
+    przebiegu, a w pamięci zostają tylko ścieżki; close() usuwa pliki.
+    Z asset_store obrazy zachowanych podglądów są chronione przed usunięciem
+    z magazynu do chwili zwolnienia podglądu.
+    """
+
+    def __init__(self, subject, preview_keep=RESULTS_PREVIEW_KEEP, spill_dir=None, asset_store=None):
+        self.subject = subject
+        self.preview_keep = preview_keep
+        self.rows = []
+        self._previews = OrderedDict()
+        self._asset_store = asset_store
+        self._assets = {}
+        self._lock = threading.Lock()
+        self._spill_dir = None
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._spill_dir = tempfile.mkdtemp(prefix="run-", dir=spill_dir)
+
+    def add(self, result, html=None):
+        keep = html is not None and (self._spill_dir or self.preview_keep > 0)
+        assets = self._asset_store.retain(html) if keep and self._asset_store is not None else None
+        if html is not None and self._spill_dir:
+            path = os.path.join(self._spill_dir, f"{result.number}.html")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(html)
+            html = path
+        with self._lock:
+            self.rows.append(result)
+            if assets:
+                self._assets[result.number] = assets
+            if html is not None and self._spill_dir:
+                self._previews[result.number] = html
+            elif html is not None and self.preview_keep > 0:
+                self._previews[result.number] = html
+                while len(self._previews) > self.preview_keep:
+                    number, _ = self._previews.popitem(last=False)
+                    self._release_assets(number)
+
+    def _release_assets(self, number):
+        names = self._assets.pop(number, None)
+        if names:
+            self._asset_store.release(names)
+
+    def preview(self, number):
+        with self._lock:
+            value = self._previews.get(number)
+        if value is None or not self._spill_dir:
+            return value
+        try:
+            with open(value, encoding='utf-8') as f:
+                return f.read()
+        except OSError as e:
+            logger.warning("Could not read preview %s: %s", value, e)
+            return None
+
+    def trim(self, keep):
+        """Zostawia w pamięci tylko keep ostatnich podglądów (pliki ze spill_dir zostają)"""
+        if self._spill_dir:
+            return
+        with self._lock:
+            while len(self._previews) > keep:
+                number, _ = self._previews.popitem(last=False)
+                self._release_assets(number)
+
+    def close(self):
+        with self._lock:
+            self._previews.clear()
+            for number in list(self._assets):
+                self._release_assets(number)
+        if self._spill_dir:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+
+    def preview_numbers(self):
+        with self._lock:
+            return list(self._previews)
+
+    def count(self, status=None):
+        with self._lock:
+            if status is None:
+                return len(self.rows)
+            return sum(1 for row in self.rows if row.status == status)
+
+    def table(self, last=None):
+        """Wiersze do st.dataframe (najnowsze na górze)"""
+        with self._lock:
+            rows = self.rows[-last:] if last else list(self.rows)
+        return [
+            {
+                "Nr": row.number,
+                "Temat": row.subject or "",
+                "Status": RESULT_STATUSES.get(row.status, row.status),
+                "Kliknięto": row.clicked,
+                "Usunięto": row.deleted,
+                "Rozmiar (KB)": round(row.size / 1024, 1) if row.size is not None else None,
+                "Pobieranie (ms)": round(row.fetch_time * 1000),
+                "Przetwarzanie (ms)": round(row.process_time * 1000),
+            }
+            for row in reversed(rows)
+        ]
+
+class JobCancelled(Exception):
+    pass
+
+JOB_STATES = {
+    "queued": "W kolejce",
+    "running": "W toku",
+    "paused": "Wstrzymane",
+    "done": "Zakończone",
+    "cancelled": "Anulowane",
+    "failed": "Błąd",
+}
+
+class Job:
+    """Stan zadania w tle współdzielony między wątkiem roboczym a UI.
+
+    Wątek roboczy publikuje postęp przez update()/warn() i w bezpiecznych
+    miejscach wywołuje checkpoint() albo sleep() - tam zadanie zatrzymuje się
+    po pause() i kończy wyjątkiem JobCancelled po cancel(). UI czyta tylko
+    snapshot().
+    """
+
+    ACTIVE_STATES = ("queued", "running", "paused")
+
+    def __init__(self, job_id=0, title=""):
+        self.id = job_id
+        self.title = title
+        self.results = None
+        self.created_at = time.time()
+        self._lock = threading.Lock()
+        self._state = "queued"
+        self._done = 0
+        self._total = 0
+        self._message = ""
+        self._warnings = []
+        self._queues = {}
+        self._transfer = None
+        self._error = None
+        self._started_at = None
+        self._finished_at = None
+        self._resume = threading.Event()
+        self._resume.set()
+        self._cancel = threading.Event()
+
+    def update(self, done=None, total=None, message=None, queues=None, transfer=None):
+        with self._lock:
+            if queues is not None:
+                self._queues = queues
+            if transfer is not None:
+                self._transfer = transfer
+            if done is not None:
+                self._done = done
+            if total is not None:
+                self._total = total
+            if message is not None:
+                self._message = message
+
+    def warn(self, text):
+        with self._lock:
+            self._warnings.append(text)
+
+    def start(self):
+        """Wywoływane przez wątek roboczy; False, jeśli zadanie anulowano w kolejce"""
+        with self._lock:
+            if self._cancel.is_set():
+                self._state = "cancelled"
+                self._finished_at = time.time()
+                return False
+            self._state = "paused" if not self._resume.is_set() else "running"
+            self._started_at = time.time()
+            return True
+
+    def finish(self, state, error=None):
+        with self._lock:
+            self._state = state
+            self._error = error
+            self._finished_at = time.time()
+
+    def pause(self):
+        with self._lock:
+            if self._state in ("queued", "running"):
+                self._resume.clear()
+                if self._state == "running":
+                    self._state = "paused"
+
+    def resume(self):
+        with self._lock:
+            if self._state == "paused":
+                self._state = "running"
+            self._resume.set()
+
+    def cancel(self):
+        with self._lock:
+            if self._state in self.ACTIVE_STATES:
+                self._cancel.set()
+                # Wstrzymane zadanie musi się obudzić, żeby zauważyć anulowanie
+                self._resume.set()
+
+    @property
+    def active(self):
+        with self._lock:
+            return self._state in self.ACTIVE_STATES
+
+    def checkpoint(self):
+        """Blokuje, dopóki zadanie jest wstrzymane; rzuca JobCancelled po anulowaniu"""
+        self._resume.wait()
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def sleep(self, seconds):
+        """Przerywalne czekanie - pauza wydłuża je o czas wstrzymania"""
+        deadline = time.monotonic() + seconds
+        while True:
+            self.checkpoint()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if self._cancel.wait(min(remaining, 0.5)):
+                raise JobCancelled()
+            if not self._resume.is_set():
+                paused_at = time.monotonic()
+                self.checkpoint()
+                deadline += time.monotonic() - paused_at
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'title': self.title,
+                'state': self._state,
+                'done': self._done,
+                'total': self._total,
+                'message': self._message,
+                'warnings': list(self._warnings),
+                'queues': dict(self._queues),
+                'transfer': self._transfer,
+                'error': self._error,
+                'started_at': self._started_at,
+                'finished_at': self._finished_at,
+            }
+
+class JobRunner:
+    """Kolejka zadań w tle z globalnym limitem równoległości.
+
+    Jeden runner na proces (shared_resource), więc limit max_workers dotyczy
+    wszystkich sesji razem; nadmiarowe zadania czekają w kolejce executora.
+    Z zakończonych zadań pamiętanych jest najwyżej history najnowszych, a
+    każde trzyma w pamięci tylko RESULTS_LIVE_PREVIEWS podglądów - pamięć nie
+    rośnie z liczbą przebiegów.
+    """
+
+    def __init__(self, max_workers=JOB_CONCURRENCY, history=JOB_HISTORY):
+        self.max_workers = max_workers
+        self.history = history
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, title, func, *args, **kwargs):
+        """Kolejkuje func(*args, job=job, **kwargs) i od razu zwraca obiekt Job"""
+        with self._lock:
+            job = Job(next(self._ids), title)
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, other in self._jobs.items() if not other.active]
+            for job_id in finished[:max(0, len(finished) - self.history)]:
+                evicted = self._jobs.pop(job_id)
+                if evicted.results is not None:
+                    evicted.results.close()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        logger.info("Queued job %s: %s", job.id, title)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if not job.start():
+            logger.info("Job %s cancelled before start", job.id)
+            return
+        try:
+            func(*args, job=job, **kwargs)
+            job.finish("done")
+            logger.info("Job %s finished", job.id)
+        except JobCancelled:
+            job.finish("cancelled")
+            logger.info("Job %s cancelled", job.id)
+        except Exception as e:
+            job.finish("failed", str(e))
+            logger.error("Error in job %s: %s", job.id, e)
+        finally:
+            if job.results is not None:
+                job.results.trim(RESULTS_LIVE_PREVIEWS)
+            # Pliki dla dashboardów są aktualne po każdym przebiegu
+            try:
+                export_metrics()
+            except Exception as e:
+                logger.warning("Could not export metrics: %s", e)
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def counts(self):
+        with self._lock:
+            return Counter(job.snapshot()['state'] for job in self._jobs.values())
+
+@shared_resource
+def get_job_runner():
+    return JobRunner()
+
+def iter_open_emails(subject, count=None, interval=10, click_percentage=100, uid_mode=True, batch_size=UID_FETCH_BATCH_SIZE, delete_strategy="batched", partial=PARTIAL_FETCH, image_mode=PREVIEW_IMAGE_MODE, match="substring", use_process_pool=PROCESS_POOL_SIZE > 0, job=None):
+    """Otwieranie maili z kontrolą procentu klikanych linków - generator
+
+    Dla każdego maila zwraca (EmailResult, przetworzony HTML) i nie trzyma
+    niczego z poprzednich maili: treść, analiza i HTML są zwalniane przed
+    interwałem, więc pamięć nie rośnie z liczbą maili. Co zrobić z HTML
+    decyduje wywołujący (open_emails_by_subject zapisuje go w RunResults).
+    Przerwanie iteracji (close()) i tak usuwa już przetworzone maile.
+
+    W trybie UID lista maili pochodzi z lokalnego indeksu nagłówków (albo
+    jednego UID SEARCH, gdy indeks jest wyłączony), a treści są
+    pobierane paczkami (UID FETCH) zamiast wyszukiwania przed każdym mailem.
+    Strategia "batched" usuwa przetworzone maile paczkami po batch_size.
+    Przy partial pobierane są tylko części HTML/tekst i obrazy cid:.
+    W trybie obrazów "asset_store" HTML odwołuje się do plików z magazynu
+    zasobów zamiast osadzać je jako base64.
+    Z use_process_pool parsowanie i przepisywanie HTML trafia do puli
+    procesów (PROCESS_POOL_SIZE), w trybie UID z wyprzedzeniem.
+
+    Funkcja nie korzysta ze Streamlit. Postęp i ostrzeżenia są publikowane
+    przez job; pauza i anulowanie działają między mailami.
+    """
+    job = job or Job(title=subject)
+    with get_imap_pool().connection() as mail:
+        # Bajty przebiegu przed i po kompresji (połączenie z puli ma liczniki od otwarcia)
+        transfer_start = imap_transfer_stats(mail)
         
-        # Sprawdź ile maili o danym temacie jest dostępnych
-        _, search_data = mail.search(None, f'SUBJECT "{subject}"')
-        all_email_ids = search_data[0].split()
+        def run_transfer():
+            current = imap_transfer_stats(mail)
+            if current is None or transfer_start is None:
+                return None
+            return current[0] - transfer_start[0], current[1] - transfer_start[1]
         
+        mail.select("inbox")
+        job.update(message="Wyszukiwanie maili...")
+    
+        # Sprawdź ile maili o danym temacie jest dostępnych
+        with span("search"):
+            if uid_mode:
+                all_email_ids = find_uids_by_subject(mail, subject, match=match)
+            else:
+                all_email_ids = search_by_subject(mail, subject)
+    
         if not all_email_ids:
-            st.warning(f"Nie znaleziono maili o temacie '{subject}'")
-            mail.close()
-            mail.logout()
-            return []
-        
+            job.warn(f"Nie znaleziono maili o temacie '{subject}'")
+            job.update(message="Brak maili do otwarcia")
+            return
+    
         total_emails = len(all_email_ids)
         emails_to_process = min(count or total_emails, total_emails)
-        
+    
         # Wylosuj które maile będą miały kliknięte linki
         emails_to_click = int(emails_to_process * click_percentage / 100)
         click_indices = set(random.sample(range(emails_to_process), emails_to_click))
+    
+        logger.debug("Will click links in %s out of %s emails", emails_to_click, emails_to_process)
+        logger.debug("Click indices: %s", sorted(click_indices))
+    
+        if uid_mode:
+            email_source = iter_emails_by_uid(mail, all_email_ids[:emails_to_process], batch_size, partial)
+        else:
+            email_source = iter_emails_by_search(mail, subject, emails_to_process)
         
-        logger.debug(f"Will click links in {emails_to_click} out of {emails_to_process} emails")
-        logger.debug(f"Click indices: {sorted(click_indices)}")
+        # Usunięte maile od razu znikają z indeksu nagłówków
+        on_deleted = (lambda uids: get_header_index().remove("inbox", uids)) if uid_mode and USE_HEADER_INDEX else None
+        deleter = make_deleter(delete_strategy, mail, uid_mode, batch_size, on_deleted)
+        stages = []
+        if uid_mode and PIPELINE_PREFETCH > 0:
+            # Pobieranie, przetwarzanie i usuwanie nakładają się w czasie; treść
+            # jest zawsze pobrana z wyprzedzeniem, więc process_email nie używa połączenia
+            connection_lock = threading.RLock()
+            email_source = PrefetchStage(email_source, PIPELINE_PREFETCH, connection_lock)
+            deleter = AsyncDeleter(deleter, connection_lock, max(2 * batch_size, PIPELINE_PREFETCH))
+            stages = [email_source, deleter]
+        fetch_source = email_source
+        if use_process_pool and uid_mode:
+            email_source = AnalysisStage(email_source, PROCESS_POOL_SIZE or 1)
+            stages.insert(1, email_source)
+        asset_store = get_preview_asset_store() if image_mode == "asset_store" else None
         
-        processed_emails = []
         processed_count = 0
+        attempted_count = 0
         error_count = 0
         total_links_clicked = 0
-        
-        # Kontenery na wyświetlanie maili (będziemy je odwracać na końcu)
-        email_containers = []
-        
-        # Główny kontener na postęp
-        progress_container = st.container()
-        
-        with progress_container:
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
+    
+        # Przy anulowaniu wyjście z bloku zatrzymuje pobieranie i i tak usuwa maile z ostatniej paczki
+        with deleter, closing(fetch_source), closing(email_source):
             # Pokaż informację o ustawieniach klikania
             if click_percentage < 100:
-                status_text.text(f"Rozpoczynam przetwarzanie {emails_to_process} maili (linki kliknięte w {emails_to_click} mailach, {click_percentage}%)")
+                job.update(total=emails_to_process, message=f"Rozpoczynam przetwarzanie {emails_to_process} maili (linki kliknięte w {emails_to_click} mailach, {click_percentage}%)")
             else:
-                status_text.text(f"Rozpoczynam przetwarzanie {emails_to_process} maili (linki kliknięte we wszystkich)")
-            
-            for i in range(emails_to_process):
+                job.update(total=emails_to_process, message=f"Rozpoczynam przetwarzanie {emails_to_process} maili (linki kliknięte we wszystkich)")
+        
+            fetch_started = time.perf_counter()
+            for i, (email_id, email_body, *analysis) in enumerate(email_source):
+                fetch_time = time.perf_counter() - fetch_started
+                job.checkpoint()
+                attempted_count += 1
                 # Sprawdź czy w tym mailu mają być kliknięte linki
                 should_click = i in click_indices
-                
-                # Pobierz pierwszy dostępny mail o podanym temacie
-                email_id = get_first_email_by_subject(mail, subject)
-                
-                if not email_id:
-                    status_text.text(f"Nie znaleziono więcej maili o temacie '{subject}'")
-                    break
-                
-                # Aktualizacja paska postępu
-                progress = (i + 1) / emails_to_process
-                progress_bar.progress(progress)
+            
                 action_text = "z klikaniem linków" if should_click else "bez klikania linków"
-                status_text.text(f"Przetwarzanie maila {i+1} z {emails_to_process} ({action_text})")
-                
-                # Dodaj nowy kontener dla maila (będzie na początku listy)
-                email_container = st.container()
-                email_containers.insert(0, email_container)
-                
+                job.update(message=f"Przetwarzanie maila {i+1} z {emails_to_process} ({action_text})")
+            
                 # Przetwórz mail
-                mail_subject, mail_content, delete_success, links_clicked = process_email(email_id, mail, should_click)
-                
+                process_started = time.perf_counter()
+                mail_subject, mail_content, delete_success, links_clicked = process_email(email_id, mail, should_click, email_body, uid_mode, deleter, partial, asset_store, use_process_pool, *analysis)
+                process_time = time.perf_counter() - process_started
+                size = len(email_body) if email_body is not None else None
+                metrics = get_metrics()
+                metrics.record("fetch_wait", fetch_time)
+                metrics.record("process_email", process_time, size or 0)
+            
                 if mail_subject and mail_content:
-                    processed_emails.append((mail_subject, mail_content))
                     processed_count += 1
                     total_links_clicked += links_clicked
-                    
-                    # Aktualizujemy wyświetlanie maila
-                    with email_container:
-                        # Dodaj wskaźnik czy link został kliknięty
-                        if should_click and links_clicked > 0:
-                            st.subheader(f"Email {i+1}: {mail_subject} ✅ Kliknięto losowy link")
-                        elif should_click and links_clicked == 0:
-                            st.subheader(f"Email {i+1}: {mail_subject} ⚠️ Planowano kliknięcie, ale nie znaleziono linków")
-                        else:
-                            st.subheader(f"Email {i+1}: {mail_subject} 📧 Tylko otwarty")
-                        
-                        st.components.v1.html(mail_content, height=400, scrolling=True)
-                        if not delete_success:
-                            st.warning("Email został otwarty, ale nie udało się go usunąć")
-                        st.divider()
+                    if should_click and links_clicked > 0:
+                        status = "clicked"
+                    elif should_click:
+                        status = "no_links"
+                    else:
+                        status = "opened"
+                    yield EmailResult(i + 1, email_id, mail_subject, status, links_clicked > 0, delete_success, size, fetch_time, process_time), mail_content
                 else:
                     error_count += 1
-                    with email_container:
-                        st.error(f"Błąd podczas przetwarzania maila {i+1}")
-                        st.divider()
-                
+                    yield EmailResult(i + 1, email_id, None, "error", False, False, size, fetch_time, process_time), None
+                # Nic z tego maila nie czeka w pamięci na interwał
+                email_body = analysis = mail_content = None
+                job.update(done=i + 1, queues={stage.name: (stage.depth, stage.capacity, stage.max_depth) for stage in stages}, transfer=run_transfer())
+            
                 # Losowa wartość interwału (±50%)
                 if i < emails_to_process - 1:  # Nie czekaj po ostatnim mailu
                     random_interval = interval * (0.5 + random.random())
-                    status_text.text(f"Czekam {random_interval:.2f}s przed kolejnym mailem...")
-                    time.sleep(random_interval)
+                    job.update(message=f"Czekam {random_interval:.2f}s przed kolejnym mailem...")
+                    job.sleep(random_interval)
+                fetch_started = time.perf_counter()
+        
+            if attempted_count < emails_to_process:
+                job.warn(f"Nie znaleziono więcej maili o temacie '{subject}'")
             
+            # Usuń pozostałe maile z ostatniej paczki
+            deleter.flush()
+            if deleter.failed_count:
+                job.warn(f"Nie udało się usunąć {deleter.failed_count} przetworzonych maili")
+        
             # Końcowa informacja o statusie
             if error_count > 0:
-                status_text.text(f"Zakończono: przetworzono {processed_count} maili, błędy: {error_count}, kliknięto linki łącznie: {total_links_clicked}")
+                job.update(message=f"Zakończono: przetworzono {processed_count} maili, błędy: {error_count}, kliknięto linki łącznie: {total_links_clicked}")
             else:
-                status_text.text(f"Zakończono przetwarzanie {processed_count} maili, kliknięto linki łącznie: {total_links_clicked}")
-        
-        mail.close()
-        mail.logout()
+                job.update(message=f"Zakończono przetwarzanie {processed_count} maili, kliknięto linki łącznie: {total_links_clicked}")
             
-        return processed_emails
-    except Exception as e:
-        st.error(f"Wystąpił błąd podczas otwierania maili: {e}")
-        logger.error(f"Error in open_emails_by_subject: {e}")
-        return []
+            transfer = run_transfer()
+            if transfer is not None:
+                job.update(transfer=transfer)
+                logger.info("IMAP transfer of run %r: %s bytes on the wire for %s bytes (saved %s)", subject, transfer[1], transfer[0], transfer[0] - transfer[1])
+
+def open_emails_by_subject(subject, count=None, interval=10, click_percentage=100, uid_mode=True, batch_size=UID_FETCH_BATCH_SIZE, delete_strategy="batched", partial=PARTIAL_FETCH, image_mode=PREVIEW_IMAGE_MODE, match="substring", use_process_pool=PROCESS_POOL_SIZE > 0, job=None):
+    """Przebieg iter_open_emails zbierany do RunResults
+
+    Uruchamiane jako zadanie w tle (JobRunner) - wyniki są widoczne w
+    job.results już w trakcie przebiegu. Podglądy trzyma RunResults (ostatnie
+    RESULTS_PREVIEW_KEEP w pamięci albo wszystkie w RESULTS_SPILL_DIR).
+    Zwraca RunResults (albo None, gdy nie było czego otwierać).
+    """
+    job = job or Job(title=subject)
+    results = None
+    for result, content in iter_open_emails(
+        subject, count, interval, click_percentage, uid_mode, batch_size, delete_strategy,
+        partial, image_mode, match, use_process_pool, job=job
+    ):
+        if results is None:
+            asset_store = get_preview_asset_store() if image_mode == "asset_store" else None
+            results = RunResults(subject, spill_dir=RESULTS_SPILL_DIR, asset_store=asset_store)
+            job.results = results
+        results.add(result, content)
+    return results
+
+def render_run_results(results, key="results"):
+    """Tabela wyników przebiegu i podglądy HTML tylko dla wybranych maili"""
+    st.subheader(f"Wyniki: {results.subject}")
+    summary = ", ".join(
+        f"{label}: {results.count(status)}" for status, label in RESULT_STATUSES.items() if results.count(status)
+    )
+    st.caption(f"Maili: {results.count()} ({summary})")
+    st.dataframe(results.table(), hide_index=True, use_container_width=True)
+    
+    available = results.preview_numbers()
+    if not available:
+        return
+    if len(available) < results.count() - results.count("error"):
+        st.caption(f"Podgląd dostępny dla ostatnich {len(available)} maili")
+    selected = st.multiselect(
+        "Pokaż podgląd maili",
+        list(reversed(available)),
+        max_selections=RESULTS_LIVE_PREVIEWS,
+        format_func=lambda number: f"{number}: {results.rows[number - 1].subject}",
+        key=f"{key}_previews",
+        help=f"Naraz renderowanych jest najwyżej {RESULTS_LIVE_PREVIEWS} podglądów"
+    )
+    for number in selected:
+        html_content = results.preview(number)
+        if html_content is None:
+            continue
+        row = results.rows[number - 1]
+        st.markdown(f"**Email {number}: {row.subject}** {RESULT_STATUSES[row.status]}")
+        st.components.v1.html(html_content, height=400, scrolling=True)
+        if not row.deleted:
+            st.warning("Email został otwarty, ale nie udało się go usunąć")
+
+def render_jobs(job_ids):
+    """Stan zadań sesji (najnowsze pierwsze); zwraca True, jeśli któreś jeszcze trwa"""
+    runner = get_job_runner()
+    jobs = [job for job in (runner.get(job_id) for job_id in job_ids) if job is not None]
+    if not jobs:
+        return False
+    
+    st.subheader("Zadania")
+    counts = runner.counts()
+    st.caption(f"Wszystkie sesje: w toku {counts['running'] + counts['paused']}, w kolejce {counts['queued']} (limit równoległych zadań: {runner.max_workers})")
+    
+    any_active = False
+    for position, job in enumerate(jobs):
+        info = job.snapshot()
+        active = info['state'] in Job.ACTIVE_STATES
+        any_active = any_active or active
+        label = f"#{info['id']} {info['title']} - {JOB_STATES[info['state']]}"
+        with st.expander(label, expanded=active or position == 0):
+            if info['total']:
+                st.progress(min(info['done'] / info['total'], 1.0), text=f"{info['done']} z {info['total']}")
+            if info['message']:
+                st.text(info['message'])
+            if info['queues']:
+                # Pełna kolejka "Pobrane" - wąskim gardłem jest przetwarzanie, pusta - IMAP
+                st.caption("Kolejki: " + ", ".join(
+                    f"{name} {depth}/{capacity} (maks. {peak})" for name, (depth, capacity, peak) in info['queues'].items()
+                ))
+            if info['transfer']:
+                st.caption(f"Transfer IMAP (COMPRESS=DEFLATE): {format_transfer(info['transfer'])}")
+            for warning in info['warnings']:
+                st.warning(warning)
+            if info['error']:
+                st.error(f"Wystąpił błąd podczas otwierania maili: {info['error']}")
+            
+            if active:
+                pause_col, cancel_col = st.columns(2)
+                with pause_col:
+                    if info['state'] == "paused":
+                        st.button("Wznów", key=f"job_{info['id']}_resume", on_click=job.resume)
+                    else:
+                        st.button("Wstrzymaj", key=f"job_{info['id']}_pause", on_click=job.pause)
+                with cancel_col:
+                    st.button("Anuluj", key=f"job_{info['id']}_cancel", on_click=job.cancel)
+                if job.results is not None:
+                    # W trakcie tylko ostatnie wiersze - podglądy po zakończeniu
+                    st.dataframe(job.results.table(last=10), hide_index=True, use_container_width=True)
+            elif job.results is not None:
+                render_run_results(job.results, key=f"job_{info['id']}")
+    return any_active
+
+def render_metrics_panel():
+    metrics = get_metrics()
+    snapshot = metrics.snapshot()
+    if not snapshot:
+        st.caption("Brak pomiarów - metryki pojawią się po pierwszym przebiegu")
+        return
+    st.caption(f"Od {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(metrics.started_at))}; percentyle z ostatnich {metrics.samples} pomiarów etapu")
+    st.dataframe(
+        [
+            {
+                "Etap": stage,
+                "Liczba": entry['count'],
+                "p50 (ms)": round(entry['p50'] * 1000, 1),
+                "p95 (ms)": round(entry['p95'] * 1000, 1),
+                "max (ms)": round(entry['max'] * 1000, 1),
+                "Suma (s)": round(entry['sum'], 2),
+                "Dane (KB)": round(entry['bytes'] / 1024, 1),
+            }
+            for stage, entry in snapshot.items()
+        ],
+        hide_index=True,
+        use_container_width=True
+    )
+    json_col, prom_col, export_col, reset_col = st.columns(4)
+    with json_col:
+        st.download_button("JSON", metrics_to_json(snapshot), file_name="metrics.json", mime="application/json")
+    with prom_col:
+        st.download_button("Prometheus", metrics_to_prometheus(snapshot), file_name="metrics.prom", mime="text/plain")
+    with export_col:
+        if st.button("Zapisz pliki"):
+            st.caption(f"Zapisano w {export_metrics()}")
+    with reset_col:
+        st.button("Wyczyść metryki", on_click=metrics.reset)
+
+def render_mailbox_watch(subject, match="substring"):
+    """Liczba maili o temacie z MailboxWatcher; zmiana względem początku obserwacji w tej sesji"""
+    watcher = get_mailbox_watcher()
+    watched = (subject, match)
+    previous = st.session_state.get('watched')
+    if previous and previous != watched:
+        watcher.unwatch(*previous)
+    st.session_state['watched'] = watched
+    email_count = watcher.watch(subject, match)
+    status = watcher.status()
+    
+    if email_count is None:
+        st.info("Wczytywanie listy maili skrzynki...")
+    else:
+        baseline = st.session_state.setdefault('watch_baseline', {}).setdefault(watched, email_count)
+        st.metric(f"Maile o temacie '{subject}' (na żywo)", email_count, delta=email_count - baseline)
+        st.session_state['email_count'] = email_count
+        st.session_state['subject'] = subject
+        st.session_state['subject_match'] = match
+    
+    if status['state'] == "error":
+        st.warning(f"Obserwacja przerwana, ponowne łączenie: {status['error']}")
+    elif status['updated_at']:
+        st.caption(
+            f"Tryb {status['mode'] or '-'}, maili w skrzynce: {status['messages']}, "
+            f"zaktualizowano {int(time.time() - status['updated_at'])} s temu"
+        )
 
-def debug_single_email(subject):
+def debug_single_email(subject, match="substring"):
     """Funkcja do debugowania pojedynczego maila"""
     try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-        mail.select("inbox")
-        
-        email_id = get_first_email_by_subject(mail, subject)
-        if email_id:
-            debug_info = debug_email_structure(email_id, mail)
-            return debug_info
-        else:
-            st.warning(f"Nie znaleziono maila o temacie '{subject}'")
-            return None
+        with get_imap_pool().connection() as mail:
+            mail.select("inbox")
+            
+            email_id = get_first_email_by_subject(mail, subject, use_uid=True, match=match)
+            if email_id:
+                debug_info = debug_email_structure(email_id, mail)
+                return debug_info
+            else:
+                st.warning(f"Nie znaleziono maila o temacie '{subject}'")
+                return None
             
     except Exception as e:
         st.error(f"Błąd podczas debugowania: {e}")
         return None
-    finally:
-        try:
-            mail.close()
-            mail.logout()
-        except:
-            pass
 
 def check_imap_connection():
     try:
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(EMAIL_ACCOUNT, EMAIL_PASSWORD)
-        mail.logout()
-        return True
+        status, _ = get_imap_pool().run(lambda mail: mail.noop())
+        return status == 'OK'
     except Exception as e:
-        logger.error(f"Error connecting to IMAP server: {e}")
+        logger.error("Error connecting to IMAP server: %s", e)
         return False
 
+class ConnectionHealth:
+    """Zapamiętany wynik sprawdzenia połączenia IMAP.
+
+    Przebieg skryptu dostaje ostatni znany stan od razu. Gdy jest starszy niż
+    ttl, odświeżenie startuje w wątku tła (najwyżej jedno naraz), więc
+    interakcje z widżetami nie logują się do serwera przy każdym przebiegu.
+    """
+
+    def __init__(self, check, ttl=60):
+        self._check = check
+        self.ttl = ttl
+        self.ok = None
+        self.checked_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            ok = self._check()
+            with self._lock:
+                self.ok = ok
+                self.checked_at = time.time()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def status(self):
+        """Zwraca ostatni znany stan; pierwszy raz sprawdza synchronicznie"""
+        if self.checked_at is None:
+            return self.recheck()
+        with self._lock:
+            stale = time.time() - self.checked_at > self.ttl
+            start_refresh = stale and not self._refreshing
+            if start_refresh:
+                self._refreshing = True
+        if start_refresh:
+            threading.Thread(target=self._refresh, name="imap-health", daemon=True).start()
+        return self.ok
+
+    def recheck(self):
+        """Sprawdza połączenie od razu (przycisk "Sprawdź ponownie")"""
+        ok = self._check()
+        with self._lock:
+            self.ok = ok
+            self.checked_at = time.time()
+        return ok
+
+@shared_resource
+def get_connection_health():
+    return ConnectionHealth(check_imap_connection, IMAP_HEALTH_TTL)
+
 def main():
     st.title("Otwieracz do maili")
     
-    # Sprawdź połączenie do serwera IMAP
-    connection_status = check_imap_connection()
+    # Stan połączenia z serwerem IMAP - z pamięci, odświeżany w tle
+    health = get_connection_health()
+    status_col, recheck_col = st.columns([4, 1])
+    with recheck_col:
+        if st.button("Sprawdź ponownie"):
+            with st.spinner("Sprawdzanie połączenia..."):
+                health.recheck()
+    connection_status = health.status()
+    checked_ago = int(time.time() - health.checked_at)
     
-    if not connection_status:
-        st.error(f"Nie udało się połączyć z serwerem IMAP ({IMAP_SERVER}:{IMAP_PORT}). Sprawdź ustawienia połączenia.")
-    else:
-        st.success(f"Połączono z serwerem IMAP: {EMAIL_ACCOUNT}")
+    with status_col:
+        if not connection_status:
+            st.error(f"Nie udało się połączyć z serwerem IMAP ({IMAP_SERVER}:{IMAP_PORT}). Sprawdź ustawienia połączenia. (sprawdzono {checked_ago} s temu)")
+        else:
+            st.success(f"Połączono z serwerem IMAP: {EMAIL_ACCOUNT} (sprawdzono {checked_ago} s temu)")
     
     subject_to_search = st.text_input("Podaj temat maila")
+    if USE_HEADER_INDEX:
+        subject_match = st.radio(
+            "Dopasowanie tematu",
+            list(SUBJECT_MATCH_MODES),
+            format_func=SUBJECT_MATCH_MODES.get,
+            horizontal=True,
+            help="Wyszukiwanie w lokalnym indeksie nagłówków (bez rozróżniania wielkości liter)"
+        )
+    else:
+        subject_match = "substring"
     
     # Dodaj przycisk do debugowania
     col1, col2 = st.columns(2)
@@ -600,10 +3971,11 @@ def main():
                 return
                 
             with st.spinner("Sprawdzanie liczby maili..."):
-                email_count = count_emails_by_subject(subject_to_search)
+                email_count = count_emails_by_subject(subject_to_search, match=subject_match)
                 
             st.session_state['email_count'] = email_count
             st.session_state['subject'] = subject_to_search
+            st.session_state['subject_match'] = subject_match
             
             if email_count > 0:
                 st.success(f"Znaleziono {email_count} maili o temacie '{subject_to_search}'")
@@ -617,7 +3989,24 @@ def main():
                 return
                 
             with st.spinner("Analizowanie struktury maila..."):
-                debug_single_email(subject_to_search)
+                debug_single_email(subject_to_search, match=subject_match)
+    
+    # Liczba maili na żywo - zamiast wielokrotnego "Sprawdź liczbę maili"
+    watching = st.checkbox(
+        "Obserwuj skrzynkę na żywo (IMAP IDLE)",
+        key="watch_mailbox",
+        disabled=not subject_to_search,
+        help="Osobne połączenie czeka na nowe i usunięte maile; pobierane są tylko nagłówki nowych maili, bez wyszukiwania"
+    )
+    if watching and subject_to_search:
+        render_mailbox_watch(subject_to_search, subject_match)
+    elif 'watched' in st.session_state:
+        get_mailbox_watcher().unwatch(*st.session_state.pop('watched'))
+        watching = False
+    
+    # Inspektor zostaje otwarty między przebiegami skryptu - części są rozwijane osobno
+    if 'inspection' in st.session_state:
+        render_email_inspector(st.session_state['inspection'])
     
     if 'email_count' in st.session_state and st.session_state['email_count'] > 0:
         st.subheader("Ustawienia otwierania")
@@ -656,26 +4045,103 @@ def main():
                             value=10,
                             help="Faktyczny interwał będzie losowy w zakresie ±50% podanej wartości")
         
+        with st.expander("Ustawienia zaawansowane", expanded=False):
+            uid_mode = st.checkbox(
+                "Tryb UID (jedno wyszukiwanie, pobieranie paczkami)",
+                value=True,
+                help="Lista maili pochodzi z indeksu nagłówków albo jednego UID SEARCH, a treści są pobierane paczkami przez UID FETCH"
+            )
+            batch_size = st.number_input(
+                "Rozmiar paczki UID FETCH",
+                min_value=1,
+                max_value=500,
+                value=UID_FETCH_BATCH_SIZE,
+                disabled=not uid_mode
+            )
+            delete_strategy = st.radio(
+                "Usuwanie przetworzonych maili",
+                list(DELETE_STRATEGIES),
+                format_func=DELETE_STRATEGIES.get,
+                disabled=not uid_mode,
+                help="Usuwanie paczkami wymaga trybu UID; bez niego maile są usuwane pojedynczo"
+            )
+            partial_fetch = st.checkbox(
+                "Pobieraj tylko renderowane części maila",
+                value=PARTIAL_FETCH,
+                help="Na podstawie BODYSTRUCTURE pobierany jest tylko HTML, tekst i obrazy cid: - bez załączników"
+            )
+            image_mode = st.radio(
+                "Obrazy w podglądzie",
+                ["inline", "asset_store"],
+                index=["inline", "asset_store"].index(PREVIEW_IMAGE_MODE),
+                format_func={"inline": "Osadzone w HTML (base64)", "asset_store": "Z lokalnego magazynu (bez duplikatów)"}.get,
+                help="Magazyn wymaga włączonego server.enableStaticServing w .streamlit/config.toml"
+            )
+            use_process_pool = st.checkbox(
+                "Parsowanie i przepisywanie HTML w puli procesów",
+                value=PROCESS_POOL_SIZE > 0,
+                disabled=PROCESS_POOL_SIZE == 0,
+                help=f"Praca CPU trafia do {PROCESS_POOL_SIZE} procesów roboczych; rozmiar puli ustawia PROCESS_POOL_SIZE w secrets (0 = wyłączona)"
+            )
+        
         if st.button("Zacznij otwierać maile"):
             if not connection_status:
                 st.error("Nie można otworzyć maili z powodu błędu połączenia z serwerem")
                 return
                 
-            with st.spinner("Otwieranie maili..."):
-                open_emails_by_subject(
-                    st.session_state['subject'], 
-                    count=email_count_to_open if open_all == "Tylko część" else None,
-                    interval=interval,
-                    click_percentage=click_percentage
-                )
+            job = get_job_runner().submit(
+                st.session_state['subject'],
+                open_emails_by_subject,
+                st.session_state['subject'],
+                count=email_count_to_open if open_all == "Tylko część" else None,
+                interval=interval,
+                click_percentage=click_percentage,
+                uid_mode=uid_mode,
+                batch_size=int(batch_size),
+                delete_strategy=delete_strategy,
+                partial=partial_fetch,
+                image_mode=image_mode,
+                match=st.session_state.get('subject_match', "substring"),
+                use_process_pool=use_process_pool
+            )
+            st.session_state.setdefault('job_ids', []).insert(0, job.id)
+    
+    # Zadania tej sesji - działają w tle, UI tylko odczytuje ich stan
+    jobs_active = render_jobs(st.session_state.get('job_ids', []))
+    
+    # Czasy etapów przetwarzania (wszystkie przebiegi od ostatniego wyczyszczenia)
+    with st.expander("Metryki etapów", expanded=False):
+        render_metrics_panel()
     
     # Wyświetlanie logów debugowania
     with st.expander("Logi debugowania", expanded=False):
-        log_contents = log_buffer.getvalue()
-        st.text_area("Logi", log_contents, height=300)
+        charset_stats = get_charset_cache().stats
+        if charset_stats:
+            st.caption("Wykrywanie kodowania: " + ", ".join(f"{tier}: {count}" for tier, count in sorted(charset_stats.items())))
+        image_cache_stats = get_image_cache().stats
+        if image_cache_stats:
+            st.caption("Pamięć obrazów: " + ", ".join(f"{kind}: {count}" for kind, count in sorted(image_cache_stats.items())))
+        filter_col, text_col, size_col = st.columns([2, 3, 1])
+        with filter_col:
+            min_level_name = st.selectbox("Poziom", ["DEBUG", "INFO", "WARNING", "ERROR"], key="log_level")
+        with text_col:
+            log_filter = st.text_input("Szukaj w logach", key="log_filter")
+        with size_col:
+            page_size = st.selectbox("Na stronę", [50, 100, 200], key="log_page_size")
+        
+        records = log_handler.records(logging.getLevelName(min_level_name), log_filter)
+        page_count = max(1, (len(records) + page_size - 1) // page_size)
+        page = st.number_input(f"Strona (z {page_count}, najnowsze pierwsze)", min_value=1, max_value=page_count, value=1, key="log_page")
+        page_records = records[(page - 1) * page_size:page * page_size]
+        st.code("\n".join(log_handler.format(record) for record in page_records) or "Brak wpisów", language='text')
+        st.caption(f"Wpisów: {len(records)}")
         if st.button("Wyczyść logi"):
-            log_buffer.truncate(0)
-            log_buffer.seek(0)
+            log_handler.clear()
+    
+    # Odpytywanie o postęp zadań w tle - każda interakcja i tak przerywa ten przebieg
+    if jobs_active or watching:
+        time.sleep(JOB_POLL_INTERVAL)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""Test wykrywania kodowania części bez zadeklarowanego charsetu.
+
+Pierwszy bajt spoza ASCII leży za próbką CHARSET_SAMPLE_SIZE (długi <head>
+ze stylami) - polskie znaki nie mogą zamienić się w U+FFFD, a 'ascii' nie
+może trafić do pamięci kodowań nadawcy.
+
+Uruchomienie: python test_charset.py  (albo python -m pytest test_charset.py)
+"""
+import os
+import sys
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from _app import import_app
+
+app = import_app(LOG_LEVEL="WARNING")
+
+POLISH_TEXT = "Zażółć gęślą jaźń - wyjątkowa oferta dla Ciebie! Sprawdź nowości w naszym sklepie. "
+
+def make_payload(charset):
+    head = "<html><head><style>" + "td{font-family:Arial}" * (app.CHARSET_SAMPLE_SIZE // 20) + "</style></head><body>"
+    payload = (head + POLISH_TEXT * 20 + "</body></html>").encode(charset)
+    assert payload.find(POLISH_TEXT.encode(charset)) > app.CHARSET_SAMPLE_SIZE
+    return payload
+
+def make_part(payload):
+    # Bez parametru charset w Content-Type - kodowanie trzeba wykryć
+    part = MIMEText("", "html")
+    del part["Content-Type"]
+    part["Content-Type"] = "text/html"
+    part.set_payload(payload)
+    return part
+
+def test_non_ascii_past_sample():
+    for charset in ("cp1250", "iso-8859-2"):
+        sender_key = f"<{charset}.newsletter.example.com>"
+        payload = make_payload(charset)
+        detected = app.detect_charset(payload, sender_key)
+        assert detected and detected.lower() != "ascii"
+        text = app.decode_content(make_part(payload), sender_key)
+        assert "�" not in text
+        # Bez utraty bajtów - jednobajtowe kodowanie odtwarza całą treść
+        assert text.encode(detected) == payload
+
+def test_ascii_not_memoized():
+    sender_key = "<ascii.newsletter.example.com>"
+    app.detect_charset(make_payload("cp1250"), sender_key)
+    assert (app.get_charset_cache().get(sender_key) or "").lower() != "ascii"
+
+def test_decoded_text_reused():
+    # Próby UTF-8 i kodowania nadawcy zwracają gotowy tekst - decode_content nie dekoduje drugi raz
+    sender_key = "<reuse.newsletter.example.com>"
+    assert app.detect_and_decode(POLISH_TEXT.encode("utf-8"), sender_key) == ("utf-8", POLISH_TEXT)
+    app.get_charset_cache().put(sender_key, "cp1250")
+    payload = POLISH_TEXT.encode("cp1250")
+    assert app.detect_and_decode(payload, sender_key) == ("cp1250", POLISH_TEXT)
+    assert app.decode_content(make_part(payload), sender_key) == POLISH_TEXT
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
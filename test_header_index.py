@@ -0,0 +1,139 @@
+"""Test synchronizacji lokalnego indeksu nagłówków z serwerem zastępczym.
+
+Maile kasowane innym połączeniem (inny klient poczty) i wpisy, których
+w indeksie brakuje, nie mogą przekłamać count() ani find() - także wtedy,
+gdy liczba maili w indeksie i na serwerze przypadkiem się zgadza. Zanim
+indeks powstanie (i gdy jest niedostępny), liczbę podaje ESEARCH z pamięcią
+wyników per stan skrzynki.
+
+Uruchomienie: python test_header_index.py  (albo python -m pytest test_header_index.py)
+"""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from _mailbox import SUBJECT_PREFIX, generate_mailbox
+from _servers import StandInHTTPServer, StandInIMAPServer
+
+imap_server = StandInIMAPServer().start()
+http_server = StandInHTTPServer().start()
+
+from _app import import_app
+
+workdir = tempfile.mkdtemp(prefix="mail-opener-test-")
+SETTINGS = dict(
+    IMAP_SERVER="127.0.0.1",
+    IMAP_PORT=imap_server.port,
+    IMAP_SSL=False,
+    LOG_LEVEL="WARNING",
+    USE_HEADER_INDEX=True,
+    IMAGE_CACHE_DIR=os.path.join(workdir, "images"),
+    HEADER_INDEX_PATH=os.path.join(workdir, "headers.sqlite3"),
+)
+app = import_app(**SETTINGS)
+
+def setup_module():
+    # Pliki testów zbierane razem (pytest) - ustawienia i serwery tego pliku na czas jego testów
+    import_app(**SETTINGS)
+
+MESSAGES = [raw for _, raw in generate_mailbox(8, http_server.base_url, seed=11, mix={"alternative": 1}, attachment_size=0)]
+
+def load_mailbox(count=6):
+    imap_server.mailbox.load(MESSAGES[:count])
+
+def expunge_externally(uids):
+    mail = app._connect_imap()
+    try:
+        mail.select("inbox")
+        mail.uid('STORE', app.format_uid_set(uids), '+FLAGS', '(\\Deleted)')
+        mail.expunge()
+    finally:
+        mail.logout()
+
+def live_uids():
+    return [message.uid for message in imap_server.mailbox.messages]
+
+def indexed_uids():
+    uids = app.get_imap_pool().run(lambda mail: app.find_uids_by_subject(mail, SUBJECT_PREFIX))
+    return [int(uid) for uid in uids]
+
+def test_deletes_offset_by_arrivals():
+    load_mailbox()
+    assert indexed_uids() == live_uids()
+    expunge_externally([2, 3])
+    for raw in MESSAGES[6:8]:
+        imap_server.mailbox.append(raw)
+    assert app.count_emails_by_subject(SUBJECT_PREFIX) == 6
+    assert indexed_uids() == live_uids()
+
+def test_missing_entry_offsets_delete():
+    load_mailbox()
+    assert indexed_uids() == live_uids()
+    # Wpis usunięty z indeksu, choć mail na serwerze został (np. nieudany EXPUNGE),
+    # i jeden mail skasowany poza aplikacją - liczby się zgadzają
+    app.get_header_index().remove("inbox", [4])
+    expunge_externally([5])
+    assert indexed_uids() == live_uids() == [1, 2, 3, 4, 6]
+    assert app.count_emails_by_subject(SUBJECT_PREFIX) == 5
+
+def test_missing_entry_restored():
+    load_mailbox()
+    assert indexed_uids() == live_uids()
+    app.get_header_index().remove("inbox", [2])
+    assert indexed_uids() == live_uids()
+
+class CountingESEARCH:
+    """Podmienia app.esearch_count i liczy wywołania"""
+
+    def __enter__(self):
+        self.calls = 0
+        self._original = app.esearch_count
+
+        def esearch_count(mail, subject):
+            self.calls += 1
+            return self._original(mail, subject)
+
+        app.esearch_count = esearch_count
+        return self
+
+    def __exit__(self, *exc_info):
+        app.esearch_count = self._original
+
+def test_cold_start_counts_with_esearch():
+    load_mailbox()
+    index = app.get_header_index()
+    with CountingESEARCH() as esearch:
+        assert app.count_emails_by_subject(SUBJECT_PREFIX) == 6
+        assert esearch.calls == 1
+        # Sam licznik nie pobiera nagłówków całej skrzynki
+        assert not index.built("inbox", imap_server.mailbox.uidvalidity)
+        # Stan skrzynki bez zmian - wynik z pamięci, bez wyszukiwania
+        assert app.count_emails_by_subject(SUBJECT_PREFIX) == 6
+        assert esearch.calls == 1
+        imap_server.mailbox.append(MESSAGES[6])
+        assert app.count_emails_by_subject(SUBJECT_PREFIX) == 7
+        assert esearch.calls == 2
+        # Po zbudowaniu indeksu (wyszukiwanie maili do otwarcia) liczy indeks
+        assert indexed_uids() == live_uids()
+        assert app.count_emails_by_subject(SUBJECT_PREFIX) == 7
+        assert app.count_emails_by_subject(SUBJECT_PREFIX, match="prefix") == 7
+        assert esearch.calls == 2
+
+def test_broken_index_falls_back_to_esearch():
+    load_mailbox()
+    assert indexed_uids() == live_uids()
+    app.get_header_index()._db.close()
+    try:
+        with CountingESEARCH() as esearch:
+            assert app.count_emails_by_subject(SUBJECT_PREFIX) == 6
+            assert esearch.calls == 1
+    finally:
+        app.get_header_index.clear()
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
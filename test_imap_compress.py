@@ -0,0 +1,120 @@
+"""Test COMPRESS=DEFLATE na lokalnym serwerze zastępczym (benchmarks/_servers.py).
+
+Te same operacje (FETCH całego maila i części, SEARCH, IDLE, usuwanie,
+cały przebieg open_emails_by_subject) na sesji bez kompresji i z nią.
+
+Uruchomienie: python test_imap_compress.py  (albo python -m pytest test_imap_compress.py)
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from _mailbox import SUBJECT_PREFIX, generate_mailbox
+from _servers import StandInHTTPServer, StandInIMAPServer
+
+imap_server = StandInIMAPServer().start()
+http_server = StandInHTTPServer().start()
+
+from _app import import_app
+
+workdir = tempfile.mkdtemp(prefix="mail-opener-test-")
+SETTINGS = dict(
+    IMAP_SERVER="127.0.0.1",
+    IMAP_PORT=imap_server.port,
+    IMAP_SSL=False,
+    LOG_LEVEL="WARNING",
+    IMAGE_CACHE_DIR=os.path.join(workdir, "images"),
+    HEADER_INDEX_PATH=os.path.join(workdir, "headers.sqlite3"),
+)
+app = import_app(**SETTINGS)
+
+def setup_module():
+    # Pliki testów zbierane razem (pytest) - ustawienia i serwery tego pliku na czas jego testów
+    import_app(**SETTINGS)
+
+def load_mailbox(count=6):
+    messages = generate_mailbox(count, http_server.base_url, seed=7, mix={"alternative": 1, "charsets": 1}, attachment_size=0)
+    imap_server.mailbox.load(raw for _, raw in messages)
+    return [raw for _, raw in messages]
+
+def connect(compress):
+    imap_server.compress = compress
+    mail = app._connect_imap()
+    mail.select("inbox")
+    return mail
+
+def check_session(compress):
+    raw_messages = load_mailbox()
+    mail = connect(compress)
+    try:
+        assert ('COMPRESS=DEFLATE' in mail.capabilities) == compress
+        assert (app.imap_transfer_stats(mail) is not None) == compress
+
+        uids = app.search_by_subject(mail, SUBJECT_PREFIX, use_uid=True)
+        assert len(uids) == len(raw_messages)
+        fetched = app.fetch_emails_by_uid(mail, uids)
+        assert [fetched[uid] for uid in uids] == raw_messages
+
+        email_body, info = app.fetch_partial_email(mail, uids[0], use_uid=True)
+        subject, _, html_content = app.extract_email_content(app.email.message_from_bytes(email_body))
+        assert subject.startswith(SUBJECT_PREFIX) and html_content
+
+        inspection = app.inspect_email(mail, uids[0])
+        html_part = next(part for part in inspection['parts'] if part.content_type == 'text/html')
+        counts, _, _ = app.search_part(mail, uids[0], html_part, chunk_size=1024)
+        assert counts['leadingmail.pl'] > 0
+
+        with app.make_deleter("batched", mail, True) as deleter:
+            deleter.add(uids[0])
+        assert len(app.search_by_subject(mail, SUBJECT_PREFIX, use_uid=True)) == len(raw_messages) - 1
+        return app.imap_transfer_stats(mail)
+    finally:
+        mail.logout()
+
+def test_uncompressed_session():
+    assert check_session(compress=False) is None
+
+def test_compressed_session():
+    plain, wire = check_session(compress=True)
+    # Newslettery HTML kompresują się kilkukrotnie
+    assert wire * 3 < plain
+
+def test_idle_on_compressed_session():
+    load_mailbox(2)
+    imap_server.compress = True
+    watcher = app.MailboxWatcher()
+    try:
+        watcher.watch(SUBJECT_PREFIX)
+        deadline = time.time() + 10
+        while watcher.watch(SUBJECT_PREFIX) != 2 and time.time() < deadline:
+            time.sleep(0.05)
+        imap_server.mailbox.append(generate_mailbox(1, http_server.base_url, seed=8)[0][1])
+        while watcher.watch(SUBJECT_PREFIX) != 3 and time.time() < deadline:
+            time.sleep(0.05)
+        assert watcher.watch(SUBJECT_PREFIX) == 3
+        assert watcher.status()['mode'] == "IDLE"
+    finally:
+        watcher.stop()
+
+def test_run_reports_transfer():
+    for compress in (False, True):
+        load_mailbox()
+        imap_server.compress = compress
+        app.close_imap_pool()
+        job = app.Job()
+        results = app.open_emails_by_subject(SUBJECT_PREFIX, interval=0, click_percentage=0, job=job)
+        assert results.count() == 6 and results.count("error") == 0
+        transfer = job.snapshot()['transfer']
+        if compress:
+            assert transfer[1] < transfer[0]
+        else:
+            assert transfer is None
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
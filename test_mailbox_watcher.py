@@ -0,0 +1,121 @@
+"""Test obserwacji skrzynki (MailboxWatcher, IMAP IDLE) na lokalnym serwerze zastępczym.
+
+Połączenie w IDLE zostaje zerwane bez ostrzeżenia (pośrednik TCP przestaje
+przekazywać dane) - wątek obserwacji ma to wykryć po WATCH_READ_TIMEOUT,
+połączyć się ponownie i dalej liczyć nowe maile.
+
+Uruchomienie: python test_mailbox_watcher.py  (albo python -m pytest test_mailbox_watcher.py)
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from _mailbox import SUBJECT_PREFIX, generate_mailbox
+from _servers import StandInHTTPServer, StandInIMAPServer
+
+imap_server = StandInIMAPServer().start()
+http_server = StandInHTTPServer().start()
+
+class BlackholeProxy:
+    """Pośrednik TCP do serwera IMAP; blackhole() ucisza otwarte połączenia, nie zamykając ich"""
+
+    def __init__(self, port):
+        self.port = port
+        self.links = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    @property
+    def address(self):
+        return self.listener.getsockname()[1]
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            upstream = socket.create_connection(("127.0.0.1", self.port))
+            silent = threading.Event()
+            self.links.append(silent)
+            for source, target in ((client, upstream), (upstream, client)):
+                threading.Thread(target=self._pipe, args=(source, target, silent), daemon=True).start()
+
+    def _pipe(self, source, target, silent):
+        while True:
+            try:
+                data = source.recv(65536)
+            except OSError:
+                data = b''
+            if not data:
+                target.close()
+                return
+            if not silent.is_set():
+                target.sendall(data)
+
+    def blackhole(self):
+        # Tylko otwarte połączenia - ponowne połączenie watchera działa normalnie
+        for silent in self.links:
+            silent.set()
+
+proxy = BlackholeProxy(imap_server.port)
+
+from _app import import_app
+
+workdir = tempfile.mkdtemp(prefix="mail-opener-test-")
+SETTINGS = dict(
+    IMAP_SERVER="127.0.0.1",
+    IMAP_PORT=proxy.address,
+    IMAP_SSL=False,
+    LOG_LEVEL="WARNING",
+    IMAGE_CACHE_DIR=os.path.join(workdir, "images"),
+    HEADER_INDEX_PATH=os.path.join(workdir, "headers.sqlite3"),
+    IMAP_IDLE_RENEW=1,
+    WATCH_READ_TIMEOUT=2,
+    WATCH_POLL_INTERVAL=0.2,
+    WATCH_RETRY_DELAY=0,
+)
+app = import_app(**SETTINGS)
+
+def setup_module():
+    # Pliki testów zbierane razem (pytest) - ustawienia i serwery tego pliku na czas jego testów
+    import_app(**SETTINGS)
+
+def wait_for_count(watcher, expected, timeout=15):
+    deadline = time.time() + timeout
+    while watcher.watch(SUBJECT_PREFIX) != expected and time.time() < deadline:
+        time.sleep(0.05)
+    return watcher.watch(SUBJECT_PREFIX)
+
+def test_reconnects_after_silent_drop():
+    messages = generate_mailbox(3, http_server.base_url, seed=5, attachment_size=0)
+    imap_server.mailbox.load(raw for _, raw in messages[:2])
+    watcher = app.MailboxWatcher()
+    try:
+        assert wait_for_count(watcher, 2) == 2
+        assert watcher.status()['mode'] == "IDLE"
+        connections = len(proxy.links)
+        proxy.blackhole()
+        imap_server.mailbox.append(messages[2][1])
+        assert wait_for_count(watcher, 3) == 3
+        assert len(proxy.links) > connections
+        assert watcher.status()['state'] == "watching"
+    finally:
+        watcher.stop()
+
+def test_stop_ends_idle_from_watcher_thread():
+    imap_server.mailbox.load(raw for _, raw in generate_mailbox(1, http_server.base_url, seed=6, attachment_size=0))
+    watcher = app.MailboxWatcher()
+    assert wait_for_count(watcher, 1) == 1
+    thread = watcher._thread
+    watcher.stop()
+    thread.join(5)
+    assert not thread.is_alive() and watcher.status()['state'] == "stopped"
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")
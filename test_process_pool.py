@@ -0,0 +1,60 @@
+"""Test puli procesów (PROCESS_POOL_SIZE) na lokalnym serwerze zastępczym.
+
+W trakcie przebiegu ginie proces roboczy - pula jest zamykana i zastępowana
+nową, a przebieg kończy się dla wszystkich maili.
+
+Uruchomienie: python test_process_pool.py  (albo python -m pytest test_process_pool.py)
+"""
+import os
+import signal
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks"))
+
+from _mailbox import SUBJECT_PREFIX, generate_mailbox
+from _servers import StandInHTTPServer, StandInIMAPServer
+
+imap_server = StandInIMAPServer().start()
+http_server = StandInHTTPServer().start()
+
+from _app import import_app
+
+workdir = tempfile.mkdtemp(prefix="mail-opener-test-")
+SETTINGS = dict(
+    IMAP_SERVER="127.0.0.1",
+    IMAP_PORT=imap_server.port,
+    IMAP_SSL=False,
+    LOG_LEVEL="WARNING",
+    IMAGE_CACHE_DIR=os.path.join(workdir, "images"),
+    HEADER_INDEX_PATH=os.path.join(workdir, "headers.sqlite3"),
+    PROCESS_POOL_SIZE=2,
+)
+app = import_app(**SETTINGS)
+
+def setup_module():
+    # Pliki testów zbierane razem (pytest) - ustawienia i serwery tego pliku na czas jego testów
+    import_app(**SETTINGS)
+
+def test_worker_killed_mid_run():
+    messages = generate_mailbox(12, http_server.base_url, seed=3, mix={"alternative": 1, "charsets": 1}, attachment_size=0)
+    imap_server.mailbox.load(raw for _, raw in messages)
+    results = []
+    broken_pool = None
+    for result, _ in app.iter_open_emails(SUBJECT_PREFIX, interval=0, click_percentage=0, use_process_pool=True, job=app.Job()):
+        results.append(result)
+        if len(results) == 3:
+            # Kolejne maile są już zlecone do analizy (AnalysisStage) - giną razem z procesem
+            broken_pool = app.get_process_pool()
+            os.kill(next(iter(broken_pool._processes)), signal.SIGKILL)
+    assert len(results) == len(messages)
+    assert [result.status for result in results].count("error") == 0
+    assert app.get_process_pool() is not broken_pool
+    app.get_process_pool().shutdown()
+    app.get_process_pool.clear()
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: OK")